@@ -13,9 +13,14 @@ from examples.multiple_trackvizs import main
 import time
 import contextlib, io
 from dash_extensions import DeferScript
+import flask
 import json
-import os, shutil
+import os
+import sys
 import logging
+from core_gui.gui_assets.live_view import LiveView, add_live_view_routes
+from core_gui.gui_assets.segment_store import SegmentStore, add_segment_routes
+from core_gui.gui_assets.stream_metrics import read_metrics
 
 ############################################################################################
 ###--------------------### GLOBAL QUEUE OBJECTS FOR DATA TRANSFER ###--------------------###
@@ -29,6 +34,15 @@ def globalQueueInit():
 
 globalQueueInit()
 
+##########################################################################
+###--------------------### GLOBAL SEGMENT STORE ###--------------------###
+##########################################################################
+# The streamer uploads the HLS playlists and segments here, and the app serves them from memory at /hls/
+segmentStore = SegmentStore()
+
+# The streamer also pushes each new frame here as a JPEG, for the control panel's low latency view at /live/mjpeg
+liveView = LiveView()
+
 ############################################################################
 ###--------------------### GLOBAL BUTTON COUNTERS ###--------------------###
 ############################################################################
@@ -159,6 +173,17 @@ def control_panel_body():
                 children=[
                     html.P('Chronos has stopped!')
                 ]
+            ),
+
+            html.Br(),
+
+            # Low latency view of the simulation, to see the effect of the controls straight away
+            html.P('Live view'),
+            html.Img(
+                id='live-view',
+                src='/live/mjpeg',
+                alt='The live view starts with the simulation.',
+                style={'width': '100%'}
             )
         ]
     )
@@ -228,6 +253,10 @@ def stats_body():
                     html.P(
                         id='live-update-test'
                     ),
+                    # Streaming pipeline metrics, also served as JSON at /stream-metrics
+                    html.Pre(
+                        id='stream-metrics'
+                    ),
                     html.Button(
                         'Clear console',
                         id='button-5'
@@ -351,6 +380,21 @@ def stats_body():
     )
 
 ###--------------------### WEB APP INITIALISATION ###--------------------###
+# Where the streamer publishes its metrics (see Simulation.run_with_web)
+metrics_file_path = 'assets/hls/metrics.json'
+
+def read_stream_metrics():
+    '''
+    The streamer's published metrics, or None. The streamer only sees segments published to a local playlist,
+    so when it uploads to segmentStore the segment count and timings are taken from the store instead.
+    '''
+    metrics = read_metrics(metrics_file_path)
+    if metrics is not None and not metrics['segments']:
+        uploads = segmentStore.stats()
+        metrics['segments'] = uploads['segments']
+        metrics['stages']['segment'] = uploads['segment']
+    return metrics
+
 def web_init():
 
     app = Dash(
@@ -361,6 +405,10 @@ def web_init():
     app.title = "Chronos Web Interface"
     # server = app.server # not sure if needed?
 
+    # Serves the stream from segmentStore at /hls/, and takes the streamer's uploads
+    add_segment_routes(app.server, segmentStore)
+    add_live_view_routes(app.server, liveView)
+
     ## MAIN LAYOUT SECTION ## -----
     app.layout = html.Div(
         id="app-container", 
@@ -513,6 +561,32 @@ def web_init():
     )
     def update_test(n):
         return html.P('Current elapsed time of session: ' + str(n))
+
+    # Call back that shows the streaming pipeline metrics published by the streamer
+    @app.callback(
+    Output('stream-metrics', 'children'),
+    Input('interval-component', 'n_intervals')
+    )
+    def update_stream_metrics(n):
+        metrics = read_stream_metrics()
+        if metrics is None:
+            return ''
+
+        lines = ['Stream: ' + ', '.join(f'{name} {count}' for name, count in metrics['frames'].items()) + ' frames']
+        for name, stage in metrics['stages'].items():
+            if stage['count']:
+                lines.append(f"  {name:<8} p50 {stage['p50_ms']:7.1f} ms  p95 {stage['p95_ms']:7.1f} ms  max {stage['max_ms']:7.1f} ms")
+        lines.append(f"  queue depth {metrics['queue']['depth']} (max {metrics['queue']['max_depth']}), "
+                     f"{metrics['segments']} segments, encoder speed {metrics['encoder_speed']}")
+        return '\n'.join(lines)
+
+    # Structured snapshot of the streaming pipeline metrics, for polling or scraping
+    @app.server.route('/stream-metrics')
+    def stream_metrics():
+        metrics = read_stream_metrics()
+        response = flask.jsonify(metrics if metrics is not None else {})
+        response.headers['Cache-Control'] = 'no-store'
+        return response
     
     # Call back that starts/stop the Chronos simulation
     @app.callback(
@@ -555,9 +629,11 @@ def web_init():
 
             if not chronosProcess.is_alive() and n_clicks_start_actual == 1:
 
-                streamer_file_path = 'assets/hls'
-                shutil.rmtree(streamer_file_path)
-                os.makedirs(streamer_file_path)
+                # Clear the previous session's stream and metrics
+                segmentStore.clear()
+                liveView.clear()
+                if os.path.isfile(metrics_file_path):
+                    os.remove(metrics_file_path)
 
                 consoleQueue.put('-----### CHRONOS IS STARTING ###-----')
                 chronosProcess = Process(
@@ -641,8 +717,6 @@ def web_init():
         Input('button-refresh', 'n_clicks')
     )
     def refresh_page(n_clicks):
-        # Delete the assets > hls > live.m3u8 file to reset the session
-        streamer_file_path = 'assets/hls/live.m3u8'
 
         # Code to clear the console queue so that it stops outputting stuff
         while not consoleQueue.empty():
@@ -653,9 +727,8 @@ def web_init():
         if n_clicks == 1 and chronosProcess.is_alive(): # To avoid putting this into the queue when the web loads for the first time 
             commandQueue.put('stop stream')
         
-        # Delete the live.m3u8 file (first instance)
-        if os.path.isfile(streamer_file_path):
-            os.remove(streamer_file_path)
+        # Delete the live.m3u8 playlist (first instance) to reset the session
+        segmentStore.delete('live.m3u8')
         
         return ''
     
@@ -679,7 +752,7 @@ def web_init():
         
         buttonIsPressed = n_clicks > sendCommandCount
 
-        commandList = ['create', 'remove', 'start', 'stop', 'clear']
+        commandList = ['create', 'remove', 'start', 'stop', 'clear', 'faster', 'slower', 'pause', 'begin', 'end']
 
         # Functions that will be called based on the command input
         def create_agents():
@@ -722,13 +795,27 @@ def web_init():
         def js_buttons():
             return sendCommandText, sendCommandStyle, '' 
 
+        # Simulation controls, with or without a window (see Simulation.run_with_web)
+        def sim_controls():
+            if len(input.split()) != 1:
+                return None
+
+            commandQueue.put(input.strip())
+
+            return sendCommandText, sendCommandStyle, ''
+
         ## Hash table mapping the commands and their functions
         commandHash = {
             'create': create_agents,
             'remove': remove_agents,
             'start': js_buttons,
             'stop': js_buttons,
-            'clear': js_buttons
+            'clear': js_buttons,
+            'faster': sim_controls,
+            'slower': sim_controls,
+            'pause': sim_controls,
+            'begin': sim_controls,
+            'end': sim_controls
         }
 
         if buttonIsPressed:
@@ -753,11 +840,9 @@ def web_init():
         Input('streamer-interval', 'disabled') 
     )
     def stream_reload(n, dont_disable):
-        streamer_file_path = 'assets/hls/live.m3u8'
-
         # dont_disable is by default 'None', which ensures that this callback function gets called every n_interval
         # when 'not None' is returned to the dcc.Interval element, this callback function stops being called
-        if os.path.isfile(streamer_file_path):
+        if segmentStore.get('live.m3u8') is not None:
             return 'a', not dont_disable
 
         return '', dont_disable
@@ -780,10 +865,12 @@ def testFun123(dataQueueInput, dataQueueOutput, consoleQueue, commandQueue):
     
 if __name__ == '__main__':
 
-    # Delete the assets > hls > files to reset the session
-    streamer_file_path = 'assets/hls'
-    shutil.rmtree(streamer_file_path)
-    os.makedirs(streamer_file_path)
+    # python app.py --headless renders Chronos without a window (see use_headless in examples/multiple_trackvizs.py)
+    if '--headless' in sys.argv[1:]:
+        os.environ['CHRONOS_HEADLESS'] = '1'
+
+    # The streamer publishes its metrics in assets > hls
+    os.makedirs(os.path.dirname(metrics_file_path), exist_ok=True)
 
     # Supresses Flask HTTP request logs from the console
     log = logging.getLogger('werkzeug')
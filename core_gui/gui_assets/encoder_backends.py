@@ -0,0 +1,279 @@
+# Encoder backends for PygameStreamer: ffmpeg as a subprocess fed through a
+# pipe, or libav in process through PyAV (pip install av), when available
+
+import sys
+import time
+from collections import deque
+from fractions import Fraction
+from queue import Queue, Empty
+from threading import Thread
+
+import subprocess as sp
+import numpy as np
+
+try:
+    import av
+except ImportError:
+    av = None
+
+
+ON_POSIX = 'posix' in sys.builtin_module_names
+
+BACKENDS = ('ffmpeg', 'pyav', 'auto')
+
+
+def enqueue_output(out, queue):
+    for line in iter(out.readline, b''):
+        queue.put(line)
+    out.close()
+
+
+class FFmpegEncoder():
+    """
+    Encodes frames with an ffmpeg subprocess, writing them to its stdin.
+    Stats are the frames written and the speed ffmpeg last reported.
+
+    Arguments:
+        profile - the EncoderProfile to encode with
+        w, h, fps - frame size and rate
+        pix_fmt - ffmpeg pixel format of the frames
+        output - file (or URL) to write the stream to
+        bitrate - target bitrate, ahead of the profile's; None for the profile's
+        segment_time - seconds per segment, unless the profile sets it
+        sdp_name - SDP file describing an rtp stream
+        vfr - timestamp frames as they arrive (see EncoderProfile.input_args())
+    """
+
+    name = 'ffmpeg'
+
+    def __init__(self, profile, w, h, fps, pix_fmt, output,
+                 bitrate=None, segment_time=1, sdp_name='pygame_streamer.sdp',
+                 vfr=False, verbose=False):
+        self._verbose = verbose
+        self._frames = 0
+        self._speed = None
+
+        command = profile.command(w, h, fps, pix_fmt, output,
+                                  bitrate=bitrate,
+                                  segment_time=segment_time,
+                                  sdp_name=sdp_name,
+                                  vfr=vfr)
+        if verbose:
+            print(' '.join(command), flush=True)
+
+        self._process = sp.Popen(command,
+                                 stdin=sp.PIPE,
+                                 stderr=sp.STDOUT,
+                                 stdout=sp.PIPE,
+                                 close_fds=ON_POSIX)
+
+        # Use a thread to parse ffmpeg output without blocking
+        self._q = Queue()
+        t = Thread(target=enqueue_output, args=(self._process.stdout, self._q))
+        t.daemon = True  # thread dies at the end of the program
+        t.start()
+
+    def write(self, array_data):
+        """
+        Writes a frame to ffmpeg straight from the array's buffer, without
+        copying it into a bytes object first. Raises BrokenPipeError if
+        ffmpeg has exited.
+        """
+        self._process.stdin.write(memoryview(np.ascontiguousarray(array_data)))
+        self._frames += 1
+        self.__read_output()
+
+    def __get_speed(self, line):
+        ratio = None
+        words = line.split(' ')
+
+        for word in words:
+            elems = word.split('=')
+            if elems[0] == 'speed' and elems[1] == 'N/A':
+                pass
+            elif elems[0] == 'speed' and elems[1] != '':
+                ratio = float(elems[1].split('x')[0])
+        return ratio
+
+    def __read_output(self):
+        """
+        Drains what ffmpeg printed since the last call, so its pipe never
+        fills up, and keeps the latest encoding speed it reported.
+        """
+        while True:
+            try:
+                line = self._q.get_nowait()
+            except Empty:
+                return
+            ratio = self.__get_speed(line.decode("utf-8", "replace"))
+            if ratio is not None:
+                self._speed = ratio
+                if self._verbose:
+                    print(ratio, flush=True)
+
+    def close(self):
+        """Closes ffmpeg's stdin, and gives it a few seconds to finish the stream."""
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            self._process.wait(timeout=5.0)
+        except sp.TimeoutExpired:
+            self._process.kill()
+        self.__read_output()
+
+    def stats(self):
+        return {
+            'backend': self.name,
+            'encoded_frames': self._frames,
+            'encoder_speed': self._speed,
+        }
+
+
+class PyAVEncoder():
+    """
+    Encodes frames in process with libav, through PyAV: each frame is
+    copied once into a libav frame, converted to yuv420p by swscale,
+    encoded and muxed, with no pipe or subprocess in between. Stats
+    come straight from the encoder: frames, keyframes and bytes encoded,
+    the time spent encoding each frame, and the encoding speed.
+
+    Arguments are those of FFmpegEncoder. Profiles with renditions, and
+    rtp, need the ffmpeg command line; see supports().
+    """
+
+    name = 'pyav'
+
+    def __init__(self, profile, w, h, fps, pix_fmt, output,
+                 bitrate=None, segment_time=1, sdp_name='pygame_streamer.sdp',
+                 vfr=False, verbose=False, history=1000):
+        if av is None:
+            raise Exception("PyAV could not be imported!")
+        if not self.supports(profile):
+            raise Exception(f"Sorry, the pyav backend cannot encode the {profile.name} profile.")
+        self._w = w
+        self._h = h
+        self._pix_fmt = pix_fmt
+        self._vfr = vfr
+        self._gop = profile.gop
+
+        rate = Fraction(str(fps)).limit_denominator(1000)
+        self._container = av.open(output, mode='w', format=profile.format,
+                                  options=profile.format_options(segment_time))
+        self._stream = self._container.add_stream('libx264', rate=rate,
+                                                  options=profile.codec_options(fps, bitrate))
+        self._stream.width = w
+        self._stream.height = h
+        self._stream.pix_fmt = 'yuv420p'
+        # frames are numbered at a constant rate, or stamped in milliseconds
+        self._time_base = Fraction(1, 1000) if vfr else 1 / rate
+        self._stream.codec_context.time_base = self._time_base
+        if verbose:
+            print(f'pyav: {profile.format} to {output}, libx264 {profile.codec_options(fps, bitrate)}, '
+                  f'{profile.format_options(segment_time)}', flush=True)
+
+        self._keyframe = getattr(av.video.frame, 'PictureType', None)
+        self._keyframe = self._keyframe.I if self._keyframe else 'I'
+        self._next_keyframe = 0.0
+        self._frames = 0
+        self._keyframes = 0
+        self._bytes = 0
+        self._encode_times = deque(maxlen=history)
+        self._encoding = 0.0
+        self._start = None
+        self._last_pts = -1
+
+    @classmethod
+    def supports(cls, profile):
+        """Whether the profile can be encoded in process."""
+        return not profile.renditions and profile.format in ('hls', 'dash', 'mp4')
+
+    def write(self, array_data):
+        """Encodes a frame, a (h, w, bytes per pixel) uint8 array in pix_fmt."""
+        started = time.monotonic()
+        if self._start is None:
+            self._start = started
+
+        frame = av.VideoFrame(self._w, self._h, self._pix_fmt)
+        plane = frame.planes[0]
+        # libav may pad the rows of its frames
+        rows = np.frombuffer(plane, dtype=np.uint8).reshape(self._h, plane.line_size)
+        np.copyto(rows[:, :self._w * array_data.shape[2]], array_data.reshape(self._h, -1))
+        del rows
+
+        if self._vfr:
+            pts = int((started - self._start) / self._time_base)
+            frame.pts = max(pts, self._last_pts + 1)
+        else:
+            frame.pts = self._frames
+        frame.time_base = self._time_base
+        self._last_pts = frame.pts
+        # keyframes every gop seconds of stream, as -force_key_frames does
+        seconds = frame.pts * self._time_base
+        if self._gop and seconds >= self._next_keyframe:
+            frame.pict_type = self._keyframe
+            self._next_keyframe = (int(seconds / self._gop) + 1) * self._gop
+
+        self.__mux(self._stream.encode(frame))
+        self._frames += 1
+        elapsed = time.monotonic() - started
+        self._encode_times.append(elapsed)
+        self._encoding += elapsed
+
+    def __mux(self, packets):
+        for packet in packets:
+            self._bytes += packet.size
+            if packet.is_keyframe:
+                self._keyframes += 1
+            self._container.mux(packet)
+
+    def close(self):
+        """Flushes the encoder and finishes the stream."""
+        try:
+            self.__mux(self._stream.encode())
+        finally:
+            self._container.close()
+
+    def stats(self):
+        times = np.array(self._encode_times) * 1000.0
+        duration = float(self._last_pts * self._time_base) if self._frames else 0.0
+        return {
+            'backend': self.name,
+            'encoded_frames': self._frames,
+            'keyframes': self._keyframes,
+            'encoded_bytes': self._bytes,
+            'encode_ms_mean': float(times.mean()) if len(times) else 0.0,
+            'encode_ms_p95': float(np.percentile(times, 95)) if len(times) else 0.0,
+            'encode_ms_max': float(times.max()) if len(times) else 0.0,
+            # seconds of stream per second spent encoding, as ffmpeg reports
+            # speed for a file; a live stream only needs 1
+            'encoder_speed': round(duration / self._encoding, 2) if self._encoding else None,
+        }
+
+
+def choose_backend(backend, profile, verbose=False):
+    """
+    Returns the name of the backend to encode profile with: backend
+    ('ffmpeg', 'pyav' or 'auto', which prefers pyav), falling back to
+    'ffmpeg' when PyAV is not installed or cannot encode the profile.
+    """
+    if backend not in BACKENDS:
+        raise Exception(f"Sorry, unknown encoder backend {backend}. Use one of {', '.join(BACKENDS)}.")
+    if backend == 'ffmpeg':
+        return backend
+    if av is None:
+        reason = 'PyAV is not installed'
+    elif not PyAVEncoder.supports(profile):
+        reason = f'it cannot encode the {profile.name} profile'
+    else:
+        return 'pyav'
+    if verbose or backend == 'pyav':
+        print(f'Not encoding with pyav, as {reason}: using ffmpeg', flush=True)
+    return 'ffmpeg'
+
+
+def open_encoder(backend, profile, w, h, fps, pix_fmt, output, **options):
+    """Starts an encoder of the backend chosen by choose_backend()."""
+    encoder = PyAVEncoder if backend == 'pyav' else FFmpegEncoder
+    return encoder(profile, w, h, fps, pix_fmt, output, **options)
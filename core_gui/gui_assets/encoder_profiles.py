@@ -0,0 +1,359 @@
+# Encoder profiles: the ffmpeg settings PygameStreamer encodes and packages
+# its raw frames with, from low latency live streams to recordings
+
+import copy
+import os
+
+# target bitrate when neither the streamer nor the profile sets one
+DEFAULT_BITRATE = '10000k'
+
+
+class Rendition():
+    """
+    One rung of an adaptive bitrate ladder.
+
+    Arguments:
+        name - name of the rendition, used in its playlist and segment names
+        height - height in pixels, keeping the aspect ratio; None for the
+            input's own size
+        bitrate - target bitrate, e.g. '2500k', ahead of the streamer's;
+            None for the streamer's
+    """
+
+    def __init__(self, name, height=None, bitrate=None):
+        self.name = name
+        self.height = height
+        self.bitrate = bitrate
+
+
+class EncoderProfile():
+    """
+    A named set of ffmpeg settings for PygameStreamer.
+
+    Arguments:
+        name - name the profile is registered under
+        format - ffmpeg output format: 'hls', 'dash', 'rtp' or 'mp4'
+        preset - x264 preset, trading CPU for compression
+        tune - x264 tune, e.g. 'zerolatency' to disable frame lookahead
+            and B-frames so each frame leaves the encoder at once
+        gop - seconds between keyframes; segments can only start at one
+        bitrate - target bitrate, e.g. '4000k', unless the streamer is given
+            one; None for DEFAULT_BITRATE
+        crf - constant quality (0-51, lower is better) instead of a
+            target bitrate, for recordings
+        segment_time - seconds per HLS/DASH segment; None for the
+            streamer's chunk_time
+        segment_type - 'mpegts' or 'fmp4' HLS segments
+        hls_flags - ffmpeg -hls_flags, '+' separated
+        muxer_args - extra output arguments, after the generated ones
+        renditions - list of Renditions to encode from the one input, for
+            adaptive bitrate HLS; renditions taller than the input are
+            left out. None for a single rendition at the input's size.
+        description - one line about what the profile is for
+    """
+
+    def __init__(self, name, format,
+                 preset='ultrafast',
+                 tune=None,
+                 gop=1.0,
+                 bitrate=None,
+                 crf=None,
+                 segment_time=None,
+                 segment_type='mpegts',
+                 hls_flags='delete_segments',
+                 muxer_args=(),
+                 renditions=None,
+                 description=''
+                 ):
+        self.name = name
+        self.format = format
+        self.preset = preset
+        self.tune = tune
+        self.gop = gop
+        self.bitrate = bitrate
+        self.crf = crf
+        self.segment_time = segment_time
+        self.segment_type = segment_type
+        self.hls_flags = hls_flags
+        self.muxer_args = list(muxer_args)
+        self.renditions = renditions
+        self.description = description
+
+    def with_options(self, **options):
+        """Returns a copy of the profile with the given settings changed."""
+        profile = copy.copy(self)
+        for name, value in options.items():
+            if not hasattr(profile, name):
+                raise Exception(f"Unknown encoder profile setting {name}.")
+            setattr(profile, name, value)
+        return profile
+
+    def input_args(self, w, h, fps, pix_fmt, vfr=False):
+        """
+        ffmpeg arguments reading raw frames from stdin. With vfr, each
+        frame is timestamped when it arrives, so frames need only be sent
+        when the picture changes.
+        """
+        args = ['-y',
+                '-f', 'rawvideo',
+                '-vcodec', 'rawvideo',
+                '-pix_fmt', pix_fmt,
+                '-s', f'{w}x{h}']
+        if vfr:
+            # no input rate: it would renumber the frames at fps, discarding
+            # their arrival times, so pauses would collapse on playback
+            args += ['-use_wallclock_as_timestamps', '1']
+        else:
+            args += ['-r', str(fps)]
+        return args + ['-i', '-']  # input from stdin
+
+    def codec_options(self, fps, bitrate=None):
+        """
+        The x264 settings as libav codec options, e.g. {'preset':
+        'ultrafast', 'b': '10000k', 'g': '30'}, for an in-process encoder.
+        An explicit bitrate comes first, then the profile's, then
+        DEFAULT_BITRATE.
+        """
+        options = {'preset': self.preset}
+        if self.tune:
+            options['tune'] = self.tune
+        if self.crf is not None:
+            options['crf'] = str(self.crf)
+        else:
+            options['b'] = bitrate or self.bitrate or DEFAULT_BITRATE
+        if self.gop:
+            # a fixed GOP, with keyframes exactly where segments may start
+            keyint = max(int(round(float(fps) * self.gop)), 1)
+            options.update(g=str(keyint), keyint_min=str(keyint), sc_threshold='0')
+        return options
+
+    def format_options(self, segment_time=1):
+        """
+        The packaging settings as libav muxer options, e.g. {'hls_time':
+        '1', 'hls_flags': 'delete_segments'}, including muxer_args.
+        """
+        segment_time = str(self.segment_time or segment_time)
+        if self.format == 'hls':
+            options = {'hls_time': segment_time,
+                       'hls_flags': self.hls_flags}
+            if self.segment_type != 'mpegts':
+                options['hls_segment_type'] = self.segment_type
+        elif self.format == 'dash':
+            options = {'seg_duration': segment_time,
+                       'use_timeline': '1',
+                       'use_template': '1',
+                       'remove_at_exit': '1'}
+        elif self.format == 'rtp':
+            options = {}
+        elif self.format == 'mp4':
+            options = {'movflags': '+faststart'}
+        else:
+            raise Exception("Sorry, unknown format. Use hls, dash, rtp or mp4.")
+        # muxer_args are '-name', 'value' pairs
+        for name, value in zip(self.muxer_args[0::2], self.muxer_args[1::2]):
+            options[name.lstrip('-')] = value
+        return options
+
+    def video_args(self, fps, bitrate=None, vfr=False):
+        """
+        ffmpeg arguments encoding the video with x264. With vfr, frames
+        keep their timestamps instead of being duplicated to a constant
+        frame rate.
+        """
+        args = ['-c:v', 'libx264',
+                '-pix_fmt', 'yuv420p']
+        if vfr:
+            args += ['-fps_mode', 'vfr']
+        for name, value in self.codec_options(fps, bitrate).items():
+            args += ['-b:v' if name == 'b' else f'-{name}', value]
+        if self.gop:
+            args += ['-force_key_frames', f'expr:gte(t,n_forced*{self.gop})']
+        return args
+
+    def output_args(self, output, segment_time=1, sdp_name='pygame_streamer.sdp'):
+        """ffmpeg arguments packaging the video into output."""
+        args = ['-sdp_file', sdp_name] if self.format == 'rtp' else []
+        for name, value in self.format_options(segment_time).items():
+            args += [f'-{name}', value]
+        return args + ['-f', self.format, output]
+
+    def ladder(self, h):
+        """The profile's renditions for an input h pixels tall."""
+        return [r for r in self.renditions if r.height is None or r.height < h]
+
+    def ladder_args(self, h, fps, bitrate, vfr=False):
+        """
+        ffmpeg arguments encoding every rendition from the one input.
+        The input is converted to yuv420p once, and each rendition is
+        scaled from the next larger one, so conversion and scaling work
+        is shared down the ladder.
+        """
+        ladder = self.ladder(h)
+        # e.g. [0:v]format=yuv420p,split=2[v0][s0];[s0]scale=-2:720,split=2[v1][s1];...
+        source, ops = '[0:v]', ['format=yuv420p']
+        filters = []
+        for i, rendition in enumerate(ladder):
+            if rendition.height is not None:
+                ops.append(f'scale=-2:{rendition.height}')
+            if i + 1 < len(ladder):
+                filters.append(f"{source}{','.join(ops + ['split=2'])}[v{i}][s{i}]")
+                source, ops = f'[s{i}]', []
+            else:
+                filters.append(f"{source}{','.join(ops) or 'null'}[v{i}]")
+        
+        args = ['-filter_complex', ';'.join(filters)]
+        for i in range(len(ladder)):
+            args += ['-map', f'[v{i}]']
+        args += self.video_args(fps, bitrate, vfr)
+        for i, rendition in enumerate(ladder):
+            rate = rendition.bitrate or bitrate or self.bitrate or DEFAULT_BITRATE
+            args += [f'-b:v:{i}', rate,
+                     f'-maxrate:v:{i}', rate,
+                     f'-bufsize:v:{i}', rate]
+        return args
+
+    def ladder_output_args(self, h, output, segment_time=1):
+        """
+        ffmpeg arguments writing each rendition to its own HLS playlist,
+        and a master playlist listing them all at output.
+        """
+        if self.format != 'hls':
+            raise Exception("Sorry, adaptive bitrate needs the hls format.")
+        directory, master = os.path.split(output)
+        base = os.path.splitext(master)[0]
+        segment_ext = 'ts' if self.segment_type == 'mpegts' else 'm4s'
+        ladder = self.ladder(h)
+        
+        args = ['-hls_time', str(self.segment_time or segment_time),
+                '-hls_flags', self.hls_flags,
+                '-var_stream_map', ' '.join(f'v:{i},name:{r.name}' for i, r in enumerate(ladder)),
+                '-master_pl_name', master,
+                '-hls_segment_filename', os.path.join(directory, f'{base}_%v_%05d.{segment_ext}')]
+        if self.segment_type != 'mpegts':
+            args += ['-hls_segment_type', self.segment_type,
+                     '-hls_fmp4_init_filename', f'{base}_%v_init.mp4']
+        return args + self.muxer_args + ['-f', 'hls', os.path.join(directory, f'{base}_%v.m3u8')]
+
+    def for_upload(self):
+        """
+        Returns a copy of the profile which uploads its playlists and
+        segments with HTTP PUT (and removes old segments with DELETE), for
+        an http:// output such as a SegmentStore (see segment_store.py).
+        HLS segments are numbered from the microsecond the stream starts, so
+        their names are not reused by the next stream.
+        """
+        muxer_args = ['-method', 'PUT']
+        if self.format == 'hls':
+            muxer_args += ['-hls_start_number_source', 'epoch_us']
+        return self.with_options(muxer_args=self.muxer_args + muxer_args)
+
+    def playlist(self, h, output):
+        """
+        The file ffmpeg rewrites each time it publishes a segment: output,
+        or with renditions the first rendition's playlist. None for the
+        formats without segments, and for uploads.
+        """
+        if self.format not in ('hls', 'dash') or '://' in output:
+            return None
+        if self.renditions:
+            directory, master = os.path.split(output)
+            base = os.path.splitext(master)[0]
+            return os.path.join(directory, f'{base}_{self.ladder(h)[0].name}.m3u8')
+        return output
+
+    def command(self, w, h, fps, pix_fmt, output,
+                bitrate=None, segment_time=1, sdp_name='pygame_streamer.sdp', vfr=False):
+        """
+        The full ffmpeg command line for this profile. vfr is for streams
+        which only send a frame when the picture changes (see input_args()).
+        """
+        if self.renditions:
+            return (['ffmpeg']
+                    + self.input_args(w, h, fps, pix_fmt, vfr)
+                    + self.ladder_args(h, fps, bitrate, vfr)
+                    + self.ladder_output_args(h, output, segment_time))
+        return (['ffmpeg']
+                + self.input_args(w, h, fps, pix_fmt, vfr)
+                + self.video_args(fps, bitrate, vfr)
+                + self.output_args(output, segment_time, sdp_name))
+
+
+# full size at the streamer's bitrate, then 720p and 480p
+ABR_LADDER = [
+    Rendition('full'),
+    Rendition('720p', height=720, bitrate='4000k'),
+    Rendition('480p', height=480, bitrate='1500k'),
+]
+
+PROFILES = {p.name: p for p in [
+    # --- live streaming, as PygameStreamer always did --- #
+    EncoderProfile('hls', 'hls',
+                   description='HLS, MPEG-TS segments of chunk_time seconds'),
+    EncoderProfile('dash', 'dash',
+                   description='DASH, segments of chunk_time seconds'),
+    EncoderProfile('rtp', 'rtp', gop=None,
+                   description='RTP, described by an SDP file'),
+
+    # --- low latency live streaming --- #
+    EncoderProfile('hls-lowlatency', 'hls',
+                   tune='zerolatency',
+                   gop=0.5,
+                   segment_time=0.5,
+                   segment_type='fmp4',
+                   hls_flags='delete_segments+independent_segments',
+                   muxer_args=['-hls_list_size', '6'],
+                   description='HLS, half-second fMP4 segments, no encoder delay'),
+    EncoderProfile('dash-lowlatency', 'dash',
+                   tune='zerolatency',
+                   gop=1.0,
+                   segment_time=1,
+                   muxer_args=['-use_timeline', '0',
+                               '-streaming', '1',
+                               '-ldash', '1',
+                               '-frag_type', 'duration',
+                               '-frag_duration', '0.2',
+                               '-target_latency', '1',
+                               # an LL-HLS playlist of the same partial segments
+                               '-hls_playlist', '1',
+                               '-lhls', '1',
+                               '-strict', 'experimental'],
+                   description='Low latency DASH (and LL-HLS) with 0.2 s chunks'),
+    EncoderProfile('rtp-lowlatency', 'rtp', tune='zerolatency', gop=0.5,
+                   description='RTP with no encoder delay'),
+
+    # --- adaptive bitrate: players pick the rendition their link can take --- #
+    EncoderProfile('hls-abr', 'hls',
+                   renditions=ABR_LADDER,
+                   description='HLS, full size, 720p and 480p renditions'),
+    EncoderProfile('hls-lowlatency-abr', 'hls',
+                   tune='zerolatency',
+                   gop=0.5,
+                   segment_time=0.5,
+                   segment_type='fmp4',
+                   hls_flags='delete_segments+independent_segments',
+                   muxer_args=['-hls_list_size', '6'],
+                   renditions=ABR_LADDER,
+                   description='hls-lowlatency with full size, 720p and 480p renditions'),
+
+    # --- recording, where quality and throughput matter more --- #
+    EncoderProfile('record', 'mp4', preset='medium', crf=18, gop=2.0,
+                   description='MP4 file, high quality'),
+    EncoderProfile('record-fast', 'mp4', preset='veryfast', crf=23, gop=2.0,
+                   description='MP4 file, encodes many times faster than real time'),
+    EncoderProfile('hls-quality', 'hls', preset='veryfast', gop=2.0, segment_time=4,
+                   description='HLS, larger segments for better compression'),
+]}
+
+
+def get_profile(profile):
+    """
+    Returns the EncoderProfile registered under the name profile, or
+    profile itself if it is already an EncoderProfile.
+    """
+    if isinstance(profile, EncoderProfile):
+        return profile
+    try:
+        return PROFILES[profile]
+    except KeyError:
+        raise Exception(f"Sorry, unknown encoder profile {profile}. "
+                        f"Use one of {', '.join(PROFILES)}.")
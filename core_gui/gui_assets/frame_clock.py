@@ -0,0 +1,73 @@
+# Monotonic clock pacing a fixed frame rate, for feeding frames to an encoder
+
+import time
+from collections import deque
+
+import numpy as np
+
+
+class FrameClock():
+    """
+    Schedules frames at a fixed rate against the monotonic clock.
+
+    Frame n is due at start + n / fps, so lateness never accumulates into
+    drift: a late frame is followed by a shorter wait. If the caller falls
+    behind, several frames are due at once, to keep the output in step
+    with the wall clock; beyond max_lag seconds behind, the clock gives up
+    on catching up and restarts from now (counted as a resync).
+    """
+
+    def __init__(self, fps, max_lag=1.0, history=1000):
+        self.fps = float(fps)
+        self.interval = 1.0 / self.fps
+        self.max_lag = max_lag
+        self._jitter = deque(maxlen=history)
+        self.frames = 0
+        self.resyncs = 0
+        self._start = None
+
+    def start(self, now=None):
+        """Makes the first frame due now."""
+        self._start = time.monotonic() if now is None else now
+        self.frames = 0
+
+    def deadline(self):
+        """Monotonic time at which the next frame is due."""
+        return self._start + self.frames * self.interval
+
+    def time_to_next(self, now=None):
+        """Seconds until the next frame is due, 0 if it is already due."""
+        now = time.monotonic() if now is None else now
+        return max(self.deadline() - now, 0.0)
+
+    def due(self, now=None):
+        """
+        Returns the number of frames due by now (0 if called early) and
+        counts them as emitted, recording how late the first one is.
+        """
+        now = time.monotonic() if now is None else now
+        lateness = now - self.deadline()
+        if lateness < 0:
+            return 0
+        if lateness > self.max_lag:
+            self.resyncs += 1
+            self._start = now - self.frames * self.interval
+            lateness = 0.0
+        self._jitter.append(lateness)
+        count = int(lateness * self.fps) + 1
+        self.frames += count
+        return count
+
+    def stats(self):
+        """
+        Returns a dict of frames scheduled, resyncs, and the mean, 95th
+        percentile and maximum lateness of recent frames in milliseconds.
+        """
+        jitter = np.array(self._jitter) * 1000.0
+        return {
+            'frames': self.frames,
+            'resyncs': self.resyncs,
+            'jitter_mean_ms': float(jitter.mean()) if len(jitter) else 0.0,
+            'jitter_p95_ms': float(np.percentile(jitter, 95)) if len(jitter) else 0.0,
+            'jitter_max_ms': float(jitter.max()) if len(jitter) else 0.0,
+        }
@@ -0,0 +1,248 @@
+# Shared memory ring buffer of video frames, between one writer process
+# (the simulation) and one reader process (the encoder)
+
+import os
+import time
+from multiprocessing import Event, Lock
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+# Header fields, as int64s at the start of the shared memory
+_SEQ = 0          # sequence number of the last committed frame (0: none yet)
+_LATEST = 1       # slot holding the last committed frame (-1: none yet)
+_READING = 2      # slot held by the reader (-1: none)
+_WRITING = 3      # slot being written (-1: none)
+_READ_SEQ = 4     # sequence number of the last frame the reader took
+_READS = 5        # number of frames the reader took
+_HEADER_LEN = 6   # followed by the sequence number of the frame in each slot,
+                  # then the time.monotonic_ns() each slot's frame was committed
+
+# What happens when the writer gets ahead of the reader
+POLICIES = (
+    'latest',       # the reader takes the latest frame, skipping older ones
+    'drop-oldest',  # the reader takes frames in order; when all slots hold
+                    # unread frames, the writer overwrites the oldest
+    'block',        # the reader takes frames in order; when all slots hold
+                    # unread frames, the writer waits for the reader
+)
+
+
+class FrameRing():
+    """
+    Fixed number of frame slots in shared memory.
+
+    The writer fills a free slot in place (begin_write() / end_write()),
+    and the reader gets a committed frame as an array over its slot
+    (wait_frame()), so frames are never pickled or piped. The slot the
+    reader holds is never written to, so what the reader sees stays intact
+    until it asks for another frame.
+
+    Memory is bounded by the number of slots whatever the policy (see
+    POLICIES): frames the reader does not get to are dropped, and counted
+    (dropped), or with 'block' the writer waits for the reader. It never
+    waits longer than block_timeout seconds though, and then drops the
+    oldest frame after all, so a stalled reader cannot hang the writer.
+
+    A lock only guards the few header updates, never the pixel copies;
+    events wake the reader when a frame is committed, and a blocked
+    writer when a frame is taken.
+    """
+
+    def __init__(self, shape, slots=3, dtype=np.uint8, policy='latest', block_timeout=1.0):
+        if slots < 3:
+            raise Exception("A FrameRing needs at least 3 slots.")
+        if policy not in POLICIES:
+            raise Exception(f"Sorry, unknown frame ring policy {policy}. Use one of {', '.join(POLICIES)}.")
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.dtype = np.dtype(dtype)
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+
+        header_bytes = (_HEADER_LEN + 2 * slots) * 8
+        self._shm = SharedMemory(create=True, size=header_bytes + slots * self.frame_bytes)
+        self._owner_pid = os.getpid()
+        self._lock = Lock()
+        self._event = Event()
+        self._taken = Event()
+        self._attach()
+
+        self._header[:] = -1
+        self._header[_SEQ] = 0
+        self._header[_READ_SEQ] = 0
+        self._header[_READS] = 0
+        self._slot_seq[:] = 0
+        self._slot_time[:] = 0
+
+    def _attach(self):
+        buf = self._shm.buf
+        header_len = _HEADER_LEN + 2 * self.slots
+        self._header = np.ndarray((header_len,), dtype=np.int64, buffer=buf)
+        self._slot_seq = self._header[_HEADER_LEN:_HEADER_LEN + self.slots]
+        self._slot_time = self._header[_HEADER_LEN + self.slots:]
+        self._frames = np.ndarray(
+            (self.slots,) + self.shape, dtype=self.dtype, buffer=buf, offset=header_len * 8
+        )
+        self._last_read = 0
+        self.frame_time = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('_header', '_slot_seq', '_slot_time', '_frames'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    # --- writer side --- #
+
+    def _free_slot(self, overwrite):
+        """
+        Picks the slot to write next, under the lock: the oldest slot the
+        reader is done with; failing that, if overwrite, the oldest slot
+        it does not hold, else None.
+        """
+        read_seq = self._header[_READ_SEQ]
+        busy = [self._header[_READING]]
+        if self.policy == 'latest':
+            # the reader may yet take the latest frame
+            busy.append(self._header[_LATEST])
+        slots = sorted((slot for slot in range(self.slots) if slot not in busy),
+                       key=lambda slot: self._slot_seq[slot])
+        for slot in slots:
+            if self._slot_seq[slot] <= read_seq:
+                return slot
+        return slots[0] if overwrite else None
+
+    def begin_write(self):
+        """
+        Returns an array over a free slot, for the writer to fill with the
+        next frame and then call end_write(). With the 'block' policy,
+        waits (up to block_timeout) for the reader to take a frame when
+        there is no free slot.
+        """
+        deadline = None
+        while True:
+            with self._lock:
+                overwrite = (self.policy != 'block'
+                             or (deadline is not None and time.monotonic() >= deadline))
+                slot = self._free_slot(overwrite)
+                if slot is not None:
+                    self._header[_WRITING] = slot
+                    return self._frames[slot]
+                # cleared under the lock, so a frame taken from now on wakes us
+                self._taken.clear()
+            if deadline is None:
+                deadline = time.monotonic() + self.block_timeout
+            self._taken.wait(max(deadline - time.monotonic(), 0.0))
+
+    def end_write(self):
+        """
+        Commits the frame written since begin_write() and wakes the reader.
+        Returns its sequence number.
+        """
+        with self._lock:
+            slot = self._header[_WRITING]
+            seq = self._header[_SEQ] + 1
+            self._slot_seq[slot] = seq
+            self._slot_time[slot] = time.monotonic_ns()
+            self._header[_SEQ] = seq
+            self._header[_LATEST] = slot
+            self._header[_WRITING] = -1
+        self._event.set()
+        return int(seq)
+
+    def write(self, frame):
+        """
+        Copies frame, an array of the ring's shape, into the ring.
+        Returns its sequence number.
+        """
+        np.copyto(self.begin_write(), frame, casting='no')
+        return self.end_write()
+
+    # --- either side --- #
+
+    @property
+    def seq(self):
+        """Sequence number of the last committed frame, 0 if none."""
+        return int(self._header[_SEQ])
+
+    def _pending(self):
+        read_seq = self._header[_READ_SEQ]
+        writing = self._header[_WRITING]
+        return sum(1 for slot in range(self.slots)
+                   if slot != writing and self._slot_seq[slot] > read_seq)
+
+    @property
+    def pending(self):
+        """Number of committed frames the reader can still take."""
+        with self._lock:
+            return self._pending()
+
+    @property
+    def dropped(self):
+        """Number of committed frames the reader did not take, and never will."""
+        with self._lock:
+            return int(self._header[_SEQ] - self._header[_READS]) - self._pending()
+
+    # --- reader side --- #
+
+    def _next_frame(self, last_seq):
+        """The (seq, slot) for the reader to take after last_seq, or None, under the lock."""
+        if self.policy == 'latest':
+            seq = int(self._header[_SEQ])
+            return (seq, int(self._header[_LATEST])) if seq > last_seq else None
+        writing = self._header[_WRITING]
+        unread = [(int(self._slot_seq[slot]), slot) for slot in range(self.slots)
+                  if slot != writing and self._slot_seq[slot] > last_seq]
+        return min(unread) if unread else None
+
+    def wait_frame(self, last_seq=None, timeout=None):
+        """
+        Waits up to timeout seconds (None: forever) for a frame newer than
+        last_seq (default: the last frame returned), and returns
+        (seq, frame): the latest frame, or with the 'drop-oldest' and
+        'block' policies the oldest one not yet taken. The frame is an
+        array over its slot, which is held for the reader until the next
+        call. Returns (last_seq, None) on timeout. frame_time is then the
+        time.monotonic() the frame was committed at.
+        """
+        if last_seq is None:
+            last_seq = self._last_read
+        while True:
+            # Clear before checking, so a commit in between is not missed
+            self._event.clear()
+            with self._lock:
+                found = self._next_frame(last_seq)
+                if found is not None:
+                    seq, slot = found
+                    self._header[_READING] = slot
+                    self._header[_READ_SEQ] = seq
+                    self._header[_READS] += 1
+                    self._last_read = seq
+                    self.frame_time = int(self._slot_time[slot]) / 1e9
+            if found is not None:
+                self._taken.set()
+                return seq, self._frames[slot]
+            if not self._event.wait(timeout):
+                return last_seq, None
+
+    def release(self):
+        """Lets the writer reuse the slot held by the reader."""
+        with self._lock:
+            self._header[_READING] = -1
+        self._taken.set()
+
+    def close(self):
+        """
+        Detaches from the shared memory, and frees it in the process which
+        created the ring. No frame returned by the ring may be in use.
+        """
+        self._header = self._slot_seq = self._slot_time = self._frames = None
+        self._shm.close()
+        if os.getpid() == self._owner_pid:
+            self._shm.unlink()
@@ -0,0 +1,289 @@
+# Low latency live view: the streamer pushes each new frame as a JPEG to
+# the web app, which sends it straight on to every viewer as an MJPEG
+# (multipart/x-mixed-replace) stream, with no segments to wait for
+
+import http.client
+import io
+import socket
+import time
+from collections import deque
+from threading import Condition, Lock, Thread
+from urllib.parse import urlsplit
+
+import numpy as np
+
+# PIL raw modes reading each packed ffmpeg pix_fmt as RGB
+_RAW_MODES = {
+    'rgb24': 'RGB', 'bgr24': 'BGR',
+    'rgba': 'RGBX', 'rgb0': 'RGBX',
+    'bgra': 'BGRX', 'bgr0': 'BGRX',
+    'argb': 'XRGB', '0rgb': 'XRGB',
+    'abgr': 'XBGR', '0bgr': 'XBGR',
+}
+
+BOUNDARY = 'frame'
+
+# Socket send buffer for viewers, so that frames a slow viewer cannot take
+# are dropped from its ClientQueue rather than queued up in the kernel
+SEND_BUFFER = 64 * 1024
+
+
+class ClientQueue():
+    """
+    Frames waiting to be sent to one viewer. At most maxlen are kept: a
+    slow viewer gets the newest frames and the older ones are dropped
+    (and counted), so it never holds up the others or uses more memory.
+    With maxlen 1, a viewer always gets the latest frame.
+    """
+
+    def __init__(self, maxlen=1):
+        self._frames = deque(maxlen=maxlen)
+        self._ready = Condition()
+        self.dropped = 0
+
+    def put(self, frame):
+        with self._ready:
+            if len(self._frames) == self._frames.maxlen:
+                self.dropped += 1
+            self._frames.append(frame)
+            self._ready.notify()
+
+    def get(self, timeout=None):
+        """Returns the oldest frame waiting, or None after timeout seconds."""
+        with self._ready:
+            if not self._frames and not self._ready.wait(timeout):
+                return None
+            return self._frames.popleft() if self._frames else None
+
+
+class LiveView():
+    """
+    Fans JPEG frames out to any number of viewers, each with its own
+    bounded ClientQueue.
+
+    Arguments:
+        max_queued - frames queued per viewer before the oldest is dropped.
+            Default 1, for the lowest latency.
+        keepalive - seconds after which the last frame is sent again when
+            no new one came, so that idle streams stay open and viewers
+            which left are noticed.
+    """
+
+    def __init__(self, max_queued=1, keepalive=5.0):
+        self.max_queued = max_queued
+        self.keepalive = keepalive
+        self.latest = None
+        self._clients = set()
+        self._lock = Lock()
+        self._frames = 0
+        self._dropped = 0  # by viewers which have left
+
+    def publish(self, jpeg):
+        """Sends a JPEG frame to every viewer."""
+        with self._lock:
+            self.latest = jpeg
+            self._frames += 1
+            clients = list(self._clients)
+        for client in clients:
+            client.put(jpeg)
+
+    def subscribe(self):
+        """Returns a new viewer's ClientQueue, starting with the latest frame."""
+        client = ClientQueue(self.max_queued)
+        with self._lock:
+            if self.latest is not None:
+                client.put(self.latest)
+            self._clients.add(client)
+        return client
+
+    def unsubscribe(self, client):
+        with self._lock:
+            self._clients.discard(client)
+            self._dropped += client.dropped
+
+    def clear(self):
+        """Forgets the latest frame, e.g. when a new stream starts."""
+        with self._lock:
+            self.latest = None
+
+    def mjpeg(self):
+        """
+        Generator of a new viewer's multipart/x-mixed-replace body, one
+        part per frame, until the viewer goes away.
+        """
+        client = self.subscribe()
+        try:
+            while True:
+                jpeg = client.get(timeout=self.keepalive)
+                if jpeg is None:
+                    jpeg = self.latest
+                    if jpeg is None:
+                        continue
+                yield (f'--{BOUNDARY}\r\n'
+                       f'Content-Type: image/jpeg\r\n'
+                       f'Content-Length: {len(jpeg)}\r\n\r\n').encode() + jpeg + b'\r\n'
+        finally:
+            self.unsubscribe(client)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'viewers': len(self._clients),
+                'frames': self._frames,
+                'dropped': self._dropped + sum(client.dropped for client in self._clients),
+            }
+
+
+def add_live_view_routes(server, live_view, prefix='/live', uploaders=('127.0.0.1', '::1')):
+    """
+    Serves live_view from the Flask server under prefix: the MJPEG stream
+    at mjpeg, the latest frame at frame.jpg, viewer stats at stats, and
+    POST/PUT frame for the streamer to push frames, from the uploaders'
+    addresses only.
+    """
+    import flask
+
+    def push_frame():
+        if flask.request.remote_addr not in uploaders:
+            flask.abort(403)
+        live_view.publish(flask.request.get_data())
+        return '', 204
+
+    def latest_frame():
+        if live_view.latest is None:
+            flask.abort(404)
+        response = flask.Response(live_view.latest, mimetype='image/jpeg')
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    def mjpeg():
+        # only the werkzeug server says which socket the response goes to
+        sock = flask.request.environ.get('werkzeug.socket')
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+        response = flask.Response(live_view.mjpeg(),
+                                  mimetype=f'multipart/x-mixed-replace; boundary={BOUNDARY}')
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    server.add_url_rule(f'{prefix}/frame', endpoint='live_view_push', view_func=push_frame,
+                        methods=['POST', 'PUT'])
+    server.add_url_rule(f'{prefix}/frame.jpg', endpoint='live_view_frame', view_func=latest_frame)
+    server.add_url_rule(f'{prefix}/mjpeg', endpoint='live_view_mjpeg', view_func=mjpeg)
+    server.add_url_rule(f'{prefix}/stats', endpoint='live_view_stats',
+                        view_func=lambda: flask.jsonify(live_view.stats()))
+
+
+class LiveViewPusher():
+    """
+    Pushes frames to a LiveView over HTTP from a background thread, so the
+    caller never waits on JPEG encoding or the network. Only the latest
+    frame is kept: one which arrives before the previous was sent replaces
+    it (counted as dropped).
+
+    Arguments:
+        url - the live view's frame URL, e.g. http://127.0.0.1:8050/live/frame
+        pix_fmt - ffmpeg pixel format of the frames (a packed RGB format)
+        quality - JPEG quality, 1-95. Default 80.
+    """
+
+    def __init__(self, url, pix_fmt, quality=80, timeout=5.0):
+        try:
+            import PIL.Image
+        except ImportError:
+            raise Exception("PIL could not be imported!")
+        self.PILImage = PIL.Image
+        if pix_fmt not in _RAW_MODES:
+            raise Exception(f"Cannot JPEG encode {pix_fmt} frames.")
+        self._raw_mode = _RAW_MODES[pix_fmt]
+        self.quality = quality
+        self.timeout = timeout
+
+        parts = urlsplit(url)
+        self._netloc = parts.netloc
+        self._path = parts.path or '/'
+        self._https = parts.scheme == 'https'
+        self._conn = None
+
+        # frames are copied into the back buffer and sent from the front one
+        self._back = self._front = None
+        self._pending = False
+        self._closed = False
+        self._ready = Condition()
+        self.pushed = 0
+        self.dropped = 0
+        self.errors = 0
+        self._encode_time = 0.0
+        self._thread = Thread(target=self.__run, daemon=True)
+        self._thread.start()
+
+    def push(self, array_data):
+        """Queues a copy of a (h, w, bytes per pixel) frame to be sent."""
+        with self._ready:
+            if self._back is None or self._back.shape != array_data.shape:
+                self._back = np.empty_like(array_data)
+            if self._pending:
+                self.dropped += 1
+            np.copyto(self._back, array_data)
+            self._pending = True
+            self._ready.notify()
+
+    def __encode(self, frame):
+        h, w = frame.shape[:2]
+        image = self.PILImage.frombuffer('RGB', (w, h), frame, 'raw', self._raw_mode, 0, 1)
+        out = io.BytesIO()
+        image.save(out, format='JPEG', quality=self.quality)
+        return out.getvalue()
+
+    def __post(self, jpeg):
+        for attempt in range(2):
+            # retry once on a fresh connection if the kept-alive one went stale
+            if self._conn is None:
+                connection = http.client.HTTPSConnection if self._https else http.client.HTTPConnection
+                self._conn = connection(self._netloc, timeout=self.timeout)
+            try:
+                self._conn.request('POST', self._path, body=jpeg,
+                                   headers={'Content-Type': 'image/jpeg'})
+                self._conn.getresponse().read()
+                return
+            except (OSError, http.client.HTTPException):
+                self._conn.close()
+                self._conn = None
+                if attempt:
+                    raise
+
+    def __run(self):
+        while True:
+            with self._ready:
+                while not self._pending and not self._closed:
+                    self._ready.wait()
+                if self._closed:
+                    return
+                self._back, self._front = self._front, self._back
+                self._pending = False
+            started = time.monotonic()
+            jpeg = self.__encode(self._front)
+            self._encode_time += time.monotonic() - started
+            try:
+                self.__post(jpeg)
+                self.pushed += 1
+            except (OSError, http.client.HTTPException):
+                # the app is not up (yet): the next frame will try again
+                self.errors += 1
+
+    def close(self):
+        with self._ready:
+            self._closed = True
+            self._ready.notify()
+        self._thread.join(timeout=self.timeout)
+        if self._conn is not None:
+            self._conn.close()
+
+    def stats(self):
+        encoded = self.pushed + self.errors
+        return {
+            'pushed': self.pushed,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'encode_ms_mean': self._encode_time / encoded * 1000.0 if encoded else 0.0,
+        }
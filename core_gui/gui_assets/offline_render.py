@@ -0,0 +1,176 @@
+# Offline rendering to a video file, faster than real time: the frames are
+# split into chunks, rendered and encoded by worker processes in parallel,
+# and the chunks joined without re-encoding
+
+import multiprocessing
+import os
+import shutil
+import subprocess as sp
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from core_gui.gui_assets.encoder_backends import choose_backend, open_encoder
+from core_gui.gui_assets.encoder_profiles import get_profile
+
+
+def split_frames(frames, chunks):
+    """
+    Splits frames 0 to frames - 1 into at most chunks consecutive
+    [start, end) ranges of (nearly) the same length.
+    """
+    chunks = max(min(chunks, frames), 1)
+    bounds = [frames * i // chunks for i in range(chunks + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def encode_frames(render, start, end, output, w, h, fps, pix_fmt='bgr0',
+                  profile='record-fast', backend='auto'):
+    """
+    Encodes frames start to end - 1 to the video file output, with profile
+    and the encoder backend chosen by choose_backend(). render(n) returns
+    frame n, a (h, w, bytes per pixel) uint8 array in pix_fmt.
+    """
+    profile = get_profile(profile)
+    encoder = open_encoder(choose_backend(backend, profile), profile, w, h, fps, pix_fmt, output)
+    try:
+        for n in range(start, end):
+            encoder.write(render(n))
+    finally:
+        encoder.close()
+
+
+def concat_videos(paths, output, verbose=False):
+    """
+    Joins the video files in paths, in order, into output with ffmpeg's
+    concat demuxer, copying the packets as they are: nothing is decoded or
+    re-encoded. The files must have been encoded with the same settings.
+    """
+    directory = os.path.dirname(os.path.abspath(output))
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', dir=directory, delete=False) as f:
+        for path in paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+        listing = f.name
+    command = ['ffmpeg', '-y', '-loglevel', 'error',
+               '-f', 'concat', '-safe', '0', '-i', listing,
+               '-c', 'copy', '-movflags', '+faststart', output]
+    if verbose:
+        print(' '.join(command), flush=True)
+    try:
+        result = sp.run(command, stdout=sp.PIPE, stderr=sp.STDOUT)
+    finally:
+        os.remove(listing)
+    if result.returncode != 0:
+        raise Exception(f"Joining the chunks into {output} failed:\n"
+                        f"{result.stdout.decode('utf-8', 'replace')}")
+
+
+def render_parallel(render_chunk, frames, output, fps, workers=None, verbose=False):
+    """
+    Renders frames 0 to frames - 1 to the video file output in parallel.
+
+    The frames are split into one chunk per worker (see split_frames()),
+    and render_chunk(start, end, path) is called in a worker process for
+    each, to render and encode its frames to path (e.g. with
+    encode_frames()); the chunks are then joined by concat_videos().
+    Workers are forked, so render_chunk may be a closure over anything,
+    pygame Surfaces included: nothing is pickled. Where processes cannot
+    be forked, the chunks are rendered one after the other in this process.
+
+    Arguments:
+        render_chunk - renders frames [start, end) to the file path
+        frames - number of frames
+        output - the video file, its extension giving the chunks' format
+        fps - frame rate, for the stats
+        workers - number of worker processes; None for one per CPU
+    Returns stats: frames, chunks, workers, seconds taken, frames
+    rendered per second, and speed (seconds of video per second).
+    """
+    if frames < 1:
+        raise Exception("Nothing to render.")
+    workers = workers or os.cpu_count() or 1
+    chunks = split_frames(frames, workers)
+    forking = len(chunks) > 1 and 'fork' in multiprocessing.get_all_start_methods()
+
+    started = time.monotonic()
+    directory = tempfile.mkdtemp(prefix='render-', dir=os.path.dirname(os.path.abspath(output)))
+    try:
+        extension = os.path.splitext(output)[1] or '.mp4'
+        paths = [os.path.join(directory, f'chunk{i:04d}{extension}') for i in range(len(chunks))]
+        if forking:
+            context = multiprocessing.get_context('fork')
+            processes = [context.Process(target=render_chunk, args=(start, end, path))
+                         for (start, end), path in zip(chunks, paths)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            for (start, end), process in zip(chunks, processes):
+                if process.exitcode != 0:
+                    raise Exception(f"Rendering frames {start} to {end - 1} failed.")
+        else:
+            for (start, end), path in zip(chunks, paths):
+                render_chunk(start, end, path)
+
+        if len(paths) == 1:
+            shutil.move(paths[0], output)
+        else:
+            concat_videos(paths, output, verbose)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    elapsed = time.monotonic() - started
+    stats = {
+        'frames': frames,
+        'chunks': len(chunks),
+        'workers': len(chunks) if forking else 1,
+        'seconds': elapsed,
+        'fps': frames / elapsed,
+        'speed': frames / fps / elapsed,
+    }
+    if verbose:
+        print(f"Rendered {frames} frames to {output} in {elapsed:.1f} s with "
+              f"{stats['workers']} workers: {stats['fps']:.0f} fps, "
+              f"{stats['speed']:.1f}x real time", flush=True)
+    return stats
+
+
+def benchmark_workers(w=1280, h=800, fps=30, seconds=60, workers=None,
+                      output='/tmp/offline_render.mp4'):
+    """
+    Renders seconds of w x h video (a still map-like background with
+    moving markers) with the record-fast profile, with one worker and then
+    with workers (None: one per CPU), and prints how much faster than real
+    time each is. Needs ffmpeg with libx264.
+    """
+    ys, xs = np.mgrid[0:h, 0:w]
+    background = np.zeros((h, w, 4), dtype=np.uint8)
+    background[..., 0] = (xs * 255 // w).astype(np.uint8)
+    background[..., 1] = (ys * 255 // h).astype(np.uint8)
+    background[..., 2] = ((xs // 32 + ys // 32) % 2 * 60).astype(np.uint8)
+    frame = background.copy()
+
+    def render(n):
+        np.copyto(frame, background)
+        for k in range(20):
+            x = (n * 7 + k * 97) % (w - 16)
+            y = (k * 53) % (h - 16)
+            frame[y:y + 16, x:x + 16, :3] = 255
+        return frame
+
+    def render_chunk(start, end, path):
+        encode_frames(render, start, end, path, w, h, fps)
+
+    for count in sorted({1, workers or os.cpu_count() or 1}):
+        stats = render_parallel(render_chunk, int(seconds * fps), output, fps, workers=count)
+        print(f'{count:>3} workers: {stats["seconds"]:6.1f} s for {seconds} s of video, '
+              f'{stats["speed"]:5.1f}x real time, {stats["fps"]:6.0f} fps')
+    os.remove(output)
+
+
+# Run as python -m core_gui.gui_assets.offline_render [workers]
+if __name__ == '__main__':
+    benchmark_workers(workers=int(sys.argv[1]) if len(sys.argv) > 1 else None)
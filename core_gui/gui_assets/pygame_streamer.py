@@ -3,241 +3,856 @@
 # 20220802
 # Kentamt
 
+import os
 import sys
 import time
-from queue import Queue, Empty
-from threading import Thread
+import zlib
+from queue import Empty
 
-from multiprocessing import Process, Queue
+from multiprocessing import Event, Process, Queue
 import subprocess as sp
 import numpy as np
 import pygame
 
+from core_gui.gui_assets.encoder_backends import choose_backend, open_encoder
+from core_gui.gui_assets.encoder_profiles import PROFILES, get_profile
+from core_gui.gui_assets.frame_clock import FrameClock
+from core_gui.gui_assets.frame_ring import FrameRing
+from core_gui.gui_assets.live_view import LiveViewPusher
+from core_gui.gui_assets.stream_metrics import StreamMetrics
 
-ON_POSIX = 'posix' in sys.builtin_module_names
 
+# ffmpeg pixel formats of 32 bit pixels, named by their bytes in memory order
+_PIX_FMTS_32 = ('rgba', 'bgra', 'argb', 'abgr', 'rgb0', 'bgr0', '0rgb', '0bgr')
 
-def enqueue_output(out, queue):
-    for line in iter(out.readline, b''):
-        queue.put(line)
-    out.close()
+
+def surface_pix_fmt(surface):
+    """
+    Returns the ffmpeg pix_fmt describing the bytes of a pygame Surface's
+    pixels as they are in memory (e.g. 'bgr0' for a typical 32 bit display
+    surface), or None if ffmpeg has no matching rawvideo format.
+    """
+    bytesize = surface.get_bytesize()
+    if bytesize not in (3, 4):
+        return None
+
+    names = {}
+    for name, mask in zip('rgba', surface.get_masks()):
+        if not mask:
+            continue
+        shift = (mask & -mask).bit_length() - 1
+        if shift % 8 or mask >> shift != 0xFF:
+            return None
+        byte = shift // 8
+        if sys.byteorder == 'big':
+            byte = bytesize - 1 - byte
+        names[byte] = name
+
+    if bytesize == 3:
+        layout = ''.join(names.get(i, '?') for i in range(3))
+        return {'rgb': 'rgb24', 'bgr': 'bgr24'}.get(layout)
+    layout = ''.join(names.get(i, '0') for i in range(4))
+    return layout if layout in _PIX_FMTS_32 else None
+
+
+def pix_fmt_bytes(pix_fmt):
+    """Returns the number of bytes per pixel of a packed ffmpeg pix_fmt."""
+    if pix_fmt in ('rgb24', 'bgr24'):
+        return 3
+    if pix_fmt in _PIX_FMTS_32:
+        return 4
+    raise Exception(f"Unsupported pix_fmt {pix_fmt}, use a packed RGB format.")
+
+
+def create_surface(w, h, pix_fmt):
+    """
+    Returns a new w x h Surface whose pixels are laid out in memory as
+    the packed ffmpeg pix_fmt (the reverse of surface_pix_fmt()), so that
+    surface_to_native() copies them as they are. Needs no display.
+    """
+    bpp = pix_fmt_bytes(pix_fmt)
+    layout = pix_fmt[:3] if bpp == 3 else pix_fmt
+    masks = []
+    for name in 'rgba':
+        byte = layout.find(name)
+        if byte < 0:
+            masks.append(0)
+            continue
+        if sys.byteorder == 'big':
+            byte = bpp - 1 - byte
+        masks.append(0xFF << (8 * byte))
+    flags = pygame.SRCALPHA if masks[3] else 0
+    return pygame.Surface((w, h), flags, bpp * 8, masks)
+
+
+def surface_to_native(surface, out=None):
+    """
+    Copies a pygame Surface's pixels straight out of its buffer, in its
+    own pixel format (see surface_pix_fmt()), into a (height, width,
+    bytesize) uint8 array, which is out if given. This is the only copy
+    made: any swizzling is left to ffmpeg.
+    """
+    w, h = surface.get_size()
+    bpp = surface.get_bytesize()
+    if out is None:
+        out = np.empty((h, w, bpp), dtype=np.uint8)
+    buf = surface.get_buffer()
+    try:
+        rows = np.frombuffer(buf, dtype=np.uint8).reshape(h, surface.get_pitch())
+        # Drop any padding at the end of each row while copying
+        np.copyto(out.reshape(h, w * bpp), rows[:, :w * bpp])
+        del rows
+    finally:
+        del buf  # unlocks the surface
+    return out
+
+
+def surface_to_rgb24(surface, bgr=False):
+    """
+    Converts a pygame Surface to a (height, width, 3) uint8 array of
+    packed RGB (or BGR) pixels, whatever the Surface's own pixel format.
+    """
+    array_data: np.array = pygame.surfarray.array3d(surface)
+    array_data = array_data.astype(np.uint8)
+    array_data = array_data.swapaxes(0, 1)
+    if bgr:
+        array_data = array_data[..., [2, 1, 0]]  # RGB2BGR
+    return np.ascontiguousarray(array_data)
+
+
+def benchmark_capture(w=1280, h=800, frames=200):
+    """
+    Times frame capture from a w x h display-format surface, converting to
+    bgr24 (as pygame_to_image() always used to) against copying the native
+    buffer, and prints microseconds and megabytes copied per frame.
+    """
+    pygame.display.init()
+    try:
+        pygame.display.set_mode((1, 1))
+        surface = pygame.Surface((w, h)).convert()
+    except pygame.error:
+        # No display available: use the usual 32 bit display layout
+        surface = pygame.Surface((w, h), 0, 32)
+    surface.fill((30, 60, 90))
+
+    pix_fmt = surface_pix_fmt(surface)
+    bpp = surface.get_bytesize()
+    # bgr24 conversion copies the frame in array3d(), astype() and the
+    # fancy-indexed swizzle
+    cases = [
+        ('bgr24 conversion', lambda: surface_to_rgb24(surface, bgr=True), 3 * w * h * 3),
+        (f'native {pix_fmt}', lambda: surface_to_native(surface), w * h * bpp),
+    ]
+    for name, capture, copied in cases:
+        capture()
+        start = time.perf_counter()
+        for _ in range(frames):
+            capture()
+        elapsed = time.perf_counter() - start
+        print(f'{name:>20}: {elapsed / frames * 1e6:8.0f} us/frame, '
+              f'{copied / 1e6:6.1f} MB copied/frame')
 
 class PygameStreamer():
     def __init__(self, w, h, fps,
-                 bitrate='10000k',
-                 speed_option='ultrafast',
+                 bitrate=None,
+                 speed_option=None,
                  format='hls',
-                 chunk_time=1,
+                 chunk_time=None,
                  sdp_name='pygame_streamer.sdp',
                  output='./hls/live.m3u8',
+                 pix_fmt=None,
+                 ring_slots=3,
+                 queue_policy='latest',
+                 block_timeout=1.0,
+                 profile=None,
+                 skip_unchanged=False,
+                 backend='ffmpeg',
+                 metrics_path=None,
+                 live_view=None,
+                 live_view_quality=80,
                  verbose=False
                  ):
+        """
+        profile is the name of an EncoderProfile (see encoder_profiles.py)
+        or an EncoderProfile, e.g. 'hls-lowlatency'; by default the profile
+        named by format ('hls', 'dash' or 'rtp'). speed_option (the x264
+        preset) and chunk_time (seconds per segment), when given, override
+        the profile's. bitrate, when given, overrides the profile's too;
+        otherwise the profile's is used, or encoder_profiles.DEFAULT_BITRATE.
+        output is a file, or for hls and dash an http:// URL to upload the
+        playlists and segments to, e.g. the web app's SegmentStore.
+        skip_unchanged makes the stream variable frame rate: frames which
+        are the same as the previous one are neither handed over nor
+        encoded, except once per keyframe interval so that segments keep
+        coming. Frames are timestamped as they reach ffmpeg, so playback
+        timing stays right.
+        queue_policy says what happens to frames handed over faster than
+        they are encoded, in the ring_slots frames shared with the writing
+        subprocess (see frame_ring.py): 'latest' (the default) encodes the
+        latest frame and drops the rest, for live streams; 'drop-oldest'
+        encodes frames in order but drops the oldest when the ring is full;
+        'block' makes write_surface()/write_image() wait for a free slot,
+        for up to block_timeout seconds, so no frame is lost unless the
+        encoder stalls. Memory stays the same either way, and drops are
+        counted in the metrics and stats.
+        backend is 'ffmpeg' to encode with an ffmpeg subprocess fed through
+        a pipe, 'pyav' to encode in process with PyAV, or 'auto' for pyav
+        when it can; pyav falls back to ffmpeg when PyAV is not installed
+        or the profile needs the ffmpeg command line (see
+        encoder_backends.py).
+        Pipeline metrics (see stream_metrics.py) are recorded in
+        self.metrics; with metrics_path, the writing subprocess publishes
+        them there as JSON every second, e.g. for the Dash app to poll.
+        live_view is the URL of a LiveView (see live_view.py) to push each
+        new frame to as a JPEG of live_view_quality, alongside the encoded
+        stream, for a view without the stream's segment delay.
+        """
         
         self._verbose = verbose
         
         self._w = w
         self._h = h
         self._bitrate = bitrate
-        self._speed_option = speed_option
         self._fps = str(fps)
-        self._format = format
         self._output = None
         self._output = output
         
-        # speed parameter
-        self._k = 0.2
-        self._margin = 0.005
-        
-        # For hls options
-        self._chunk_time = str(chunk_time)
+        # ffmpeg settings
+        profile = get_profile(profile or format)
+        overrides = {}
+        if speed_option:
+            overrides['preset'] = speed_option
+        if chunk_time:
+            overrides['segment_time'] = chunk_time
+        self._profile = profile.with_options(**overrides) if overrides else profile
+        if output.startswith(('http://', 'https://')) and self._profile.format in ('hls', 'dash'):
+            self._profile = self._profile.for_upload()
+        self._format = self._profile.format
         
-        # For dash options
-        self._remove_at_exit = str(1)
+        # pixel format of the frames handed to the encoder, e.g. 'rgb24' for
+        # NumpyImageManager arrays. By default it is the native format of
+        # the display surface, so that pygame_to_image() copies its pixels
+        # as they are and ffmpeg does the conversion.
+        if pix_fmt is None:
+            screen = pygame.display.get_surface() if pygame.display.get_init() else None
+            pix_fmt = (screen and surface_pix_fmt(screen)) or 'bgr24'
+        self._pix_fmt = pix_fmt
         
         # For rtp options
         self._sdp_name = sdp_name
         
-        # subprocess for ffmpeg
-        self._sleep_sec = 1.0 / float(self._fps)
-        self._previous_data = None        
-        self._writing_process = None
+        # change detection
+        self._skip_unchanged = skip_unchanged
+        self._keyframe_interval = self._profile.gop or 1.0
+        self._last_hash = None
+        
+        # encoder, started in the writing subprocess
+        self._backend = choose_backend(backend, self._profile, verbose)
+        self._encoder = None
        
+        # frames are handed to the writing subprocess through shared memory
+        self.frames = FrameRing((h, w, pix_fmt_bytes(self._pix_fmt)), slots=ring_slots,
+                                policy=queue_policy, block_timeout=block_timeout)
+        
+        # metrics, recorded by both processes
+        self.metrics = StreamMetrics(slots=ring_slots)
+        self._metrics_path = metrics_path
+        
+        # JPEG frames for the live view, pushed from the writing subprocess
+        self._live_view = live_view
+        self._live_view_quality = live_view_quality
+        self._live_view_pusher = None
+
         # subprocess for writing 
-        self.image_queue = Queue()
-        self.stop_request = Queue()
-        self._running = True
-        self._finished = False
-        self._async_write_proc = Process(target=self.async_write, args=(self.image_queue, self.stop_request))
+        self.stop_request = Event()
+        self.stats_queue = Queue()
+        self._async_write_proc = Process(target=self.async_write, args=(self.frames, self.stop_request))
         self._async_write_proc.start()
 
     def terminate(self):
-        self.stop_request.put(True)
-        if self._finished:
-            if self._verbose:
-                print('terminate subprocesses')
-                
-            self._writing_process.stdin.close()
-            self._writing_process.kill()
+        """
+        Stops streaming: the writing subprocess ends the stream and ffmpeg
+        is given a few seconds to finish its output.
+        Returns the writer's pacing statistics (see async_write()), or
+        None if the writer did not stop cleanly.
+        """
+        if self._verbose:
+            print('terminate subprocesses')
+        self.stop_request.set()
+        
+        stats = None
+        try:
+            stats = self.stats_queue.get(timeout=10.0)
+        except Empty:
+            pass
+        self._async_write_proc.join(timeout=5.0)
+        if self._async_write_proc.is_alive():
             self._async_write_proc.terminate()
+        self.frames.close()
+        self.metrics.close()
+        return stats
   
-    def pygame_to_image(self, screen):
-        array_data: np.array = pygame.surfarray.array3d(screen)
-        array_data = array_data.astype(np.uint8)
-        array_data = array_data.swapaxes(0, 1)
-        array_data = array_data[..., [2, 1, 0]].copy()  # RGB2BGR
-        return array_data
+    def __unchanged(self, buffer, changed):
+        """
+        Whether a frame is the same as the previous one: changed=False
+        says so, changed=True says not, and with None (don't know) the
+        frames' hashes are compared when skip_unchanged is set.
+        buffer is a callable returning the frame's bytes, only called to
+        hash them.
+        """
+        if changed is not None or not self._skip_unchanged:
+            if changed:
+                self._last_hash = None
+            return changed is False
+        digest = zlib.crc32(buffer())
+        if digest == self._last_hash:
+            return True
+        self._last_hash = digest
+        return False
     
-    def __get_speed(self, line):
-        ratio = None
-        words = line.split(' ')
-        
-        for word in words:
-            elems = word.split('=')
-            if elems[0] == 'speed' and elems[1]  == 'N/A':
-                pass
-            elif elems[0] == 'speed' and elems[1] != '':
-                ratio = float(elems[1].split('x')[0])
-        return ratio
+    def write_surface(self, screen, changed=None):
+        """
+        Hands the current pixels of screen to the encoder, copying them
+        straight into a free frame slot when the screen's own pixel format
+        is the streamer's pix_fmt.
+        changed=False tells that the screen is the same as when last
+        handed over, so nothing needs doing (see __unchanged()). Only
+        waits with the 'block' queue_policy, while the ring is full.
+        Returns the sequence number of the latest frame.
+        """
+        # the buffer is released (and the surface unlocked) once hashed
+        if self.__unchanged(screen.get_buffer, changed):
+            return self.frames.seq
+        
+        started = time.monotonic()
+        if surface_pix_fmt(screen) == self._pix_fmt:
+            surface_to_native(screen, out=self.frames.begin_write())
+            seq = self.frames.end_write()
+        else:
+            seq = self.frames.write(self.pygame_to_image(screen))
+        self.metrics.observe('capture', time.monotonic() - started)
+        self.metrics.count('frames_captured')
+        return seq
     
-    def __adjust_speed(self):
+    def write_image(self, array_data, changed=None):
+        """
+        Hands a frame, a (h, w, bytes per pixel) uint8 array in the
+        streamer's pix_fmt, to the encoder. changed is as for
+        write_surface().
+        """
+        array_data = np.ascontiguousarray(array_data)
+        if self.__unchanged(lambda: array_data, changed):
+            return self.frames.seq
+        
+        started = time.monotonic()
+        seq = self.frames.write(array_data)
+        self.metrics.observe('capture', time.monotonic() - started)
+        self.metrics.count('frames_captured')
+        return seq
+  
+    def pygame_to_image(self, screen):
+        """
+        Returns the pixels of screen as an array in the streamer's pix_fmt.
+        When that is the screen's own format, the pixel buffer is copied
+        once as it is; otherwise the pixels are converted to bgr24/rgb24.
+        """
+        if surface_pix_fmt(screen) == self._pix_fmt:
+            return surface_to_native(screen)
+        if self._pix_fmt in ('bgr24', 'rgb24'):
+            return surface_to_rgb24(screen, bgr=self._pix_fmt == 'bgr24')
+        raise Exception(f"Cannot capture a surface as {self._pix_fmt}.")
+
+    def create_surface(self):
+        """
+        Returns a new offscreen Surface of the stream's size in its
+        pix_fmt, to render into without a display: write_surface() then
+        copies its pixels straight into the frame slots.
+        """
+        return create_surface(self._w, self._h, self._pix_fmt)
+
+    def async_write(self, frames: FrameRing, stop_request: Event):
         """
-        if the output of ffmpeg contains speed infomation,
-        adjust sleep time with the speed.
+        Feeds ffmpeg at exactly the configured fps, paced by a FrameClock.
+        Each time a frame is due the latest frame of the ring is written,
+        or, if the simulation has not produced a new one, the previous
+        frame again; with skip_unchanged, the previous frame is only written
+        again when a keyframe is due. Runs until stop_request is set, then
+        puts its statistics (frames written, new, repeated and skipped
+        frames, resyncs, jitter and the encoder's own stats) in
+        stats_queue.
+        Along the way it records the handoff, write and segment stages and
+        the frame counters in self.metrics, and publishes them to
+        metrics_path every second.
         """
+        self._encoder = open_encoder(self._backend, self._profile,
+                                     self._w, self._h, self._fps, self._pix_fmt,
+                                     self._output,
+                                     bitrate=self._bitrate,
+                                     sdp_name=self._sdp_name,
+                                     vfr=self._skip_unchanged,
+                                     verbose=self._verbose)
+        if self._live_view:
+            self._live_view_pusher = LiveViewPusher(self._live_view, self._pix_fmt,
+                                                    quality=self._live_view_quality)
+        
+        metrics = self.metrics
+        playlist = self._profile.playlist(self._h, self._output)
+        last_playlist = last_segment = None
+        
+        # wait for the simulation's first frame, rather than stream blanks
+        array_data = None
+        while array_data is None and not stop_request.is_set():
+            _, array_data = frames.wait_frame(timeout=0.1)
+        if array_data is not None:
+            self.__took_frame(frames, array_data)
+        
+        clock = FrameClock(float(self._fps))
+        clock.start()
+        new_frames = repeated = skipped = 0
+        fresh = True
+        last_report = last_write = last_publish = last_poll = time.monotonic()
+        
         try:
-            line = self._q.get_nowait()
-        except Empty:
-            # if there is no massage from ffmpeg, do nothing.
-            pass 
-        else:
-            line = line.decode("utf-8")
-            ratio = self.__get_speed(line)
+            while array_data is not None:
+                # sleep until the next frame is due, waking at once on stop
+                if stop_request.wait(clock.time_to_next()):
+                    break
             
-            if ratio is not None:
-                
-                if self._verbose:
-                    print(ratio,  flush=True)
-                    
-                if ratio < 1.0 + self._margin:
-                    self._sleep_sec *= 1.0 - (1.0 - ratio) * self._k
-                elif 1.0 - self._margin < ratio:
-                    self._sleep_sec *= 1.0 + (ratio - 1.0) * self._k
-                    
-                    
-    def __set_previous_data(self, array_data):
-        self._previous_data = array_data # TODO: check if deepcopy is needed
-        
-        
-    def __remove_data(self):
-        while not self.image_queue.empty():
-            self.image_queue.get()
+                # the latest frame, skipping any the simulation wrote meanwhile;
+                # it stays intact in its slot until the next one is taken
+                _, latest = frames.wait_frame(timeout=0)
+                if latest is not None:
+                    array_data = latest
+                    fresh = True
+                    self.__took_frame(frames, array_data)
             
+                # more than one frame is due when writing fell behind
+                due = clock.due()
+                if due and self._skip_unchanged:
+                    # frames carry their own timestamps, so one will do;
+                    # and none while nothing changed, until a keyframe is due
+                    if fresh or time.monotonic() - last_write >= self._keyframe_interval:
+                        skipped += due - 1
+                        metrics.count('frames_skipped', due - 1)
+                        due = 1
+                    else:
+                        skipped += due
+                        metrics.count('frames_skipped', due)
+                        due = 0
+                for _ in range(due):
+                    started = time.monotonic()
+                    self._encoder.write(array_data)
+                    last_write = time.monotonic()
+                    metrics.observe('write', last_write - started)
+                    if fresh:
+                        new_frames += 1
+                        metrics.count('frames_new')
+                        fresh = False
+                    else:
+                        repeated += 1
+                        metrics.count('frames_repeated')
+                
+                now = time.monotonic()
+                if playlist and now - last_poll >= 0.1:
+                    # a segment was published when its playlist was rewritten
+                    last_poll = now
+                    try:
+                        modified = os.stat(playlist).st_mtime_ns
+                    except OSError:
+                        modified = None
+                    if modified is not None and modified != last_playlist:
+                        last_playlist = modified
+                        metrics.count('segments')
+                        if last_segment is not None:
+                            metrics.observe('segment', now - last_segment)
+                        last_segment = now
+                if self._metrics_path and now - last_publish >= 1.0:
+                    last_publish = now
+                    self.__publish_metrics(clock)
             
-    def async_write(self, image_queue: Queue, stop_request :Queue):
+                if self._verbose and time.monotonic() - last_report >= 5.0:
+                    last_report = time.monotonic()
+                    print(self.__writer_stats(clock, new_frames, repeated, skipped), flush=True)
         
-        self.__init_process()
+        except BrokenPipeError:
+            print('ffmpeg exited, stopped streaming', flush=True)
         
-        while self._running:
-            
-            if not stop_request.empty():
-                self._running = False
-            
-            if not image_queue.empty():
-                array_data = image_queue.get()
-                
-                self._writing_process.stdin.write(array_data.tobytes())
-                self.__adjust_speed()
-                self.__set_previous_data(array_data)
-                self.__remove_data()
-                    
+        self._encoder.close()
+        if self._live_view_pusher:
+            self._live_view_pusher.close()
+        if self._metrics_path:
+            self.__publish_metrics(clock)
+        self.stats_queue.put(self.__writer_stats(clock, new_frames, repeated, skipped))
+        
+    def __took_frame(self, frames, array_data):
+        """
+        Records the handoff of the frame just taken from the ring, and the
+        ring's drops and depth, and passes the frame on to the live view.
+        """
+        if self._live_view_pusher:
+            self._live_view_pusher.push(array_data)
+        metrics = self.metrics
+        depth = frames.pending + 1  # including the frame taken
+        metrics.observe('handoff', time.monotonic() - frames.frame_time)
+        metrics.count('frames_taken')
+        metrics.set('frames_dropped', frames.dropped)
+        metrics.set('queue_depth', depth)
+        metrics.set('queue_depth_max', max(depth, metrics.get('queue_depth_max')))
+    
+    def __publish_metrics(self, clock):
+        encoder = self._encoder.stats()
+        self.metrics.set('encoder_speed', encoder['encoder_speed'] or 0)
+        try:
+            extra = {'clock': clock.stats(), 'encoder': encoder}
+            if self._live_view_pusher:
+                extra['live_view'] = self._live_view_pusher.stats()
+            self.metrics.publish(self._metrics_path, **extra)
+        except OSError as e:
+            if self._verbose:
+                print(f'Could not publish metrics: {e}', flush=True)
+    
+    def __writer_stats(self, clock, new_frames, repeated, skipped):
+        stats = clock.stats()
+        stats.update(
+            new_frames=new_frames,
+            repeated_frames=repeated,
+            skipped_frames=skipped,
+            dropped_frames=self.frames.dropped,
+        )
+        stats.update(self._encoder.stats())
+        if self._live_view_pusher:
+            stats['live_view'] = self._live_view_pusher.stats()
+        return stats
+        
+
+def _queue_reader(queue, latencies, frames):
+    for _ in range(frames):
+        array_data = queue.get()
+        latencies.put(time.perf_counter() - array_data.reshape(-1)[:8].view(np.float64)[0])
+
+
+def _ring_reader(ring, latencies, frames):
+    seq = 0
+    while seq < frames:
+        seq, array_data = ring.wait_frame()
+        latencies.put(time.perf_counter() - array_data.reshape(-1)[:8].view(np.float64)[0])
+    latencies.put(None)
+
+
+def benchmark_handoff(w=1280, h=800, frames=200, fps=30):
+    """
+    Hands frames of w x h bgr0 pixels to another process at fps through a
+    multiprocessing Queue (as async_write used to get them) and through a
+    FrameRing, and prints the writing process's CPU time per frame (queue
+    pickling happens in a background thread) and the latency until the
+    reader has the frame.
+    """
+    frame = np.zeros((h, w, 4), dtype=np.uint8)
+    stamp = frame.reshape(-1)[:8].view(np.float64)
+    for name in ('queue', 'ring'):
+        latencies = Queue()
+        if name == 'queue':
+            queue = Queue()
+            reader = Process(target=_queue_reader, args=(queue, latencies, frames))
+        else:
+            ring = FrameRing(frame.shape)
+            reader = Process(target=_ring_reader, args=(ring, latencies, frames))
+        reader.start()
+
+        start = time.process_time()
+        for _ in range(frames):
+            stamp[0] = time.perf_counter()
+            if name == 'queue':
+                queue.put(frame)
             else:
-                if self._previous_data is not None:
-                    self._writing_process.stdin.write(self._previous_data.tobytes())
-                    self.__adjust_speed()
-                    
-            time.sleep(self._sleep_sec)
-            
+                ring.write(frame)
+            time.sleep(1.0 / fps)
+
+        received = []
+        while True:
+            try:
+                latency = latencies.get(timeout=2.0)
+            except Empty:
+                break
+            if latency is None:
+                break
+            received.append(latency)
+        reader.join()
+        cpu = time.process_time() - start
+        if name == 'ring':
+            ring.close()
+        received.sort()
+        median = received[len(received) // 2] if received else float('nan')
+        print(f'{name:>6}: {cpu / frames * 1e6:8.0f} us writer CPU/frame, '
+              f'{median * 1e6:8.0f} us median latency, {len(received)} frames received')
+
 
-        self._finished = True
-        
-    def __init_process(self):
-        if self._format == 'hls':
-            command = ['ffmpeg',
-                       # ----------- input --------------------
-                       '-y',
-                       '-f', 'rawvideo',
-                       '-vcodec', 'rawvideo',
-                       '-pix_fmt', 'bgr24',
-                       '-s', f'{self._w}x{self._h}',
-                       '-r', self._fps,
-                       '-i', '-',  # input from stdin
-                       # ----------- output --------------------
-                       '-c:v', 'libx264',
-                       '-pix_fmt', "yuv420p",
-                       '-preset', self._speed_option,
-                       '-b:v', self._bitrate,
-                       '-hls_time', self._chunk_time,
-                       '-hls_flags', "delete_segments",
-                       '-force_key_frames', "expr:gte(t,n_forced*1)",
-                       '-f', self._format,
-                       self._output]
-
-        elif self._format == 'dash':
-            # self._output = '/dev/shm/dash/live.mpd'
-            command = ['ffmpeg',
-                       # ----------- input --------------------
-                       '-y',
-                       '-f', 'rawvideo',
-                       '-vcodec', 'rawvideo',
-                       '-pix_fmt', 'bgr24',
-                       '-s', f'{self._w}x{self._h}',
-                       '-r', self._fps,
-                       '-i', '-',  # input from stdin
-                       # ----------- output --------------------
-                       '-c:v', 'libx264',
-                       '-pix_fmt', "yuv420p",
-                       '-preset', self._speed_option,
-                       '-b:v', self._bitrate,
-                       '-force_key_frames', "expr:gte(t,n_forced*1)",
-                       '-seg_duration', self._chunk_time,
-                       '-use_timeline', '1',
-                       '-use_template', '1',
-                       '-remove_at_exit', self._remove_at_exit,
-                       '-f', self._format,
-                       self._output]
-
-        elif self._format == 'rtp':
-            # self._output = f'rtp://239.0.0.1:50004' # multicast
-            command = ['ffmpeg',
-                       # ----------- input --------------------
-                       '-y',
-                       '-f', 'rawvideo',
-                       '-vcodec', 'rawvideo',
-                       '-pix_fmt', 'bgr24',
-                       '-s', f'{self._w}x{self._h}',
-                       '-r', self._fps,
-                       '-i', '-',  # input from stdin
-                       # ----------- output --------------------
-                       '-c:v', 'libx264',
-                       '-pix_fmt', "yuv420p",
-                       '-preset', self._speed_option,
-                       '-b:v', self._bitrate,
-                       '-sdp_file', self._sdp_name,
-                       '-f', self._format,
-                       self._output]
+def _slow_reader(ring, fps, seconds, stall, taken):
+    """Takes a frame at fps for seconds, stopping for stall seconds halfway."""
+    count = 0
+    start = time.monotonic()
+    stalled = False
+    while time.monotonic() - start < seconds:
+        if not stalled and time.monotonic() - start >= seconds / 2:
+            stalled = True
+            time.sleep(stall)
+        if ring.wait_frame(timeout=1.0 / fps)[1] is not None:
+            count += 1
+        time.sleep(1.0 / fps)
+    taken.put(count)
+
+
+def benchmark_policies(w=1280, h=800, fps=60, encoder_fps=10, seconds=6, stall=2.0):
+    """
+    Hands w x h bgr0 frames over at fps to a reader taking only
+    encoder_fps, which also stalls for stall seconds halfway, with each
+    FrameRing policy. Prints how long the producer's writes took, the
+    frames taken and dropped, and the ring's memory, which is all the
+    frames in flight ever use.
+    """
+    frame = np.zeros((h, w, 4), dtype=np.uint8)
+    for policy in ('latest', 'drop-oldest', 'block'):
+        ring = FrameRing(frame.shape, policy=policy, block_timeout=0.5)
+        taken = Queue()
+        reader = Process(target=_slow_reader, args=(ring, encoder_fps, seconds, stall, taken))
+        reader.start()
+        
+        writes = []
+        written = 0
+        start = time.monotonic()
+        while time.monotonic() - start < seconds:
+            began = time.perf_counter()
+            ring.write(frame)
+            writes.append(time.perf_counter() - began)
+            written += 1
+            time.sleep(max(1.0 / fps - writes[-1], 0))
+        
+        count = taken.get()
+        reader.join()
+        writes = np.array(writes) * 1000.0
+        print(f'{policy:>12}: write p50 {np.median(writes):7.2f} ms, max {writes.max():7.1f} ms; '
+              f'{written} frames written, {count} taken, {ring.dropped} dropped; '
+              f'{ring.slots * ring.frame_bytes / 1e6:.1f} MB in the ring')
+        ring.close()
+
+
+def _playlist_segments(playlist):
+    """Returns [(uri, duration)] of the media segments in an HLS playlist."""
+    segments = []
+    duration = None
+    try:
+        with open(playlist) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return segments
+    for line in lines:
+        if line.startswith('#EXTINF:'):
+            duration = float(line[len('#EXTINF:'):].split(',')[0])
+        elif line and not line.startswith('#') and duration is not None:
+            segments.append((line, duration))
+            duration = None
+    return segments
+
+
+def benchmark_latency(profiles=('hls', 'hls-lowlatency', 'hls-quality'),
+                      w=1280, h=800, fps=10, seconds=20, directory='/tmp/pygame_streamer_latency'):
+    """
+    Streams w x h frames at fps for seconds with each HLS profile and
+    prints the capture-to-playlist delay: how long after a frame is handed
+    to the streamer the playlist lists a segment containing it, for the
+    first frame of each segment (which waits longest) and the last. Needs
+    ffmpeg with libx264.
+    """
+    import shutil
+    
+    frame = np.zeros((h, w, 4), dtype=np.uint8)
+    for name in profiles:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        playlist = os.path.join(directory, 'live.m3u8')
+        streamer = PygameStreamer(w, h, fps, output=playlist, pix_fmt='bgr0', profile=name)
+        
+        # frame n is captured at start + n / fps; the streamer's clock
+        # starts on the first frame
+        start = time.monotonic()
+        next_frame = 0
+        seen = set()
+        published = 0.0
+        first_delays = []
+        last_delays = []
+        while time.monotonic() - start < seconds:
+            now = time.monotonic()
+            if now >= start + next_frame / fps:
+                frame[..., :3] = next_frame % 256  # a new picture every frame
+                streamer.write_image(frame)
+                next_frame += 1
+            for uri, duration in _playlist_segments(playlist):
+                if uri not in seen:
+                    seen.add(uri)
+                    # the segment's frames were captured from start + published
+                    first_delays.append(now - (start + published))
+                    published += duration
+                    last_delays.append(now - (start + published))
+            time.sleep(0.005)
+        streamer.terminate()
+        
+        # the first segment includes start up
+        first_delays, last_delays = first_delays[1:], last_delays[1:]
+        if first_delays:
+            print(f'{name:>16}: first frame {np.median(first_delays):5.2f} s, '
+                  f'last frame {np.median(last_delays):5.2f} s median '
+                  f'capture-to-playlist delay over {len(first_delays)} segments '
+                  f'({PROFILES[name].description})')
         else:
-            raise Exception("Sorry, unknown format. Use hls, dash or rtp.")
+            print(f'{name:>16}: no segments published')
+
+
+def benchmark_encoder_cpu(profiles=('hls-lowlatency', 'hls-lowlatency-abr'),
+                          w=1280, h=800, fps=10, seconds=20, budget=1.0,
+                          directory='/tmp/pygame_streamer_cpu'):
+    """
+    Encodes seconds of w x h frames (a still map-like background with
+    moving markers) with each profile, as fast as ffmpeg can, and prints
+    the CPU it takes per second of stream, in cores, against budget.
+    Needs ffmpeg with libx264.
+    """
+    import shutil
+    
+    ys, xs = np.mgrid[0:h, 0:w]
+    background = np.zeros((h, w, 4), dtype=np.uint8)
+    background[..., 0] = (xs * 255 // w).astype(np.uint8)
+    background[..., 1] = (ys * 255 // h).astype(np.uint8)
+    background[..., 2] = ((xs // 32 + ys // 32) % 2 * 60).astype(np.uint8)
+    
+    for name in profiles:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        command = get_profile(name).command(w, h, fps, 'bgr0', os.path.join(directory, 'live.m3u8'))
+        process = sp.Popen(command, stdin=sp.PIPE, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+        frame = background.copy()
+        for n in range(int(seconds * fps)):
+            np.copyto(frame, background)
+            for k in range(20):
+                x = (n * 7 + k * 97) % (w - 16)
+                y = (k * 53) % (h - 16)
+                frame[y:y + 16, x:x + 16, :3] = 255
+            process.stdin.write(memoryview(frame))
+        process.stdin.close()
+        _, _, usage = os.wait4(process.pid, 0)
+        process.returncode = 0
         
-        self._writing_process = sp.Popen(command,
-                                         stdin=sp.PIPE,
-                                         stderr=sp.STDOUT,
-                                         stdout=sp.PIPE,
-                                         close_fds=ON_POSIX)
+        cores = (usage.ru_utime + usage.ru_stime) / seconds
+        verdict = 'within' if cores <= budget else 'OVER'
+        print(f'{name:>20}: {cores:5.2f} cores for real time streaming, '
+              f'{verdict} the budget of {budget:.2f}')
+
+
+def benchmark_headless(w=1280, h=800, sprites=50, frames=300, pix_fmt='bgr0'):
+    """
+    Renders frames like Simulation.run_with_web() does, as fast as it
+    goes: a map background and sprites blitted, then captured for the
+    streamer. The windowed path draws to the display, polls events and
+    flips it; the headless path draws to an offscreen surface in pix_fmt.
+    Prints frames per second of each.
+    """
+    pygame.init()
+    ys, xs = np.mgrid[0:h, 0:w]
+    pixels = np.zeros((h, w, 3), dtype=np.uint8)
+    pixels[..., 0] = (xs * 255 // w).astype(np.uint8)
+    pixels[..., 1] = (ys * 255 // h).astype(np.uint8)
+    background = pygame.image.frombuffer(pixels.tobytes(), (w, h), 'RGB')
+    sprite = pygame.Surface((32, 32), pygame.SRCALPHA, 32)
+    pygame.draw.circle(sprite, (200, 40, 40, 255), (16, 16), 14)
+
+    def render(screen, n):
+        screen.blit(background, (0, 0))
+        for k in range(sprites):
+            screen.blit(sprite, ((n * 7 + k * 97) % (w - 32), (k * 53) % (h - 32)))
+
+    def windowed():
+        screen = pygame.display.set_mode((w, h))
+        out = np.empty((h, w, screen.get_bytesize()), dtype=np.uint8)
+        native = surface_pix_fmt(screen) is not None
+        for n in range(frames):
+            pygame.event.get()
+            pygame.mouse.get_pos()
+            render(screen, n)
+            pygame.display.flip()
+            if native:
+                surface_to_native(screen, out=out)
+            else:
+                surface_to_rgb24(screen)
+        return f'{pygame.display.get_driver()} display, {surface_pix_fmt(screen)}'
+
+    def headless():
+        screen = create_surface(w, h, pix_fmt)
+        out = np.empty((h, w, pix_fmt_bytes(pix_fmt)), dtype=np.uint8)
+        for n in range(frames):
+            render(screen, n)
+            surface_to_native(screen, out=out)
+        return f'offscreen surface, {pix_fmt}'
+
+    for name, path in (('windowed', windowed), ('headless', headless)):
+        start = time.perf_counter()
+        try:
+            detail = path()
+        except pygame.error as e:
+            print(f'{name:>10}: {e}')
+            continue
+        finally:
+            if name == 'windowed':
+                pygame.display.quit()
+        elapsed = time.perf_counter() - start
+        print(f'{name:>10}: {frames / elapsed:7.1f} fps, {elapsed / frames * 1e3:6.2f} ms/frame ({detail})')
+
+
+def benchmark_backends(profile='hls-lowlatency', w=1280, h=800, fps=30, frames=300,
+                       directory='/tmp/pygame_streamer_backends'):
+    """
+    Encodes that many w x h bgr0 frames with profile through each encoder
+    backend, as fast as it goes, and prints the CPU time (of this process
+    and of ffmpeg) and wall time per frame. Needs ffmpeg with libx264, and
+    PyAV for the pyav backend.
+    """
+    import shutil
+    from core_gui.gui_assets.encoder_backends import av
+    
+    frame = np.zeros((h, w, 4), dtype=np.uint8)
+    for backend in ('ffmpeg', 'pyav'):
+        if backend == 'pyav' and av is None:
+            print(f'{backend:>8}: PyAV is not installed')
+            continue
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
         
-        # Use a thread to parse ffmpeg output without blocking
-        self._q = Queue()
-        t = Thread(target=enqueue_output,
-                   args=(self._writing_process.stdout, self._q))
-        t.daemon = True # thread dies at the end of the program
-        t.start()
+        start, wall = os.times(), time.perf_counter()
+        encoder = open_encoder(backend, get_profile(profile), w, h, fps, 'bgr0',
+                               os.path.join(directory, 'live.m3u8'))
+        for n in range(frames):
+            frame[..., :3] = n % 256
+            encoder.write(frame)
+        encoder.close()
+        end, wall = os.times(), time.perf_counter() - wall
         
+        cpu = sum(end[:4]) - sum(start[:4])  # user and system, with children
+        print(f'{backend:>8}: {cpu / frames * 1e3:6.2f} ms CPU/frame, '
+              f'{wall / frames * 1e3:6.2f} ms/frame, stats {encoder.stats()}')
+
+
+# Run as python -m core_gui.gui_assets.pygame_streamer [capture|handoff|policies|latency|cpu|backends|headless]
+if __name__ == '__main__':
+    benchmarks = sys.argv[1:] or ['capture', 'handoff']
+    if 'capture' in benchmarks:
+        benchmark_capture()
+    if 'handoff' in benchmarks:
+        benchmark_handoff()
+    if 'policies' in benchmarks:
+        benchmark_policies()
+    if 'latency' in benchmarks:
+        benchmark_latency()
+    if 'cpu' in benchmarks:
+        benchmark_encoder_cpu()
+    if 'backends' in benchmarks:
+        benchmark_backends()
+    if 'headless' in benchmarks:
+        benchmark_headless()
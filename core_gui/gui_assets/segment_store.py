@@ -0,0 +1,194 @@
+# In-memory store of a live stream's playlists and segments, which the
+# encoder uploads over HTTP (ffmpeg's -method PUT) and the web app serves
+
+import hashlib
+import posixpath
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from core_gui.gui_assets.stream_metrics import new_histogram, observe, stage_snapshot
+
+CONTENT_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.mpd': 'application/dash+xml',
+    '.ts': 'video/mp2t',
+    '.m4s': 'video/iso.segment',
+    '.mp4': 'video/mp4',
+    '.m4v': 'video/mp4',
+}
+
+# Playlists change with every segment and init segments with every stream,
+# so players must revalidate them; media segments do not change once written
+PLAYLIST_EXTS = ('.m3u8', '.mpd')
+SEGMENT_EXTS = ('.ts', '.m4s')
+
+
+class StoredFile():
+    """One complete file of the store: its bytes, ETag and headers."""
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+        self.etag = hashlib.blake2b(data, digest_size=8).hexdigest()
+        self.modified = time.time()
+        ext = posixpath.splitext(name)[1].lower()
+        self.content_type = CONTENT_TYPES.get(ext, 'application/octet-stream')
+        self.is_playlist = ext in PLAYLIST_EXTS
+        self.is_segment = ext in SEGMENT_EXTS
+
+
+class SegmentStore():
+    """
+    Thread-safe map from file name to the latest complete upload of it.
+
+    A file only replaces the previous version once it has been received
+    in full, so readers get either the old or the new playlist, never half
+    of one; and every reader of a version shares the same bytes, so any
+    number of viewers fan out from one encode without touching the disk.
+
+    The encoder deletes segments as they leave the playlist; in case it
+    does not (e.g. DASH keeps them all), the oldest segments are evicted
+    once the store holds more than max_bytes.
+
+    A segment is published when its media playlist is rewritten, so each
+    new version of one counts as a segment arriving; stats() reports the
+    count and the time between arrivals, like the streamer's 'segments'
+    counter and 'segment' stage, which cannot see uploaded playlists.
+
+    Arguments:
+        max_bytes - memory the stored files may use. Default 256 MB.
+        segment_max_age - seconds clients may cache media segments for.
+            Segment names can repeat from one stream to the next, so this
+            is kept short. Default 30.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, segment_max_age=30):
+        self.max_bytes = max_bytes
+        self.segment_max_age = segment_max_age
+        self._files = OrderedDict()
+        self._bytes = 0
+        # media playlist name -> [segments arrived, last arrival, histogram]
+        self._arrivals = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def normalize(name):
+        """Returns name as a relative path, or raises if it escapes the store."""
+        name = posixpath.normpath(name.lstrip('/'))
+        if name.startswith('..') or name == '.':
+            raise Exception(f"Invalid stream file name {name}.")
+        return name
+
+    def put(self, name, data):
+        """Stores data as name, replacing any previous version at once."""
+        stored = StoredFile(self.normalize(name), bytes(data))
+        with self._lock:
+            old = self._files.pop(stored.name, None)
+            if old is not None:
+                self._bytes -= len(old.data)
+            self._files[stored.name] = stored
+            self._bytes += len(stored.data)
+            if self.__is_media_playlist(stored) and (old is None or old.etag != stored.etag):
+                self.__arrived(stored)
+            self.__evict()
+        return stored
+
+    @staticmethod
+    def __is_media_playlist(stored):
+        # an HLS master playlist only lists other playlists, no segments
+        return stored.name.endswith('.mpd') or (stored.is_playlist and b'#EXTINF' in stored.data)
+
+    def __arrived(self, stored):
+        arrivals = self._arrivals.setdefault(stored.name, [0, None, new_histogram()])
+        arrivals[0] += 1
+        if arrivals[1] is not None:
+            observe(arrivals[2], stored.modified - arrivals[1])
+        arrivals[1] = stored.modified
+
+    def __evict(self):
+        # oldest first; playlists and init segments are always kept
+        for name in list(self._files):
+            if self._bytes <= self.max_bytes:
+                return
+            stored = self._files[name]
+            if stored.is_segment:
+                del self._files[name]
+                self._bytes -= len(stored.data)
+
+    def get(self, name):
+        """Returns the StoredFile of name, or None."""
+        with self._lock:
+            return self._files.get(self.normalize(name))
+
+    def delete(self, name):
+        """Removes name; returns whether it was there."""
+        with self._lock:
+            stored = self._files.pop(self.normalize(name), None)
+            if stored is not None:
+                self._bytes -= len(stored.data)
+            return stored is not None
+
+    def clear(self):
+        """Removes everything, e.g. when a new stream starts."""
+        with self._lock:
+            self._files.clear()
+            self._bytes = 0
+            self._arrivals.clear()
+
+    def cache_control(self, stored):
+        """The Cache-Control header for serving stored."""
+        if stored.is_segment:
+            return f'public, max-age={self.segment_max_age}'
+        return 'no-cache'
+
+    def stats(self):
+        """
+        Returns files and bytes stored, and the segments which arrived in
+        the first media playlist uploaded (with renditions, the first
+        rendition's): segments, their count, and segment, the time between
+        them as a stream_metrics stage.
+        """
+        with self._lock:
+            count, _, hist = next(iter(self._arrivals.values()), (0, None, new_histogram()))
+            return {'files': len(self._files), 'bytes': self._bytes,
+                    'segments': count, 'segment': stage_snapshot(hist)}
+
+
+def add_segment_routes(server, store, prefix='/hls', uploaders=('127.0.0.1', '::1')):
+    """
+    Serves store from the Flask server under prefix: GET (and HEAD) with
+    ETags, Last-Modified and byte ranges, and PUT/POST and DELETE for the
+    encoder to upload and remove files, from the uploaders' addresses only.
+    """
+    import flask
+
+    def stream_file(name):
+        request = flask.request
+        try:
+            name = store.normalize(name)
+        except Exception:
+            flask.abort(404)
+
+        if request.method in ('PUT', 'POST', 'DELETE'):
+            if request.remote_addr not in uploaders:
+                flask.abort(403)
+            if request.method == 'DELETE':
+                store.delete(name)
+            else:
+                store.put(name, request.get_data())
+            return '', 204
+
+        stored = store.get(name)
+        if stored is None:
+            flask.abort(404)
+        response = flask.Response(stored.data, mimetype=stored.content_type)
+        response.set_etag(stored.etag)
+        response.last_modified = stored.modified
+        response.headers['Cache-Control'] = store.cache_control(stored)
+        # answers If-None-Match / If-Modified-Since with 304, and Range with 206
+        return response.make_conditional(request, accept_ranges=True,
+                                         complete_length=len(stored.data))
+
+    server.add_url_rule(f'{prefix}/<path:name>', endpoint='segment_store', view_func=stream_file,
+                        methods=['GET', 'PUT', 'POST', 'DELETE'])
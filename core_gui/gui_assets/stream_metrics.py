@@ -0,0 +1,193 @@
+# Metrics of the streaming pipeline, shared between the simulation process
+# and the encoder's writing process, and published as a JSON snapshot
+
+import json
+import os
+import time
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+# Pipeline stages timed, in the order a frame goes through them
+STAGES = (
+    'render',   # drawing the frame (Simulation.run_with_web)
+    'capture',  # copying the surface's pixels into a frame slot
+    'handoff',  # from the frame's commit until the writer takes it
+    'write',    # handing the frame to the encoder (pipe write or encode)
+    'segment',  # between segments being published
+)
+
+# Upper bounds of the histogram buckets, in milliseconds; the last is +Inf
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, np.inf)
+
+# Counters and gauges, after the histograms
+COUNTERS = (
+    'frames_captured',   # frames handed to the streamer
+    'frames_taken',      # frames the writer took from the ring
+    'frames_dropped',    # frames the writer never took (FrameRing.dropped)
+    'frames_new',        # frames written to the encoder for the first time
+    'frames_repeated',   # frames written again, to keep the frame rate
+    'frames_skipped',    # frames not written as nothing changed
+    'segments',          # segments published
+    'queue_depth',       # frames waiting when the writer last took one
+    'queue_depth_max',
+    'encoder_speed',     # as last reported by the encoder, 0 if unknown
+    'started',           # time.time() the metrics were created
+)
+
+_HIST_LEN = len(BUCKETS_MS) + 2  # bucket counts, then sum and max in seconds
+
+
+def new_histogram():
+    """An empty latency histogram, for observe() and stage_snapshot()."""
+    return np.zeros(_HIST_LEN, dtype=np.float64)
+
+
+def observe(hist, seconds):
+    """Records seconds into the latency histogram hist."""
+    hist[np.searchsorted(BUCKETS_MS, seconds * 1000.0)] += 1
+    hist[-2] += seconds
+    hist[-1] = max(hist[-1], seconds)
+
+
+def stage_snapshot(hist):
+    """
+    Returns the latency histogram hist as a dict: count, mean/p50/p95/p99/max
+    in milliseconds, and cumulative bucket counts by upper bound.
+    """
+    counts = hist[:len(BUCKETS_MS)]
+    total = counts.sum()
+    stage = {
+        'count': int(total),
+        'mean_ms': float(hist[-2] / total * 1000.0) if total else 0.0,
+        'max_ms': float(hist[-1] * 1000.0),
+    }
+    # percentiles interpolated within their bucket, like Prometheus'
+    # histogram_quantile(); capped at the largest value seen
+    cumulative = np.cumsum(counts)
+    for q in (50, 95, 99):
+        if not total:
+            stage[f'p{q}_ms'] = 0.0
+            continue
+        rank = total * q / 100.0
+        i = int(np.searchsorted(cumulative, rank))
+        lower = BUCKETS_MS[i - 1] if i else 0.0
+        upper = min(BUCKETS_MS[i], stage['max_ms'])
+        below = cumulative[i - 1] if i else 0.0
+        fraction = (rank - below) / counts[i] if counts[i] else 1.0
+        stage[f'p{q}_ms'] = float(max(lower + (upper - lower) * fraction, 0.0))
+    stage['buckets'] = {('+Inf' if np.isinf(b) else str(b)): int(c)
+                        for b, c in zip(BUCKETS_MS, cumulative)}
+    return stage
+
+
+class StreamMetrics():
+    """
+    Latency histograms of each pipeline stage, frame counters and gauges,
+    in shared memory so that both the simulation process and the writing
+    process record into them without any messages or locks: each stage
+    and counter is only ever recorded by one process.
+
+    snapshot() returns everything as a dict, which publish() writes to a
+    JSON file for the Dash app to poll.
+    """
+
+    def __init__(self, slots=None):
+        self.slots = slots
+        size = (len(STAGES) * _HIST_LEN + len(COUNTERS)) * 8
+        self._shm = SharedMemory(create=True, size=size)
+        self._owner_pid = os.getpid()
+        self._attach()
+        self._values[:] = 0
+        self.set('started', time.time())
+
+    def _attach(self):
+        self._values = np.ndarray((len(STAGES) * _HIST_LEN + len(COUNTERS),),
+                                  dtype=np.float64, buffer=self._shm.buf)
+        self._hists = self._values[:len(STAGES) * _HIST_LEN].reshape(len(STAGES), _HIST_LEN)
+        self._counters = self._values[len(STAGES) * _HIST_LEN:]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('_values', '_hists', '_counters'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    # --- recording --- #
+
+    def observe(self, stage, seconds):
+        """Records that a frame spent seconds in stage."""
+        observe(self._hists[STAGES.index(stage)], seconds)
+
+    def count(self, counter, n=1):
+        self._counters[COUNTERS.index(counter)] += n
+
+    def set(self, gauge, value):
+        self._counters[COUNTERS.index(gauge)] = value
+
+    def get(self, counter):
+        return float(self._counters[COUNTERS.index(counter)])
+
+    # --- reading --- #
+
+    def snapshot(self):
+        """
+        Returns the metrics as a dict of plain numbers:
+            stages - per stage: count, mean/p50/p95/p99/max in
+                milliseconds, and cumulative bucket counts by upper bound
+            frames - the frame counters
+            queue - depth and max_depth of the frame ring, and its slots
+            encoder_speed - encoding speed relative to real time, or None
+            time, uptime_s - when the snapshot was taken, and how long
+                after the metrics were created
+        """
+        values = self._values.copy()  # one consistent-enough read
+        hists = values[:len(STAGES) * _HIST_LEN].reshape(len(STAGES), _HIST_LEN)
+        counters = dict(zip(COUNTERS, values[len(STAGES) * _HIST_LEN:].tolist()))
+        now = time.time()
+        return {
+            'time': now,
+            'uptime_s': now - counters['started'],
+            'stages': {name: stage_snapshot(hist) for name, hist in zip(STAGES, hists)},
+            'frames': {name[len('frames_'):]: int(value)
+                       for name, value in counters.items() if name.startswith('frames_')},
+            'segments': int(counters['segments']),
+            'queue': {
+                'depth': int(counters['queue_depth']),
+                'max_depth': int(counters['queue_depth_max']),
+                'slots': self.slots,
+            },
+            'encoder_speed': counters['encoder_speed'] or None,
+        }
+
+    def publish(self, path, **extra):
+        """
+        Writes snapshot(), updated with extra, as JSON to path. The file
+        is replaced in one step, so readers never see half a snapshot.
+        """
+        snapshot = self.snapshot()
+        snapshot.update(extra)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, path)
+
+    def close(self):
+        """Detaches from the shared memory, freeing it in the creating process."""
+        self._values = self._hists = self._counters = None
+        self._shm.close()
+        if os.getpid() == self._owner_pid:
+            self._shm.unlink()
+
+
+def read_metrics(path):
+    """Returns the snapshot published at path, or None if there is none yet."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
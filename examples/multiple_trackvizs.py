@@ -20,6 +20,16 @@ import numpy as np
 from core_gui.gui_assets.pygame_streamer import PygameStreamer
 import os
 
+def use_headless():
+    """
+    Whether to render without a window (see Simulation.run_with_web): as the CHRONOS_HEADLESS
+    environment variable says ('1' or '0'), or else when there is no display to open one on.
+    """
+    setting = os.environ.get('CHRONOS_HEADLESS')
+    if setting is not None:
+        return setting.strip().lower() not in ('', '0', 'false', 'no')
+    return sys.platform.startswith('linux') and not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
 def main(dataQueueInput, dataQueueOutput, consoleQueue, commandQueue):
     # The goal is to show 10 trains racing eastward across the US.
 
@@ -75,8 +85,10 @@ def main(dataQueueInput, dataQueueOutput, consoleQueue, commandQueue):
 
     sim = Simulation(track_vizs, [], 0)
     # sim.run(speed=1, refresh_rate=0.1, osm_zoom=zoom) 
+    # sim.render_to_file("trains.mp4", speed=1, osm_zoom=zoom) # Offline, faster than real time
 
-    sim.run_with_web(commandQueue, speed=1, refresh_rate=0.1, osm_zoom=zoom)
+    # Controlled by the web interface's commands (faster, slower, pause, begin, end), and with a window by its keys
+    sim.run_with_web(commandQueue, speed=1, refresh_rate=0.1, osm_zoom=zoom, headless=use_headless())
 
     # To allow the web interface to safely stop the Chronos process
     consoleQueue.put('stop chronos')
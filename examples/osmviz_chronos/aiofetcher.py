@@ -0,0 +1,188 @@
+"""
+Asynchronous Tile Fetching Tool:
+  - asyncio counterpart of TileFetcher, for use from an event loop (e.g. a
+    web server preparing map backgrounds for several sessions at once).
+  - Keeps a pool of keep-alive HTTP/1.1 connections per server, and caps
+    the number of requests in flight across all servers.
+  - Needs nothing beyond the standard library.
+
+Basic idea:
+  1. Construct an AsyncTileFetcher inside a running event loop.
+  2. Await request() for each tile; run as many as you like concurrently,
+     at most max_connections of them are in flight at once.
+  3. Await close() when done.
+"""
+
+import asyncio
+import http.client
+import io
+import ssl
+from urllib.parse import urljoin, urlsplit
+
+from .fetcher import USER_AGENT
+
+_REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+class AsyncTileFetcher:
+    """
+    An AsyncTileFetcher performs GET requests over pooled keep-alive
+    connections on an asyncio event loop.
+    """
+
+    def __init__(self, max_connections=8, timeout=30, headers=None, max_redirects=5):
+        """
+        Creates an AsyncTileFetcher.
+        Arguments:
+            max_connections - maximum number of requests in flight at once.
+                 Default 8.
+            timeout - timeout, in seconds, for each request. Default 30.
+            headers - dict of extra HTTP headers sent with every request.
+            max_redirects - maximum number of redirects followed per request.
+        """
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.headers = {"User-Agent": USER_AGENT}
+        if headers:
+            self.headers.update(headers)
+
+        self._semaphore = asyncio.Semaphore(max_connections)
+        self._idle = {}
+        self._ssl_context = None
+
+    async def _open(self, scheme, host, port):
+        if scheme == "https":
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            return await asyncio.open_connection(host, port, ssl=self._ssl_context)
+        elif scheme == "http":
+            return await asyncio.open_connection(host, port)
+        raise Exception(f"Unsupported URL scheme: {scheme}")
+
+    async def _read_response(self, reader):
+        """
+        Reads one HTTP/1.1 response.
+        Returns (status, headers, body, reusable), where reusable tells
+        whether the connection can carry another request.
+        """
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by server")
+        parts = status_line.decode("iso-8859-1").split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise http.client.BadStatusLine(status_line)
+        status = int(parts[1])
+
+        raw_headers = b""
+        while True:
+            line = await reader.readline()
+            raw_headers += line
+            if line in (b"\r\n", b"\n", b""):
+                break
+        headers = http.client.parse_headers(io.BytesIO(raw_headers))
+
+        reusable = parts[0] == "HTTP/1.1" and headers.get("Connection", "").lower() != "close"
+        if status in (204, 304) or 100 <= status < 200:
+            body = b""
+        elif headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    # Skip any trailers
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b"".join(chunks)
+        elif headers.get("Content-Length") is not None:
+            body = await reader.readexactly(int(headers["Content-Length"]))
+        else:
+            body = await reader.read()
+            reusable = False
+        return status, headers, body, reusable
+
+    async def _request_once(self, url, headers):
+        parts = urlsplit(url)
+        scheme = parts.scheme
+        host = parts.hostname
+        port = parts.port or (443 if scheme == "https" else 80)
+        target = parts.path or "/"
+        if parts.query:
+            target = f"{target}?{parts.query}"
+
+        request = [f"GET {target} HTTP/1.1", f"Host: {parts.netloc}"]
+        request += [f"{name}: {value}" for name, value in headers.items()]
+        payload = ("\r\n".join(request) + "\r\n\r\n").encode("iso-8859-1")
+
+        key = (scheme, host, port)
+        idle = self._idle.setdefault(key, [])
+        for attempt in range(2):
+            # Retry once on a fresh connection if a pooled one went stale
+            pooled = bool(idle) and attempt == 0
+            reader, writer = idle.pop() if pooled else await self._open(scheme, host, port)
+            try:
+                writer.write(payload)
+                await writer.drain()
+                status, resp_headers, body, reusable = await self._read_response(reader)
+            except (ConnectionError, asyncio.IncompleteReadError, http.client.BadStatusLine):
+                writer.close()
+                if pooled:
+                    continue
+                raise
+            except BaseException:
+                # Includes cancellation: the connection is in an unknown state
+                writer.close()
+                raise
+            if reusable:
+                idle.append((reader, writer))
+            else:
+                writer.close()
+            return status, resp_headers, body
+
+    async def request(self, url, headers=None):
+        """
+        Performs a GET request for the given URL, following redirects.
+        Returns (status, response_headers, body), like TileFetcher.request().
+        Raises asyncio.TimeoutError if the request takes longer than
+        self.timeout seconds.
+        """
+        req_headers = dict(self.headers)
+        if headers:
+            req_headers.update(headers)
+
+        async with self._semaphore:
+            for _ in range(self.max_redirects + 1):
+                status, resp_headers, body = await asyncio.wait_for(
+                    self._request_once(url, req_headers), self.timeout
+                )
+                location = resp_headers.get("Location")
+                if status in _REDIRECT_CODES and location:
+                    url = urljoin(url, location)
+                    continue
+                return status, resp_headers, body
+        raise Exception(f"Too many redirects for URL: {url}")
+
+    async def fetch_bytes(self, url):
+        """
+        Downloads the given URL and returns its contents as bytes.
+        """
+        status, _, body = await self.request(url)
+        if status != 200:
+            raise Exception(f"HTTP {status} for URL: {url}")
+        return body
+
+    async def close(self):
+        """Closes every pooled connection."""
+        idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for _, writer in connections:
+                writer.close()
+        for connections in idle.values():
+            for _, writer in connections:
+                try:
+                    await writer.wait_closed()
+                except Exception:
+                    pass
@@ -52,18 +52,40 @@ Keyboard input is accepted to control the speed of the simulation.
 
 import time
 from functools import reduce
+from queue import Empty
 
+import numpy as np
 import pygame
 
-from .manager import OSMManager, PygameImageManager
+from .manager import NumpyImageManager, OSMManager
+from .projection import Viewport, choose_zoom
 
 # For pygame streaming
-from core_gui.gui_assets.pygame_streamer import PygameStreamer
-from multiprocessing import Queue, Value
-from multiprocess import Process
+from core_gui.gui_assets.pygame_streamer import PygameStreamer, create_surface, surface_to_native
+from core_gui.gui_assets.encoder_profiles import get_profile
+from core_gui.gui_assets.offline_render import encode_frames, render_parallel
 
 Inf = float("inf")
 
+# Disk budget for decoded map tiles, which later sessions read back
+# instead of decoding the tile PNGs again
+DECODED_CACHE_BYTES = 256 * 1024 * 1024
+
+# Disk budget for the whole tile cache directory (tiles, decoded tiles,
+# backgrounds and metadata), unless a simulation is given another
+CACHE_QUOTA_BYTES = 1024 * 1024 * 1024
+
+# Simulation controls: keys in the window, or these names on the command
+# channel (see Simulation.run_with_web())
+KEY_COMMANDS = {
+    pygame.K_ESCAPE: "exit",
+    pygame.K_UP: "faster",
+    pygame.K_DOWN: "slower",
+    pygame.K_SPACE: "pause",
+    pygame.K_LEFT: "begin",
+    pygame.K_RIGHT: "end",
+}
+
 
 class SimViz:
     """
@@ -281,6 +303,114 @@ class Simulation:
         """
         self.time = min(max(time, self.time_window[0]), self.time_window[1])
 
+    def __prepare_background(self, window_size, osm_zoom, bg_cache=True, cache_quota=None):
+        """
+        Returns (bg_small, new_bounds, window_size): the OSM background of
+        the bounding box scaled to fit window_size, the lat/lon bounds it
+        covers, and window_size shrunk to keep the map's proportions.
+        osm_zoom is the zoom level of the map tiles, used as given; None
+        means the lowest zoom level whose tiles fill window_size (see
+        choose_zoom()). Tiles missing at that zoom level are synthesized
+        from cached tiles of neighbouring zoom levels when possible; such
+        a background is provisional and not saved to the background cache.
+        If bg_cache is True, the background is loaded from (or saved to)
+        the background cache inside the tile cache directory, as long as
+        all of its tiles are stored and fresh.
+        cache_quota is passed on to the OSMManager, and covers the whole
+        cache directory: tiles, decoded tiles and cached backgrounds.
+        """
+        # The background is stitched as a NumPy array, which the returned
+        # Surface and the background cache share rather than copy
+        osm = OSMManager(
+            cache="maptiles/",
+            image_manager=NumpyImageManager(decoder="pygame"),
+            cache_quota=cache_quota,
+            synthesize=True,
+            decoded_cache=DECODED_CACHE_BYTES,
+            backgrounds=bg_cache,
+        )
+        try:
+            if osm_zoom is None:
+                osm_zoom = choose_zoom(self.bounding_box, window_size, osm.tile_size)
+
+            cache = osm.background_cache
+            if cache:
+                key = self.__background_key(osm, osm_zoom, window_size)
+                cached = cache.load(key) if key else None
+                if cached:
+                    if osm.cache_gc:
+                        osm.cache_gc.pin_background(key)
+                        # No tiles were used, but the quota still applies
+                        osm.cache_gc.maybe_collect()
+                    # The surface shares the memory-mapped pixels, no copy made
+                    bg_small = pygame.image.frombuffer(cached.pixels, cached.size, "RGB")
+                    return bg_small, cached.bounds, cached.size
+
+            # Tiles are scaled straight into a window-sized image, which keeps
+            # proportions and stays within the specified window_size
+            pixels, new_bounds = osm.create_osm_image(
+                self.bounding_box, zoom=osm_zoom, size=window_size
+            )
+            bg_small = osm.manager.get_surface()
+            fitted_size = bg_small.get_size()
+
+            if cache:
+                # Only once every tile is stored and fresh, so a background
+                # missing tiles that could not be downloaded, or made of
+                # synthesized placeholders for them, is not kept
+                key = self.__background_key(osm, osm_zoom, window_size)
+                if key and not osm.synthesized_tiles:
+                    cache.save(key, fitted_size, new_bounds, pixels)
+                    if osm.cache_gc:
+                        osm.cache_gc.pin_background(key)
+
+            return bg_small, new_bounds, fitted_size
+        finally:
+            osm.close()
+
+    def __set_states(self, get_xy):
+        """
+        Moves every SimViz to the current time. TrackingViz positions are
+        projected onto the map together, in one vectorized get_xy() call,
+        rather than one call per viz.
+        """
+        tracked, lats, lons = [], [], []
+        for sviz in self.all_vizs:
+            if type(sviz).set_state is not TrackingViz.set_state:
+                sviz.set_state(self.time, get_xy)
+                continue
+            sviz.xy = None
+            ll = sviz.get_location_at_time(self.time)
+            if ll is not None:
+                tracked.append(sviz)
+                lats.append(ll[0])
+                lons.append(ll[1])
+        if tracked:
+            xs, ys = get_xy(np.array(lats, dtype=float), np.array(lons, dtype=float))
+            for sviz, x, y in zip(tracked, xs.tolist(), ys.tolist()):
+                sviz.xy = x, y
+
+    def __match_format(self, bg_small, screen):
+        """
+        Returns a copy of the packed RGB background in the pixel format of
+        screen, which is about three times faster to blit every frame.
+        """
+        bg = pygame.Surface(bg_small.get_size(), 0, screen)
+        bg.blit(bg_small, (0, 0))
+        return bg
+
+    def __background_key(self, osm, osm_zoom, window_size):
+        """
+        Returns the background cache key for the map at osm_zoom in
+        window_size, or None if its tiles are not all stored and fresh.
+        """
+        version = osm.get_image_version(self.bounding_box, osm_zoom)
+        if version is None:
+            return None
+        return osm.background_cache.make_key(
+            self.bounding_box, osm_zoom, osm.cache_prefix, window_size, version
+        )
+
     def print_time(self):
         hours = int(self.time / 3600)
         minutes = int((self.time % 3600) / 60)
@@ -291,11 +421,50 @@ class Simulation:
         """
         Given coordinates in lon, lat, and a screen size,
         returns the corresponding (x, y) pixel coordinates.
+        lat and lon may also be NumPy arrays, in which case arrays of
+        pixel coordinates are returned.
         """
-        x_ratio = (lon - bounds[2]) / (bounds[3] - bounds[2])
-        y_ratio = 1.0 - ((lat - bounds[0]) / (bounds[1] - bounds[0]))
-        x, y = int(x_ratio * screen_size[0]), int(y_ratio * screen_size[1])
-        return x, y
+        return Viewport(bounds, screen_size).project(lat, lon)
+
+    def __key_commands(self):
+        """Returns the control commands (see KEY_COMMANDS) of the keys pressed."""
+        return [
+            KEY_COMMANDS[event.key]
+            for event in pygame.event.get()
+            if event.type == pygame.KEYDOWN and event.key in KEY_COMMANDS
+        ]
+
+    def __queued_commands(self, commandQueue):
+        """
+        Returns the commands waiting on commandQueue, without blocking.
+        Only text commands are taken; others (such as the web interface's
+        agent commands) are skipped.
+        """
+        commands = []
+        while True:
+            try:
+                command = commandQueue.get_nowait()
+            except Empty:
+                return commands
+            if isinstance(command, str):
+                commands.append(command.strip())
+
+    def __control(self, command, speed):
+        """
+        Applies a control command (see KEY_COMMANDS) other than "exit" and
+        returns the new speed. Unknown commands are ignored.
+        """
+        if command == "faster":
+            speed = max((speed + 1) * 1.4, (speed / 1.4) + 1)
+        elif command == "slower":
+            speed = min((speed / 1.4) - 1, (speed - 1) * 1.4)
+        elif command == "pause":
+            speed = 0.0
+        elif command == "begin":
+            self.time = self.time_window[0]
+        elif command == "end":
+            self.time = self.time_window[1]
+        return speed
 
     def run(
         self,
@@ -306,6 +475,8 @@ class Simulation:
         "lib/python2.5/site-packages/pygame/freesansbold.ttf",
         font_size=10,
         osm_zoom=14,
+        bg_cache=True,
+        cache_quota=CACHE_QUOTA_BYTES,
     ):
         """
         Pops up a window and displays the simulation on it.
@@ -317,6 +488,16 @@ class Simulation:
             If None, then labels will not be rendered, instead they will be
             printed to stdout.
         font_size is the size of the font, if it exists.
+        osm_zoom is the zoom level of the map tiles, 14 by default. None
+            picks the lowest zoom level whose tiles fill window_size, so
+            that no more tiles are fetched than the window can show.
+        bg_cache is whether to reuse the map background saved by an
+            earlier run with the same bounds, zoom and window_size.
+        cache_quota is the maximum size, in bytes, of the tile cache
+            directory, CACHE_QUOTA_BYTES (1 GiB) by default; least recently
+            used tiles beyond it are evicted, except those of this
+            simulation's map and any used in the last hour. None means no
+            limit.
         """
         pygame.init()
         black = pygame.Color(0, 0, 0)
@@ -331,27 +512,17 @@ class Simulation:
         elif isinstance(font, pygame.font.Font):
             fnt = font
 
-        osm = OSMManager(cache="maptiles/", image_manager=PygameImageManager())
-        bg_big, new_bounds = osm.create_osm_image(self.bounding_box, zoom=osm_zoom)
-        w_h_ratio = float(bg_big.get_width()) / bg_big.get_height()
-        # Make the window smaller to keep proportions and stay within
-        # specified window_size
-        new_width = int(window_size[1] * w_h_ratio)
-        new_height = int(window_size[0] / w_h_ratio)
-        if new_width > window_size[0]:
-            window_size = window_size[0], new_height
-        elif new_height > window_size[1]:
-            window_size = new_width, window_size[1]
+        bg_small, new_bounds, window_size = self.__prepare_background(
+            window_size, osm_zoom, bg_cache, cache_quota
+        )
 
         screen = pygame.display.set_mode(window_size)
-
-        bg_small = pygame.transform.smoothscale(bg_big, window_size)
-        del bg_big
+        bg_small = self.__match_format(bg_small, screen)
 
         last_time = self.time
 
-        def get_xy(lat, lon):
-            return self.get_xy(lat, lon, new_bounds, window_size)
+        # Projects lat/lon (scalars or NumPy arrays) onto the background
+        get_xy = Viewport(new_bounds, window_size).project
 
         # Main simulation loop #
 
@@ -359,19 +530,11 @@ class Simulation:
         while not ready_to_exit:
 
             # Check keyboard events
-            for event in pygame.event.get():
-                if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+            for command in self.__key_commands():
+                if command == "exit":
                     ready_to_exit = True
-                elif event.type == pygame.KEYDOWN and event.key == pygame.K_UP:
-                    speed = max((speed + 1) * 1.4, (speed / 1.4) + 1)
-                elif event.type == pygame.KEYDOWN and event.key == pygame.K_DOWN:
-                    speed = min((speed / 1.4) - 1, (speed - 1) * 1.4)
-                elif event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE:
-                    speed = 0.0
-                elif event.type == pygame.KEYDOWN and event.key == pygame.K_LEFT:
-                    self.time = self.time_window[0]
-                elif event.type == pygame.KEYDOWN and event.key == pygame.K_RIGHT:
-                    self.time = self.time_window[1]
+                else:
+                    speed = self.__control(command, speed)
 
             # Grab mouse position
             mouse_x, mouse_y = pygame.mouse.get_pos()
@@ -386,8 +549,8 @@ class Simulation:
             screen.blit(bg_small, (0, 0))
 
             # Draw the tracked objects
+            self.__set_states(get_xy)
             for sviz in self.all_vizs:
-                sviz.set_state(self.time, get_xy)
                 sviz.draw_to_surface(screen)
                 label = sviz.get_label()
                 if label and sviz.mouse_intersect(mouse_x, mouse_y):
@@ -422,9 +585,38 @@ class Simulation:
         "lib/python2.5/site-packages/pygame/freesansbold.ttf",
         font_size=10,
         osm_zoom=14,
+        bg_cache=True,
+        cache_quota=CACHE_QUOTA_BYTES,
+        stream_profile="hls-lowlatency-abr",
+        stream_output="http://127.0.0.1:8050/hls/live.m3u8",
+        live_view="http://127.0.0.1:8050/live/frame",
+        headless=False,
     ):
+        """
+        Like run(), but streams the window for the web interface until
+        'stop stream' arrives on commandQueue. stream_output is by default
+        the web app's in-memory segment store, which the playlists and
+        segments are uploaded to; it can also be a file. Each new frame is
+        also pushed to the web app's low latency live_view, unless None.
+        stream_profile is the PygameStreamer encoder profile, by default
+        half-second fMP4 HLS segments for a low delay, in full size, 720p
+        and 480p renditions for the player to choose from.
+        Streaming metrics are published to assets/hls/metrics.json (see
+        core_gui/gui_assets/stream_metrics.py).
+        The names in KEY_COMMANDS (e.g. "faster") arriving on commandQueue
+        control the simulation like the keys do.
+        headless renders into an offscreen surface in the streamer's pixel
+        format instead of a window, for hosts with no display: no window
+        is opened, and no keyboard or mouse events are polled, so the
+        simulation is only controlled through commandQueue, and no label
+        is ever shown.
+        """
 
-        pygame.init()
+        if headless:
+            # Only fonts are needed: the display is never initialized
+            pygame.font.init()
+        else:
+            pygame.init()
         black = pygame.Color(0, 0, 0)
         notec = pygame.Color(200, 200, 80)
 
@@ -437,19 +629,12 @@ class Simulation:
         elif isinstance(font, pygame.font.Font):
             fnt = font
 
-        osm = OSMManager(cache="maptiles/", image_manager=PygameImageManager())
-        bg_big, new_bounds = osm.create_osm_image(self.bounding_box, zoom=osm_zoom)
-        w_h_ratio = float(bg_big.get_width()) / bg_big.get_height()
-        # Make the window smaller to keep proportions and stay within
-        # specified window_size
-        new_width = int(window_size[1] * w_h_ratio)
-        new_height = int(window_size[0] / w_h_ratio)
-        if new_width > window_size[0]:
-            window_size = window_size[0], new_height
-        elif new_height > window_size[1]:
-            window_size = new_width, window_size[1]
+        bg_small, new_bounds, window_size = self.__prepare_background(
+            window_size, osm_zoom, bg_cache, cache_quota
+        )
 
-        screen = pygame.display.set_mode(window_size)
+        if not headless:
+            screen = pygame.display.set_mode(window_size)
 
         ########## ----- STREAMING PART ----- ##########
         fps = 10
@@ -457,69 +642,46 @@ class Simulation:
                         window_size[0], 
                         window_size[1], 
                         fps, 
-                        bitrate='10000k', 
-                        output='assets/hls/live.m3u8',
-                        format='hls', 
-                        chunk_time=2,
+                        output=stream_output,
+                        profile=stream_profile,
+                        skip_unchanged=True,
+                        metrics_path='assets/hls/metrics.json',
+                        live_view=live_view,
+                        # headless, the display's usual layout; otherwise detected from the window
+                        pix_fmt='bgr0' if headless else None,
                         verbose=True
                     )
 
-        # Function to be called as a subprocess to constantly check whether a stop/refresh has been initiated - will safely break out of Chronos's main while loop to end 
-        # the streamer process, the pygame simulation, and finally the Chronos process
-        def stop_streamer_process(commandQueue, shared_val):
-
-            running = True
-            while running:
-
-                # Checks the commandQueue for the 'stop stream' command (initiated by pressing the stop/refresh button)
-                while not commandQueue.empty():
-                    command = commandQueue.get()
-
-                    if command == 'stop stream':
-                        shared_val.value = 1.0 # Turns shared_val.value to 1 upon stop/refresh button press
-                        running = False
-                        break 
-
-        # Initiates the stop_streamer_process function to keep checking if the stop button is pressed - this terminates the streamer process
-        shared_val = Value('d', 0.0) # Creates the Value() object that is shared between the main process and the subprocess
-        stop_stream_process = Process(target=stop_streamer_process, args=(commandQueue, shared_val))
-        stop_stream_process.start()
-
-        bg_small = pygame.transform.smoothscale(bg_big, window_size)
-        del bg_big
+        # Headless, frames are rendered straight into the streamer's pixel format
+        if headless:
+            screen = streamer.create_surface()
+        bg_small = self.__match_format(bg_small, screen)
 
         last_time = self.time
+        last_frame_state = None
 
-        def get_xy(lat, lon):
-            return self.get_xy(lat, lon, new_bounds, window_size)
+        # Projects lat/lon (scalars or NumPy arrays) onto the background
+        get_xy = Viewport(new_bounds, window_size).project
 
         # Main simulation loop #
 
         ready_to_exit = False
         while not ready_to_exit:
 
-            # Break out of loop if stop/refresh button is pressed
-            if shared_val.value == 1.0:
-                ready_to_exit = True
-                break
-
-            # Check keyboard events
-            for event in pygame.event.get():
-                if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+            # Check the command channel ('stop stream' when the stop/refresh
+            # button is pressed) without blocking, and keyboard events if
+            # there is a window
+            commands = self.__queued_commands(commandQueue)
+            if not headless:
+                commands += self.__key_commands()
+            for command in commands:
+                if command in ("exit", "stop stream"):
                     ready_to_exit = True
-                elif event.type == pygame.KEYDOWN and event.key == pygame.K_UP:
-                    speed = max((speed + 1) * 1.4, (speed / 1.4) + 1)
-                elif event.type == pygame.KEYDOWN and event.key == pygame.K_DOWN:
-                    speed = min((speed / 1.4) - 1, (speed - 1) * 1.4)
-                elif event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE:
-                    speed = 0.0
-                elif event.type == pygame.KEYDOWN and event.key == pygame.K_LEFT:
-                    self.time = self.time_window[0]
-                elif event.type == pygame.KEYDOWN and event.key == pygame.K_RIGHT:
-                    self.time = self.time_window[1]
+                else:
+                    speed = self.__control(command, speed)
 
-            # Grab mouse position
-            mouse_x, mouse_y = pygame.mouse.get_pos()
+            # Grab mouse position; headless there is no mouse
+            mouse_x, mouse_y = (None, None) if headless else pygame.mouse.get_pos()
             selected = None
 
             # Print the time if changed
@@ -527,43 +689,123 @@ class Simulation:
                 self.print_time()
             last_time = self.time
 
-            # Draw the background
-            screen.blit(bg_small, (0, 0))
-
-            # Draw the tracked objects
-            for sviz in self.all_vizs:
-                sviz.set_state(self.time, get_xy)
-                sviz.draw_to_surface(screen)
-                label = sviz.get_label()
-                if label and sviz.mouse_intersect(mouse_x, mouse_y):
-                    selected = sviz
-
-            # Display selected label
-            if selected:
-                if fnt:
-                    text = fnt.render(selected.get_label(), True, black, notec)
-                    screen.blit(text, (mouse_x, mouse_y - 10))
-                    del text
-                else:
-                    print(selected.get_label()) 
-
-            pygame.display.flip()
+            # Only redraw (and stream) the frame when something on it changed,
+            # so a paused or finished simulation costs next to nothing
+            frame_state = (self.time, mouse_x, mouse_y)
+            if frame_state != last_frame_state:
+                last_frame_state = frame_state
+                render_start = time.monotonic()
+
+                # Draw the background
+                screen.blit(bg_small, (0, 0))
+
+                # Draw the tracked objects
+                self.__set_states(get_xy)
+                for sviz in self.all_vizs:
+                    sviz.draw_to_surface(screen)
+                    label = sviz.get_label()
+                    if label and not headless and sviz.mouse_intersect(mouse_x, mouse_y):
+                        selected = sviz
+
+                # Display selected label
+                if selected:
+                    if fnt:
+                        text = fnt.render(selected.get_label(), True, black, notec)
+                        screen.blit(text, (mouse_x, mouse_y - 10))
+                        del text
+                    else:
+                        print(selected.get_label()) 
+
+                if not headless:
+                    pygame.display.flip()
+                streamer.metrics.observe('render', time.monotonic() - render_start)
+
+                # Feed new frames into ffmpeg - this should be after world.step() and gui.draw_window())
+                streamer.write_surface(screen, changed=True)
 
             time.sleep(refresh_rate)
             self.set_time(self.time + speed * refresh_rate)
 
-            # Feed new frames into ffmpeg - this should be after world.step() and gui.draw_window())
-            image = streamer.pygame_to_image(screen)
-            streamer.image_queue.put(image)
-
         # Clean up and exit
         del bg_small
-        pygame.display.quit()
+        if not headless:
+            pygame.display.quit()
 
-        # Safely terminates all processes
+        # Safely terminates the streamer's processes
         streamer.terminate()
-        stop_stream_process.terminate()
 
         # Safely quits pygame
         pygame.quit()
 
+    def render_to_file(
+        self,
+        output,
+        fps=30,
+        speed=60.0,
+        window_size=(1280, 800),
+        osm_zoom=14,
+        bg_cache=True,
+        cache_quota=CACHE_QUOTA_BYTES,
+        profile="record-fast",
+        backend="auto",
+        workers=None,
+        verbose=True,
+    ):
+        """
+        Renders the whole time window to the video file output, as fast as
+        the machine goes rather than in real time. Frame n shows the
+        simulation at begin_time + n * speed / fps, set with set_time(), so
+        the same arguments always give the same video; nothing sleeps, and
+        no window is opened.
+        The frames are split into one chunk per worker process (None: one
+        per CPU), each rendered offscreen and encoded on its own, and the
+        chunks are then joined without re-encoding (see
+        core_gui/gui_assets/offline_render.py). Needs ffmpeg.
+        speed is advancement of sim in seconds per second of video, e.g.
+            60 makes an hour of simulation a one minute video.
+        window_size, osm_zoom, bg_cache and cache_quota are as for run().
+        profile is the PygameStreamer encoder profile of a file format
+            ('record' or 'record-fast'), and backend its encoder backend.
+        Returns the render stats of render_parallel().
+        """
+        profile = get_profile(profile)
+        if profile.format != "mp4":
+            raise Exception(
+                f"Sorry, cannot render to a file with the {profile.name} profile. "
+                "Use record or record-fast."
+            )
+        begin_time, end_time = self.time_window
+        if not (-Inf < begin_time <= end_time < Inf):
+            raise Exception("Sorry, cannot render an unbounded time window.")
+
+        bg_small, new_bounds, window_size = self.__prepare_background(
+            window_size, osm_zoom, bg_cache, cache_quota
+        )
+        w, h = window_size
+        get_xy = Viewport(new_bounds, window_size).project
+        frames = int((end_time - begin_time) / speed * fps) + 1
+        pix_fmt = "bgr0"
+
+        # Runs in a worker process, on its own copy of the simulation
+        def render_chunk(start, end, chunk_output):
+            screen = create_surface(w, h, pix_fmt)
+            background = self.__match_format(bg_small, screen)
+            frame = None
+
+            def render(n):
+                nonlocal frame
+                self.set_time(begin_time + n * speed / fps)
+                screen.blit(background, (0, 0))
+                self.__set_states(get_xy)
+                for sviz in self.all_vizs:
+                    sviz.draw_to_surface(screen)
+                frame = surface_to_native(screen, out=frame)
+                return frame
+
+            encode_frames(render, start, end, chunk_output, w, h, fps, pix_fmt, profile, backend)
+
+        init_time = self.time
+        try:
+            return render_parallel(render_chunk, frames, output, fps, workers, verbose)
+        finally:
+            self.set_time(init_time)
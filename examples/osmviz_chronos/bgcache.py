@@ -0,0 +1,171 @@
+"""
+Background Cache:
+  - Persists the final, window-sized map background of a Simulation as a
+    raw RGB buffer on disk, along with the lat/lon bounds it covers.
+  - Cached backgrounds are memory-mapped on load, so a session whose
+    bounds, zoom, tile server and window size match an earlier one gets
+    its background without fetching, decoding, stitching or rescaling
+    any tiles.
+  - The key also covers the version of every tile in the background (see
+    OSMManager.get_image_version()), so a background is rebuilt once any
+    of its tiles is downloaded again.
+  - Entries unused for max_age are deleted, and a TileCacheGC given the
+    BackgroundCache counts them against its quota, evicting them least
+    recently used first along with the tiles.
+
+Each entry is two files in the cache directory:
+    <key>.rgb  - width * height * 3 bytes of packed RGB pixels, row major
+    <key>.json - {"width", "height", "bounds"}, written last so that an
+                 entry is only visible once its pixels are complete
+The modification time of the .json file records when the entry was last
+used.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import os.path as path
+import time
+
+from .fetcher import write_file_atomic
+
+
+class CachedBackground:
+    """
+    A background loaded from a BackgroundCache. The pixels are a read-only
+    memory map of the cache file, which stays open until close() is called
+    (or the object is garbage collected).
+    """
+
+    def __init__(self, size, bounds, pixels, mapping=None):
+        self.size = size
+        self.bounds = bounds
+        self.pixels = pixels
+        self._mapping = mapping
+
+    def close(self):
+        """Releases the memory map backing the pixels."""
+        self.pixels = None
+        if self._mapping is not None:
+            self._mapping.close()
+            self._mapping = None
+
+
+class BackgroundCache:
+    """
+    A directory of window-sized map backgrounds, keyed by everything that
+    determines their pixels.
+    """
+
+    def __init__(self, directory, max_age=30 * 24 * 3600):
+        """
+        Creates a BackgroundCache storing its files in directory, which is
+        created if it does not exist.
+        Arguments:
+            max_age - number of seconds an entry is kept after it was last
+                 used. Default 30 days.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_age = max_age
+
+    @staticmethod
+    def make_key(bounds, zoom, cache_prefix, window_size, version):
+        """
+        Returns the cache key for a background built from the given
+        (min_lat, max_lat, min_lon, max_lon) bounds, OSM zoom level, tile
+        server (identified by its OSMManager cache_prefix), requested
+        window size and version of its tiles (as returned by
+        OSMManager.get_image_version()).
+        """
+        desc = json.dumps(
+            {
+                "bounds": [float(b) for b in bounds],
+                "zoom": int(zoom),
+                "tiles": cache_prefix,
+                "window_size": [int(s) for s in window_size],
+                "version": version,
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha1(desc.encode("utf-8")).hexdigest()
+
+    def _paths(self, key):
+        base = path.join(self.directory, key)
+        return f"{base}.rgb", f"{base}.json"
+
+    def load(self, key):
+        """
+        Returns the CachedBackground stored under key, or None if there is
+        no complete entry for it.
+        """
+        pixels_file, meta_file = self._paths(key)
+        try:
+            with open(meta_file) as f:
+                meta = json.load(f)
+            width, height = meta["width"], meta["height"]
+            with open(pixels_file, "rb") as f:
+                if os.fstat(f.fileno()).st_size != width * height * 3:
+                    return None
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(meta_file)
+        except (OSError, ValueError, KeyError):
+            return None
+        return CachedBackground((width, height), tuple(meta["bounds"]), mapping, mapping)
+
+    def save(self, key, size, bounds, pixels):
+        """
+        Stores a background under key.
+        Arguments:
+            size - (width, height) of the background in pixels
+            bounds - (min_lat, max_lat, min_lon, max_lon) it covers
+            pixels - bytes-like object (such as a NumPy array) of packed
+                 RGB pixels
+        """
+        width, height = size
+        if memoryview(pixels).nbytes != width * height * 3:
+            raise Exception("Background pixels do not match its size.")
+        pixels_file, meta_file = self._paths(key)
+        write_file_atomic(pixels_file, pixels)
+        meta = {"width": width, "height": height, "bounds": list(bounds)}
+        write_file_atomic(meta_file, json.dumps(meta).encode("utf-8"))
+        self.prune()
+
+    def remove(self, key):
+        """Deletes the entry stored under key, if any."""
+        for filename in reversed(self._paths(key)):
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+    def iter_usage(self):
+        """
+        Yields (key, nbytes, last_used) for every entry, where last_used is
+        the time it was last saved or loaded.
+        """
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".json"):
+                    continue
+                key = entry.name[: -len(".json")]
+                pixels_file, _ = self._paths(key)
+                try:
+                    st = entry.stat()
+                    nbytes = os.stat(pixels_file).st_size + st.st_size
+                except FileNotFoundError:
+                    continue
+                yield key, nbytes, st.st_mtime
+
+    def prune(self, now=None):
+        """
+        Deletes the entries unused for longer than max_age.
+        Returns the number of entries deleted.
+        """
+        if now is None:
+            now = time.time()
+        expired = [key for key, _, last_used in self.iter_usage() if now - last_used > self.max_age]
+        for key in expired:
+            self.remove(key)
+        return len(expired)
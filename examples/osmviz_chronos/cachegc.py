@@ -0,0 +1,369 @@
+"""
+Tile Cache Garbage Collection:
+  - Keeps a TileStore within a size quota by evicting the least recently
+    used tiles first.
+  - Tiles covering the map of the currently running simulation can be
+    pinned, and are never evicted.
+  - Cached backgrounds (see bgcache.py) and decoded tiles (see
+    RawTileCache in tilecache.py) count against the same quota when
+    given, and are evicted along with the tiles. Given the cache
+    directory, every other file in it (such as the freshness metadata)
+    counts too.
+  - Pins only protect tiles in this process. Tiles, backgrounds and
+    decoded tiles used within keep_recent seconds are never evicted
+    either, so the maps of simulations running in other processes
+    sharing the cache are safe as well.
+  - Can run on demand (collect()), in a background thread when the cache
+    may be over quota (maybe_collect()) or periodically (start()), or
+    from the command line:
+      python -m examples.osmviz_chronos.cachegc maptiles/ --quota 500M
+
+Tile use is recorded by OSMManager.create_osm_image() (see
+TileStore.touch_tiles()); tiles cached before that was recorded are aged
+by when they were fetched instead.
+"""
+
+import os
+import os.path as path
+import threading
+import time
+
+from .projection import tile_grid
+
+
+class TileCacheGC:
+    """
+    A TileCacheGC evicts least recently used tiles from a TileStore when
+    it grows beyond its quota.
+    """
+
+    def __init__(
+        self,
+        tile_store,
+        max_bytes,
+        low_water=0.9,
+        background_cache=None,
+        raw_tile_cache=None,
+        directory=None,
+        keep_recent=3600,
+    ):
+        """
+        Creates a TileCacheGC.
+        Arguments:
+            tile_store - the TileStore to keep within its quota
+            max_bytes - quota, in bytes of tile data, cached backgrounds,
+                 decoded tiles and any other file in directory
+            low_water - fraction of max_bytes to shrink the cache to when
+                 it is over quota, so that eviction does not run again on
+                 the very next tile. Default 0.9.
+            background_cache - a BackgroundCache whose entries count
+                 against the quota too, or None.
+            raw_tile_cache - a RawTileCache whose decoded tiles count
+                 against the quota too, or None.
+            directory - the cache directory, every file of which counts
+                 against the quota; files which are neither tiles,
+                 backgrounds nor decoded tiles are counted but never
+                 evicted. None to only count the above.
+            keep_recent - number of seconds after its last use during which
+                 nothing is evicted, whichever process used it.
+                 Default 1 hour.
+        """
+        self.tile_store = tile_store
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.background_cache = background_cache
+        self.raw_tile_cache = raw_tile_cache
+        self.directory = directory
+        self.keep_recent = keep_recent
+        self._pinned = set()
+        self._pinned_backgrounds = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._collector = None
+        # Bytes in the cache as of the last collection plus those added
+        # since, or None before the first collection
+        self._tracked_bytes = None
+        self.last_stats = None
+
+    def pin(self, zoom, tile_coords):
+        """Protects the given tiles at the given zoom level from eviction."""
+        with self._lock:
+            self._pinned.update((zoom, x, y) for x, y in tile_coords)
+
+    def pin_bounds(self, bounds, zoom):
+        """
+        Protects every tile covering (min_lat, max_lat, min_lon, max_lon)
+        bounds at the given zoom level from eviction.
+        """
+        xs, ys = tile_grid(bounds, zoom)
+        self.pin(zoom, zip(xs.tolist(), ys.tolist()))
+
+    def pin_background(self, key):
+        """Protects the cached background stored under key from eviction."""
+        with self._lock:
+            self._pinned_backgrounds.add(key)
+
+    def unpin_all(self):
+        """Allows every tile and background to be evicted again."""
+        with self._lock:
+            self._pinned.clear()
+            self._pinned_backgrounds.clear()
+
+    def _iter_backgrounds(self):
+        if self.background_cache is None:
+            return iter(())
+        return self.background_cache.iter_usage()
+
+    def _iter_decoded(self):
+        if self.raw_tile_cache is None:
+            return iter(())
+        return self.raw_tile_cache.iter_usage()
+
+    def _other_bytes(self):
+        """
+        Returns the number of bytes of the files in directory which are
+        neither tiles, backgrounds nor decoded tiles.
+        """
+        if self.directory is None:
+            return 0
+        counted = {
+            path.abspath(cache.directory)
+            for cache in (self.background_cache, self.raw_tile_cache)
+            if cache is not None
+        }
+        total = 0
+        for root, dirs, files in os.walk(self.directory):
+            dirs[:] = [d for d in dirs if path.abspath(path.join(root, d)) not in counted]
+            for name in files:
+                filename = path.join(root, name)
+                if self.tile_store.is_tile_file(filename):
+                    continue
+                try:
+                    total += os.stat(filename).st_size
+                except FileNotFoundError:
+                    continue
+        return total
+
+    def usage(self):
+        """
+        Returns a dict describing the cache: number of tiles, bytes of
+        tile data, quota, number and bytes of pinned tiles, a
+        {zoom: (tiles, bytes)} breakdown by zoom level, the number and
+        bytes of cached backgrounds and of decoded tiles, and the bytes of
+        other files in the cache directory (all included in bytes).
+        """
+        with self._lock:
+            pinned = set(self._pinned)
+        stats = {
+            "tiles": 0,
+            "bytes": 0,
+            "max_bytes": self.max_bytes,
+            "pinned_tiles": 0,
+            "pinned_bytes": 0,
+            "by_zoom": {},
+            "backgrounds": 0,
+            "background_bytes": 0,
+            "decoded": 0,
+            "decoded_bytes": 0,
+            "other_bytes": self._other_bytes(),
+        }
+        stats["bytes"] += stats["other_bytes"]
+        for _, nbytes, _ in self._iter_backgrounds():
+            stats["backgrounds"] += 1
+            stats["background_bytes"] += nbytes
+            stats["bytes"] += nbytes
+        for _, nbytes, _ in self._iter_decoded():
+            stats["decoded"] += 1
+            stats["decoded_bytes"] += nbytes
+            stats["bytes"] += nbytes
+        for zoom, x, y, nbytes, _ in self.tile_store.iter_tile_usage():
+            stats["tiles"] += 1
+            stats["bytes"] += nbytes
+            tiles, zoom_bytes = stats["by_zoom"].get(zoom, (0, 0))
+            stats["by_zoom"][zoom] = (tiles + 1, zoom_bytes + nbytes)
+            if (zoom, x, y) in pinned:
+                stats["pinned_tiles"] += 1
+                stats["pinned_bytes"] += nbytes
+        return stats
+
+    def collect(self):
+        """
+        If the cache is over quota, evicts least recently used unpinned
+        tiles, backgrounds and decoded tiles, except those used within
+        keep_recent, until it is within low_water of the quota.
+        Returns a dict with the number of tiles and bytes before and
+        after collection, and the number of tiles, backgrounds, decoded
+        tiles and bytes evicted.
+        """
+        with self._lock:
+            pinned = set(self._pinned)
+            pinned_backgrounds = set(self._pinned_backgrounds)
+        usage = list(self.tile_store.iter_tile_usage())
+        backgrounds = list(self._iter_backgrounds())
+        decoded = list(self._iter_decoded())
+        total = sum(nbytes for _, _, _, nbytes, _ in usage)
+        total += sum(nbytes for _, nbytes, _ in backgrounds)
+        total += sum(nbytes for _, nbytes, _ in decoded)
+        total += self._other_bytes()
+        stats = {
+            "tiles_before": len(usage),
+            "bytes_before": total,
+            "evicted_tiles": 0,
+            "evicted_backgrounds": 0,
+            "evicted_decoded": 0,
+            "evicted_bytes": 0,
+        }
+
+        if total > self.max_bytes:
+            target = self.max_bytes * self.low_water
+            recent = time.time() - self.keep_recent
+            # (last_used, nbytes, kind, tile, background key or filename)
+            candidates = [(t[4], t[3], "tile", t[:3]) for t in usage if t[:3] not in pinned]
+            candidates += [
+                (last_used, nbytes, "background", key)
+                for key, nbytes, last_used in backgrounds
+                if key not in pinned_backgrounds
+            ]
+            candidates += [
+                (last_used, nbytes, "decoded", filename) for filename, nbytes, last_used in decoded
+            ]
+            candidates.sort(key=lambda c: c[0])
+            victims = []
+            for last_used, nbytes, kind, name in candidates:
+                # Oldest first, so everything left was used recently too
+                if total <= target or last_used > recent:
+                    break
+                if kind == "tile":
+                    victims.append(name)
+                    stats["evicted_tiles"] += 1
+                elif kind == "background":
+                    self.background_cache.remove(name)
+                    stats["evicted_backgrounds"] += 1
+                else:
+                    self.raw_tile_cache.discard(name)
+                    stats["evicted_decoded"] += 1
+                total -= nbytes
+                stats["evicted_bytes"] += nbytes
+            self.tile_store.delete_tiles(victims)
+
+        stats["tiles_after"] = stats["tiles_before"] - stats["evicted_tiles"]
+        stats["bytes_after"] = total
+        with self._lock:
+            self._tracked_bytes = total
+        self.last_stats = stats
+        return stats
+
+    def added(self, nbytes):
+        """Records that nbytes were just added to the cache."""
+        with self._lock:
+            if self._tracked_bytes is not None:
+                self._tracked_bytes += nbytes
+
+    def maybe_collect(self):
+        """
+        Starts collect() in a background thread, unless the cache is known
+        to be within its quota (from the last collection and the bytes
+        added() since) or a collection is already running. The caller
+        never waits for the scan of the cache.
+        Returns True if a collection was started.
+        """
+        with self._lock:
+            if self._collector is not None and self._collector.is_alive():
+                return False
+            if self._tracked_bytes is not None and self._tracked_bytes <= self.max_bytes:
+                return False
+
+            def run():
+                try:
+                    self.collect()
+                except Exception as e:
+                    print(f"Tile cache collection failed: {e}")
+
+            self._collector = threading.Thread(target=run, daemon=True)
+            self._collector.start()
+            return True
+
+    def wait(self, timeout=None):
+        """Waits for a collection started by maybe_collect() to finish."""
+        collector = self._collector
+        if collector is not None:
+            collector.join(timeout)
+
+    def start(self, interval=300.0):
+        """
+        Starts collecting every interval seconds in a background thread.
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.collect()
+                except Exception as e:
+                    print(f"Tile cache collection failed: {e}")
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread started by start(), if any."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+
+def parse_size(text):
+    """Parses a size such as "500M", "2G" or "1048576" into bytes."""
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    text = text.strip().upper().rstrip("B").rstrip("I")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def main():
+    import argparse
+
+    from .tilestore import DirectoryTileStore, MBTilesStore, find_tile_prefixes
+
+    parser = argparse.ArgumentParser(
+        description="Report tile cache usage and evict least recently used tiles."
+    )
+    parser.add_argument("cache", help="tile cache directory or .mbtiles file")
+    parser.add_argument(
+        "--quota", help="evict tiles beyond this size per tile server, e.g. 500M"
+    )
+    parser.add_argument(
+        "--keep-recent", type=float, default=3600,
+        help="never evict tiles used in the last this many seconds (default 3600)",
+    )
+    args = parser.parse_args()
+
+    if args.cache.endswith(".mbtiles"):
+        stores = [MBTilesStore(args.cache)]
+    else:
+        stores = [DirectoryTileStore(args.cache, p) for p in sorted(find_tile_prefixes(args.cache))]
+
+    max_bytes = parse_size(args.quota) if args.quota else float("inf")
+    for store in stores:
+        gc = TileCacheGC(store, max_bytes, keep_recent=args.keep_recent)
+        try:
+            usage = gc.usage()
+            name = getattr(store, "filename", None) or f"{args.cache} ({store.prefix})"
+            print(f"{name}: {usage['tiles']} tiles, {usage['bytes']} bytes")
+            for zoom, (tiles, nbytes) in sorted(usage["by_zoom"].items()):
+                print(f"  zoom {zoom}: {tiles} tiles, {nbytes} bytes")
+            if args.quota:
+                stats = gc.collect()
+                print(f"  evicted {stats['evicted_tiles']} tiles, {stats['evicted_bytes']} bytes")
+        finally:
+            store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""
+Tile Fetching Tool:
+  - Downloads map tiles over persistent (keep-alive) HTTP connections
+  - Fetches many tiles concurrently using a bounded pool of worker threads
+
+Basic idea:
+  1. Construct a TileFetcher, optionally choosing the number of workers.
+  2. Call fetch() to download a single tile to a local file, fetch_bytes()
+     to download it into memory, or fetch_many() to download a batch of
+     tiles; fetch_many() yields each tile as soon as it has arrived, so
+     callers can start using it while the rest of the batch is still in
+     flight.
+  3. Call close() to stop the workers and drop the pooled connections
+     when done.
+
+Each worker thread keeps one connection open per server, and the workers
+live as long as the TileFetcher, so tiles from the same tile server cost
+one TCP/TLS handshake per worker rather than one per tile, however many
+batches they are fetched in.
+"""
+
+import http.client
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
+from urllib.parse import urljoin, urlsplit
+
+USER_AGENT = "OSMViz/1.1.0 +https://hugovk.github.io/osmviz"
+
+# Errors which indicate that a pooled connection was closed by the server
+# while idle; the request is retried once on a fresh connection.
+_STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    ConnectionResetError,
+    BrokenPipeError,
+)
+
+_REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+class TileFetcher:
+    """
+    A TileFetcher downloads tiles over a pool of keep-alive HTTP
+    connections, optionally fetching many tiles at once.
+    """
+
+    def __init__(self, workers=8, timeout=30, headers=None, max_redirects=5):
+        """
+        Creates a TileFetcher.
+        Arguments:
+            workers - maximum number of tiles downloaded concurrently by
+                 fetch_many(). Default 8.
+            timeout - socket timeout, in seconds, for each request. Default 30.
+            headers - dict of extra HTTP headers sent with every request.
+            max_redirects - maximum number of redirects followed per request.
+        """
+        self.workers = max(1, int(workers))
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.headers = {"User-Agent": USER_AGENT}
+        if headers:
+            self.headers.update(headers)
+
+        self._local = threading.local()
+        self._all_connections = []
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def _get_connection(self, scheme, netloc):
+        """
+        Returns this thread's pooled connection to the given server,
+        opening one if necessary.
+        """
+        pool = getattr(self._local, "connections", None)
+        if pool is None:
+            pool = self._local.connections = {}
+
+        key = (scheme, netloc)
+        conn = pool.get(key)
+        if conn is None:
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            elif scheme == "http":
+                conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            else:
+                raise Exception(f"Unsupported URL scheme: {scheme}")
+            pool[key] = conn
+            with self._lock:
+                self._all_connections.append(conn)
+        return conn
+
+    def _drop_connection(self, scheme, netloc):
+        """Closes and forgets this thread's connection to the given server."""
+        conn = self._local.connections.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+            with self._lock:
+                if conn in self._all_connections:
+                    self._all_connections.remove(conn)
+
+    def _get_pool(self):
+        """
+        Returns the pool of worker threads used by request_many(), starting
+        it if necessary. It is kept until close(), so its threads' pooled
+        connections are reused from one batch to the next.
+        """
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="TileFetcher"
+                )
+            return self._pool
+
+    def request(self, url, headers=None):
+        """
+        Performs a GET request for the given URL over a pooled connection,
+        following redirects.
+        Returns (status, response_headers, body), where response_headers is
+        an http.client.HTTPMessage and body is a bytes object.
+        """
+        req_headers = dict(self.headers)
+        if headers:
+            req_headers.update(headers)
+
+        for _ in range(self.max_redirects + 1):
+            parts = urlsplit(url)
+            target = parts.path or "/"
+            if parts.query:
+                target = f"{target}?{parts.query}"
+
+            for attempt in range(2):
+                conn = self._get_connection(parts.scheme, parts.netloc)
+                try:
+                    conn.request("GET", target, headers=req_headers)
+                    response = conn.getresponse()
+                    body = response.read()
+                    break
+                except _STALE_CONNECTION_ERRORS:
+                    self._drop_connection(parts.scheme, parts.netloc)
+                    if attempt:
+                        raise
+                except Exception:
+                    self._drop_connection(parts.scheme, parts.netloc)
+                    raise
+
+            if response.will_close:
+                self._drop_connection(parts.scheme, parts.netloc)
+
+            location = response.getheader("Location")
+            if response.status in _REDIRECT_CODES and location:
+                url = urljoin(url, location)
+                continue
+            return response.status, response.msg, body
+
+        raise Exception(f"Too many redirects for URL: {url}")
+
+    def fetch_bytes(self, url):
+        """
+        Downloads the given URL and returns its contents as bytes.
+        """
+        status, _, body = self.request(url)
+        if status != 200:
+            raise Exception(f"HTTP {status} for URL: {url}")
+        return body
+
+    def fetch(self, url, filename):
+        """
+        Downloads the given URL to the given filename and returns the
+        filename. The file is written atomically, so a partially
+        downloaded tile is never visible under its final name.
+        """
+        write_file_atomic(filename, self.fetch_bytes(url))
+        return filename
+
+    def request_many(self, jobs):
+        """
+        Given an iterable of (key, url, headers) tuples, where headers is a
+        dict of extra request headers or None, performs all of the requests
+        using at most self.workers concurrent requests.
+        Yields (key, result) for each request as soon as it has completed,
+        in order of completion, where result is the (status, headers, body)
+        returned by request(), or the exception it raised.
+        """
+        jobs = list(jobs)
+        if not jobs:
+            return
+
+        pool = self._get_pool()
+        futures = {pool.submit(self.request, url, headers): key for key, url, headers in jobs}
+        try:
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = e
+                yield futures[future], result
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def fetch_many(self, jobs):
+        """
+        Given an iterable of (key, url) tuples, downloads all of them using
+        at most self.workers concurrent requests.
+        Yields (key, data) for each tile as soon as it has arrived, in order
+        of completion, where data is the downloaded bytes. Raises the first
+        error encountered, after cancelling the downloads which have not
+        started yet.
+        """
+        jobs = list(jobs)
+        urls = {key: url for key, url in jobs}
+        for key, result in self.request_many((key, url, None) for key, url in jobs):
+            if isinstance(result, Exception):
+                raise Exception(f"Unable to retrieve URL: {urls[key]}\n{result}")
+            status, _, body = result
+            if status != 200:
+                raise Exception(f"Unable to retrieve URL: {urls[key]}\nHTTP {status}")
+            yield key, body
+
+    def close(self):
+        """
+        Stops the worker threads and closes every connection opened by this
+        fetcher. It may still be used afterwards, opening new ones.
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+        with self._lock:
+            connections, self._all_connections = self._all_connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+
+def get_expiry(headers, now=None, default_ttl=0):
+    """
+    Given the headers of an HTTP response, returns the time (in seconds
+    since the epoch) until which the response may be considered fresh,
+    from its Cache-Control max-age or, failing that, its Expires header.
+    Responses without either stay fresh for default_ttl seconds.
+    """
+    if now is None:
+        now = time.time()
+
+    cache_control = headers.get("Cache-Control", "") if headers else ""
+    if re.search(r"\b(no-cache|no-store)\b", cache_control):
+        return now
+    match = re.search(r"\bmax-age\s*=\s*(\d+)", cache_control)
+    if match:
+        age = headers.get("Age", "0")
+        return now + int(match.group(1)) - (int(age) if age.isdigit() else 0)
+
+    expires = headers.get("Expires") if headers else None
+    if expires:
+        try:
+            return parsedate_to_datetime(expires).timestamp()
+        except (TypeError, ValueError):
+            # An invalid Expires header means "already expired"
+            return now
+
+    return now + default_ttl
+
+
+def write_file_atomic(filename, data):
+    """
+    Writes data to filename by way of a temporary file in the same
+    directory, so readers see either the old file or the complete new one.
+    """
+    tmp_name = f"{filename}.{os.getpid()}.{threading.get_ident()}.part"
+    try:
+        with open(tmp_name, "wb") as f:
+            f.write(data)
+        os.replace(tmp_name, filename)
+    except Exception:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
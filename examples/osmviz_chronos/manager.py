@@ -34,12 +34,22 @@ Basic idea:
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import asyncio
+import functools
 import hashlib
-import math
+import json
 import os
 import os.path as path
+import time
 import urllib.request
-from urllib.request import urlretrieve
+
+from .aiofetcher import AsyncTileFetcher
+from .bgcache import BackgroundCache
+from .cachegc import TileCacheGC
+from .fetcher import USER_AGENT, TileFetcher, get_expiry
+from .projection import lat_lon_to_tile, tile_to_lat_lon
+from .tilecache import RawTileCache, shared_tile_cache
+from .tilestore import DirectoryTileStore, MBTilesStore, mbtiles_filename
 
 try:
     from tqdm import tqdm
@@ -47,14 +57,39 @@ except ImportError:
     tqdm = None
 
 
+async def _run_blocking(func, *args):
+    """
+    Runs func(*args) in the event loop's default executor, so that tile
+    store I/O, decoding and scaling do not stall the loop. If cancelled,
+    waits for the call to finish before passing the cancellation on, so
+    that cleanup never races with it.
+    """
+    future = asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait([future])
+        raise
+
+
 class ImageManager:
     """
     Simple abstract interface for creating and manipulating images, to be used
     by an OSMManager object.
+
+    Decoded tiles are kept in tile_cache (by default the process-wide
+    shared_tile_cache) so that pasting the same tile again skips loading
+    and decoding its file. Set tile_cache to None to disable this.
+    If raw_tile_cache is set to a RawTileCache (see the decoded_cache
+    argument of OSMManager), decoded tiles are also kept on disk, for
+    other processes to read back instead of decoding them again. This
+    needs image_to_raw() and image_from_raw().
     """
 
     def __init__(self):
         self.image = None
+        self.tile_cache = shared_tile_cache
+        self.raw_tile_cache = None
 
     # TO BE OVERRIDDEN #
 
@@ -80,14 +115,65 @@ class ImageManager:
         """
         raise NotImplementedError
 
+    def scale_image(self, img, size):
+        """
+        To be overridden (optionally).
+        Returns a smoothly resampled copy of a loaded image with the
+        specified (width, height). Only needed to create scaled OSM images
+        (see OSMManager.create_osm_image()).
+        """
+        raise NotImplementedError
+
+    def crop_image(self, img, box):
+        """
+        To be overridden (optionally).
+        Returns the part of a loaded image within box, a (left, top, width,
+        height) rectangle in pixels. Only needed to synthesize tiles from
+        lower zoom levels (see OSMManager).
+        """
+        raise NotImplementedError
+
+    def image_nbytes(self, img):
+        """
+        To be overridden (optionally).
+        Returns the approximate number of bytes of memory used by a loaded
+        image, used to keep the decoded tile cache within its budget.
+        Default assumes a 256x256 tile with 4 bytes per pixel.
+        """
+        return 4 * 256 * 256
+
+    def image_to_raw(self, img):
+        """
+        To be overridden (optionally).
+        Returns (size, mode, pixels) for a loaded image: its (width,
+        height), its pixel format ("RGB" or "RGBA") and a bytes-like object
+        of its packed rows. Only needed for raw_tile_cache.
+        """
+        raise NotImplementedError
+
+    def image_from_raw(self, size, mode, pixels):
+        """
+        To be overridden (optionally).
+        Returns a loaded image made from what image_to_raw() returned.
+        Only needed for raw_tile_cache.
+        """
+        raise NotImplementedError
+
     # END OF TO BE OVERRIDDEN #
 
+    def get_cache_namespace(self):
+        """
+        Returns a value identifying the kind of image this manager loads,
+        so that decoded tiles are only shared between compatible managers.
+        """
+        return type(self).__name__
+
     def prepare_image(self, width, height):
         """
         Create and internally store an image whose dimensions
         are those specified by width and height.
         """
-        if self.image:
+        if self.image is not None:
             raise Exception("Image already prepared.")
         self.image = self.create_image(width, height)
 
@@ -96,17 +182,23 @@ class ImageManager:
         Destroys internal representation of the image, if it was
         ever created.
         """
-        if self.image:
+        if self.image is not None:
             del self.image
         self.image = None
 
-    def paste_image_file(self, image_file, xy):
+    def paste_image_file(self, image_file, xy, tile_key=None, size=None, box=None):
         """
         Given the filename of an image, and the x, y coordinates of the
         location at which to place the top left corner of the contents
         of that image, pastes the image into this object's internal image.
+        If box is given, only that (left, top, width, height) part of the
+        image is pasted.
+        If size is given, the image (or its part) is scaled to that
+        (width, height) before being pasted.
+        If tile_key is given, the decoded image is also stored in the
+        decoded tile cache under that key (see paste_cached_tile()).
         """
-        if not self.image:
+        if self.image is None:
             raise Exception("Image not prepared")
 
         try:
@@ -114,9 +206,78 @@ class ImageManager:
         except Exception as e:
             raise Exception(f"Could not load image {image_file}\n{e}")
 
-        self.paste_image(img, xy)
+        self.paste_image(self.fit_image(img, size, box), xy)
+        if tile_key is not None:
+            key = (self.get_cache_namespace(), *tile_key)
+            if self.tile_cache is not None:
+                self.tile_cache.put(key, img, self.image_nbytes(img))
+            if self.raw_tile_cache is not None:
+                try:
+                    self.raw_tile_cache.put(key, *self.image_to_raw(img))
+                except NotImplementedError:
+                    pass
         del img
 
+    def paste_cached_tile(self, tile_key, xy, size=None, box=None):
+        """
+        Given a tile key, typically (cache_prefix, zoom, x, y), pastes the
+        decoded tile stored under that key at the x, y coordinates of the
+        internal image, cropped to box and scaled to size if given.
+        Returns True if the tile was in the decoded tile cache, or False if
+        nothing was pasted and the tile has to be loaded from its file.
+        """
+        if self.image is None:
+            raise Exception("Image not prepared")
+
+        key = (self.get_cache_namespace(), *tile_key)
+        img = self.tile_cache.get(key) if self.tile_cache is not None else None
+        if img is None:
+            img = self.load_raw_tile(key)
+            if img is None:
+                return False
+        self.paste_image(self.fit_image(img, size, box), xy)
+        return True
+
+    def load_raw_tile(self, key):
+        """
+        Returns the decoded tile stored under key in raw_tile_cache, also
+        keeping it in tile_cache, or None if it is not there.
+        """
+        if self.raw_tile_cache is None:
+            return None
+        raw = self.raw_tile_cache.get(key)
+        if raw is None:
+            return None
+        try:
+            img = self.image_from_raw(*raw)
+        except NotImplementedError:
+            return None
+        if self.tile_cache is not None:
+            self.tile_cache.put(key, img, self.image_nbytes(img))
+        return img
+
+    def forget_tile(self, tile_key):
+        """
+        Drops the decoded tile stored under tile_key from tile_cache and
+        raw_tile_cache, e.g. because a new version of it was downloaded.
+        """
+        key = (self.get_cache_namespace(), *tile_key)
+        if self.tile_cache is not None:
+            self.tile_cache.remove(key)
+        if self.raw_tile_cache is not None:
+            self.raw_tile_cache.remove(key)
+
+    def fit_image(self, img, size, box=None):
+        """
+        Returns img cropped to box and scaled to size, or img itself if
+        both are None.
+        """
+        if box is not None:
+            img = self.crop_image(img, box)
+        if size is None:
+            return img
+        return self.scale_image(img, size)
+
     def get_image(self):
         """
         Returns some representation of the internal image. The returned value
@@ -147,6 +308,29 @@ class PygameImageManager(ImageManager):
     def paste_image(self, img, xy):
         self.get_image().blit(img, xy)
 
+    def scale_image(self, img, size):
+        if img.get_size() == tuple(size):
+            return img
+        if img.get_bitsize() not in (24, 32):
+            # smoothscale only handles 24 and 32 bit surfaces
+            rgb = self.pygame.Surface(img.get_size(), 0, 32)
+            rgb.blit(img, (0, 0))
+            img = rgb
+        return self.pygame.transform.smoothscale(img, size)
+
+    def crop_image(self, img, box):
+        return img.subsurface(self.pygame.Rect(box))
+
+    def image_nbytes(self, img):
+        return img.get_pitch() * img.get_height()
+
+    def image_to_raw(self, img):
+        mode = "RGBA" if img.get_flags() & self.pygame.SRCALPHA else "RGB"
+        return img.get_size(), mode, self.pygame.image.tostring(img, mode)
+
+    def image_from_raw(self, size, mode, pixels):
+        return self.pygame.image.frombuffer(pixels, size, mode)
+
 
 class PILImageManager(ImageManager):
     """
@@ -171,11 +355,157 @@ class PILImageManager(ImageManager):
         return self.PILImage.new(self.mode, (width, height))
 
     def load_image_file(self, image_file):
-        return self.PILImage.open(image_file)
+        img = self.PILImage.open(image_file)
+        # Decode now: PIL opens lazily, and cached tiles must not keep
+        # their file open or be decoded again on every paste.
+        img.load()
+        return img
 
     def paste_image(self, img, xy):
         self.get_image().paste(img, xy)
 
+    def scale_image(self, img, size):
+        if img.size == tuple(size):
+            return img
+        if img.mode != self.mode:
+            img = img.convert(self.mode)
+        return img.resize(size, self.PILImage.LANCZOS)
+
+    def crop_image(self, img, box):
+        left, top, width, height = box
+        return img.crop((left, top, left + width, top + height))
+
+    def image_nbytes(self, img):
+        return img.width * img.height * len(img.getbands())
+
+    def image_to_raw(self, img):
+        if img.mode not in ("RGB", "RGBA"):
+            has_alpha = "A" in img.getbands() or "transparency" in img.info
+            img = img.convert("RGBA" if has_alpha else "RGB")
+        return img.size, img.mode, img.tobytes()
+
+    def image_from_raw(self, size, mode, pixels):
+        return self.PILImage.frombytes(mode, size, pixels)
+
+    def get_cache_namespace(self):
+        return (type(self).__name__, self.mode)
+
+
+class NumpyImageManager(ImageManager):
+    """
+    An ImageManager which works with NumPy arrays of RGB pixels, with shape
+    (height, width, 3) and dtype uint8.
+    Tiles are decoded and copied once, straight into their slice of the
+    preallocated image, so stitching and any color operations are plain
+    array operations. The image can be wrapped in a Pygame Surface
+    without copying (see get_surface()), saved to a BackgroundCache as it
+    is, or handed to a PygameStreamer with pix_fmt="rgb24". Simulation
+    builds its map backgrounds with it.
+    """
+
+    def __init__(self, decoder=None):
+        """
+        Constructs a NumPy Image Manager.
+        Arguments:
+            decoder - "pil" or "pygame", the library used to decode and
+                 scale tiles. Default is PIL if it can be imported,
+                 otherwise Pygame.
+        """
+        ImageManager.__init__(self)
+        try:
+            import numpy
+        except ImportError:
+            raise Exception("NumPy could not be imported!")
+        self.np = numpy
+
+        if decoder is None:
+            try:
+                import PIL.Image  # noqa: F401
+
+                decoder = "pil"
+            except ImportError:
+                decoder = "pygame"
+
+        if decoder == "pil":
+            try:
+                import PIL.Image
+            except ImportError:
+                raise Exception("PIL could not be imported!")
+            self.PILImage = PIL.Image
+        elif decoder == "pygame":
+            try:
+                import pygame
+            except ImportError:
+                raise Exception("Pygame could not be imported!")
+            self.pygame = pygame
+        else:
+            raise Exception(f"Unknown decoder {decoder!r}, use pil or pygame.")
+        self.decoder = decoder
+
+    def create_image(self, width, height):
+        return self.np.zeros((height, width, 3), dtype=self.np.uint8)
+
+    def load_image_file(self, image_file):
+        if self.decoder == "pil":
+            with self.PILImage.open(image_file) as img:
+                return self.np.asarray(img.convert("RGB"))
+
+        surf = self.pygame.image.load(image_file)
+        if surf.get_bitsize() not in (24, 32):
+            rgb = self.pygame.Surface(surf.get_size(), 0, 32)
+            rgb.blit(surf, (0, 0))
+            surf = rgb
+        # A view of the decoded Surface's pixels, which it keeps alive
+        return self.pygame.surfarray.pixels3d(surf).swapaxes(0, 1)
+
+    def paste_image(self, img, xy):
+        x, y = xy
+        height, width = self.image.shape[:2]
+        # Clip the tile to the image, as blit() and paste() do
+        x0, y0 = max(x, 0), max(y, 0)
+        x1 = min(x + img.shape[1], width)
+        y1 = min(y + img.shape[0], height)
+        if x0 < x1 and y0 < y1:
+            self.image[y0:y1, x0:x1] = img[y0 - y : y1 - y, x0 - x : x1 - x]
+
+    def scale_image(self, img, size):
+        width, height = size
+        if img.shape[1] == width and img.shape[0] == height:
+            return img
+        if self.decoder == "pil":
+            scaled = self.PILImage.fromarray(img).resize(size, self.PILImage.LANCZOS)
+            return self.np.asarray(scaled)
+
+        img = self.np.ascontiguousarray(img)
+        surf = self.pygame.image.frombuffer(img, (img.shape[1], img.shape[0]), "RGB")
+        scaled = self.pygame.transform.smoothscale(surf, size)
+        return self.pygame.surfarray.pixels3d(scaled).swapaxes(0, 1)
+
+    def crop_image(self, img, box):
+        left, top, width, height = box
+        return img[top : top + height, left : left + width]
+
+    def image_nbytes(self, img):
+        return img.nbytes
+
+    def image_to_raw(self, img):
+        height, width = img.shape[:2]
+        return (width, height), "RGB", self.np.ascontiguousarray(img).tobytes()
+
+    def image_from_raw(self, size, mode, pixels):
+        width, height = size
+        return self.np.frombuffer(pixels, dtype=self.np.uint8).reshape(height, width, 3)
+
+    def get_surface(self):
+        """
+        Returns a Pygame Surface sharing the pixels of the internal image.
+        The image must not be destroyed while the Surface is in use.
+        """
+        import pygame
+
+        height, width = self.image.shape[:2]
+        return pygame.image.frombuffer(self.image, (width, height), "RGB")
+
 
 class OSMManager:
     """
@@ -214,12 +544,90 @@ class OSMManager:
 
         image_manager - ImageManager instance which will be used to do all
                             image manipulation. You must provide this.
+
+        workers - Maximum number of tiles downloaded concurrently when
+                    several tiles are missing from the cache. Downloads
+                    reuse keep-alive connections to the tile server.
+                    Default 8.
+
+        tile_store - Where downloaded tiles are kept: "directory" to keep one
+                    file per tile in the cache directory, "mbtiles" to keep
+                    them in one MBTiles (SQLite) file in the cache directory,
+                    or a TileStore instance.
+                    Default "directory".
+
+        offline - If True, never contact the tile server: cached tiles are
+                    used however old they are, and missing tiles raise an
+                    exception. Default False.
+
+        tile_ttl - Number of seconds a downloaded tile stays fresh when the
+                    tile server does not say (via Cache-Control or Expires).
+                    Stale tiles are revalidated with a conditional request,
+                    so unchanged tiles are not downloaded again. Tiles cached
+                    before freshness metadata was recorded count as fresh.
+                    Default 7 days.
+
+        negative_ttl - Number of seconds a failed download is remembered,
+                    during which the tile is not requested again. Also how
+                    long a stale tile keeps being used after a failed
+                    revalidation. Default 1 hour.
+
+        cache_quota - Maximum number of bytes of the cache directory: the
+                    tile store, cached backgrounds, decoded tiles and every
+                    other file in it (such as the freshness metadata).
+                    After create_osm_image(), if the cache may be over
+                    quota, the least recently used tiles, backgrounds and
+                    decoded tiles are evicted to stay within it, except
+                    those used by this OSMManager's images or, in any
+                    process, within the last hour. This runs in a
+                    background thread (see TileCacheGC.maybe_collect()).
+                    When no usable cache directory was given, only the
+                    tiles, backgrounds and decoded tiles are counted.
+                    Default None (no limit).
+
+        backgrounds - If True, keep a BackgroundCache (see bgcache.py) in the
+                    "backgrounds" directory of the cache directory, as
+                    background_cache, for callers to save finished images
+                    in. Default False.
+
+        synthesize - If True, create_osm_image() does not download tiles
+                    missing from the tile store when it can make them from
+                    stored tiles of other zoom levels instead: the four
+                    tiles one zoom level up, scaled down, or the matching
+                    part of a tile up to synthesize_levels zoom levels
+                    down, scaled up. The image manager must implement
+                    scale_image() and crop_image(). After each image,
+                    synthesized_tiles is the number of tiles synthesized;
+                    an image with any should not be cached for good.
+                    Default False.
+
+        synthesize_levels - Number of zoom levels down to look for a tile
+                    to scale up when synthesizing. Each level halves the
+                    resolution. Default 3.
+
+        decoded_cache - Maximum number of bytes of decoded tiles to keep on
+                    disk, in the "decoded" directory of the cache directory,
+                    so that other processes using the same cache read them
+                    back rather than decoding their PNGs again. Tiles are
+                    kept for at most tile_ttl. The image manager must
+                    implement image_to_raw() and image_from_raw(). Default
+                    None (decoded tiles are only kept in memory).
         """
         cache = kwargs.get("cache")
         server = kwargs.get("server")
         url = kwargs.get("url")
         scale = kwargs.get("scale")
         mgr = kwargs.get("image_manager")
+        workers = kwargs.get("workers") or 8
+        tile_store = kwargs.get("tile_store") or "directory"
+        self.offline = bool(kwargs.get("offline"))
+        self.tile_ttl = kwargs.get("tile_ttl", 7 * 24 * 3600)
+        self.negative_ttl = kwargs.get("negative_ttl", 3600)
+        cache_quota = kwargs.get("cache_quota")
+        self.synthesize = bool(kwargs.get("synthesize"))
+        self.synthesize_levels = kwargs.get("synthesize_levels", 3)
+        decoded_cache = kwargs.get("decoded_cache")
+        backgrounds = kwargs.get("backgrounds")
 
         self.cache = None
 
@@ -281,21 +689,60 @@ class OSMManager:
         else:
             raise Exception("OSMManager.__init__ requires argument image_manager")
 
+        self.fetcher = TileFetcher(workers=workers)
+
+        if tile_store == "directory":
+            self.tile_store = DirectoryTileStore(self.cache, self.cache_prefix)
+        elif tile_store == "mbtiles":
+            self.tile_store = MBTilesStore(
+                mbtiles_filename(self.cache, self.cache_prefix), name=self.cache_prefix
+            )
+        elif isinstance(tile_store, str):
+            raise Exception(f"Unknown tile_store {tile_store!r}, use directory or mbtiles.")
+        else:  # Assume it's a valid TileStore
+            self.tile_store = tile_store
+
+        if backgrounds:
+            self.background_cache = BackgroundCache(path.join(self.cache, "backgrounds"))
+        else:
+            self.background_cache = None
+
+        if decoded_cache and self.manager.raw_tile_cache is None:
+            self.manager.raw_tile_cache = RawTileCache(
+                path.join(self.cache, "decoded"), decoded_cache, self.tile_ttl
+            )
+
+        if cache_quota:
+            self.cache_gc = TileCacheGC(
+                self.tile_store,
+                cache_quota,
+                background_cache=self.background_cache,
+                raw_tile_cache=self.manager.raw_tile_cache,
+                # A fallback such as /tmp holds other programs' files too
+                directory=self.cache if self.cache == cache else None,
+            )
+        else:
+            self.cache_gc = None
+
+        # Number of tiles of the last image synthesized from other zoom
+        # levels rather than downloaded: such an image is provisional
+        self.synthesized_tiles = 0
+
+    def close(self):
+        """
+        Closes the tile fetcher's worker threads and connections. The
+        OSMManager may still be used afterwards, opening new ones.
+        """
+        self.fetcher.close()
+
     def get_tile_coord(self, lon_deg, lat_deg, zoom):
         """
         Given lon, lat coords in DEGREES, and a zoom level,
         returns the (x, y) coordinate of the corresponding tile #.
         (https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames#Python)
+        Also accepts NumPy arrays of coords, returning arrays of tile #s.
         """
-        lat_rad = lat_deg * math.pi / 180.0
-        n = 2.0**zoom
-        xtile = int((lon_deg + 180.0) / 360.0 * n)
-        ytile = int(
-            (1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi)
-            / 2.0
-            * n
-        )
-        return xtile, ytile
+        return lat_lon_to_tile(lat_deg, lon_deg, zoom)
 
     def get_tile_url(self, tile_coord, zoom):
         """
@@ -315,20 +762,224 @@ class OSMManager:
             self.cache, f"{self.cache_prefix}{zoom}_{tile_coord[0]}_{tile_coord[1]}.png"
         )
 
+    def check_tile(self, tile_coord, zoom, source, meta, now=None):
+        """
+        Given x, y coord of a tile, the zoom level, its source in the tile
+        store (or None) and its freshness metadata (or None), returns
+        "fresh" if the stored tile can be used as it is, "stale" if it
+        should be revalidated with the tile server first, or "missing" if
+        it must be downloaded.
+        Raises an exception if the tile cannot be had: it is missing while
+        offline, or its last download failed less than negative_ttl ago.
+        """
+        if now is None:
+            now = time.time()
+        expires = meta.get("expires") if meta else None
+
+        if source is not None:
+            if self.offline or expires is None or expires > now:
+                return "fresh"
+            return "stale"
+
+        x, y = tile_coord
+        if self.offline:
+            raise Exception(f"Tile {zoom}/{x}/{y} is not cached and OSMManager is offline.")
+        if meta and meta.get("status") != 200 and expires and expires > now:
+            raise Exception(
+                f"Tile {zoom}/{x}/{y} could not be retrieved "
+                f"(status {meta.get('status')}), not retrying for {int(expires - now)}s."
+            )
+        return "missing"
+
+    def get_tile_request_headers(self, meta):
+        """
+        Given the freshness metadata of a stored tile, returns the headers
+        making a request for it conditional, or None.
+        """
+        headers = {}
+        if meta and meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta and meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers or None
+
+    def store_tile_response(self, tile_coord, zoom, source, meta, result, now=None):
+        """
+        Given x, y coord of a tile, the zoom level, its previous source and
+        metadata (or None), and the result of requesting it (a (status,
+        headers, body) tuple or an exception), updates the tile store and
+        returns the tile's source.
+        A 304 response keeps the stored tile and only refreshes its expiry.
+        If the request failed, a stale tile keeps being used; a missing
+        tile is negatively cached and an exception is raised.
+        """
+        if now is None:
+            now = time.time()
+        x, y = tile_coord
+
+        if isinstance(result, Exception) or result[0] not in (200, 304):
+            if isinstance(result, Exception):
+                status, reason = 0, result
+            else:
+                status, reason = result[0], f"HTTP {result[0]}"
+            if source is not None:
+                # Keep using the stale tile, and wait before trying again
+                meta = dict(meta, fetched=now, expires=now + self.negative_ttl)
+                self.tile_store.put_tile_meta(zoom, x, y, meta)
+                return source
+            meta = {"fetched": now, "expires": now + self.negative_ttl, "status": status}
+            self.tile_store.put_tile_meta(zoom, x, y, meta)
+            url = self.get_tile_url(tile_coord, zoom)
+            raise Exception(f"Unable to retrieve URL: {url}\n{reason}")
+
+        status, headers, body = result
+        old_meta = meta or {}
+        meta = {
+            "fetched": now,
+            "expires": get_expiry(headers, now, self.tile_ttl),
+            "etag": headers.get("ETag") or old_meta.get("etag"),
+            "last_modified": headers.get("Last-Modified") or old_meta.get("last_modified"),
+            "status": 200,
+        }
+        if status == 200 or source is None:
+            source = self.tile_store.put_tile(zoom, x, y, body)
+            if self.cache_gc:
+                self.cache_gc.added(len(body))
+            # Decoded copies of the previous version are out of date
+            self.manager.forget_tile((self.cache_prefix, zoom, x, y))
+        self.tile_store.put_tile_meta(zoom, x, y, meta)
+        return source
+
     def retrieve_tile_image(self, tile_coord, zoom):
         """
         Given x, y coord of the tile, and the zoom level,
-        retrieves the file to disk if necessary and
-        returns the local filename.
+        retrieves the tile into the tile store if necessary and
+        returns its source: the local filename, or a file-like
+        object for stores which do not keep tiles as files.
+        Stale tiles are revalidated first (see check_tile()).
         """
-        filename = self.get_local_tile_filename(tile_coord, zoom)
-        if not path.isfile(filename):
-            url = self.get_tile_url(tile_coord, zoom)
+        x, y = tile_coord
+        source = self.tile_store.get_tile_source(zoom, x, y)
+        meta = self.tile_store.get_tile_meta(zoom, x, y)
+        state = self.check_tile(tile_coord, zoom, source, meta)
+        if state == "fresh":
+            return source
+
+        headers = self.get_tile_request_headers(meta) if state == "stale" else None
+        try:
+            result = self.fetcher.request(self.get_tile_url(tile_coord, zoom), headers)
+        except Exception as e:
+            result = e
+        return self.store_tile_response(tile_coord, zoom, source, meta, result)
+
+    def retrieve_tile_images(self, tile_coords, zoom):
+        """
+        Given a collection of x, y tile coords and the zoom level,
+        retrieves every tile missing from the tile store, or stale,
+        making up to fetcher.workers requests concurrently.
+        Yields (tile_coord, source) for each tile as soon as it is
+        available: fresh stored tiles first, then the others in the order
+        in which their requests complete. See retrieve_tile_image() for
+        sources.
+        """
+        tile_coords = list(tile_coords)
+        sources = self.tile_store.get_tile_sources(zoom, tile_coords)
+        metas = self.tile_store.get_tile_metas(zoom, tile_coords)
+        now = time.time()
+
+        jobs = []
+        for tile_coord in tile_coords:
+            source, meta = sources.get(tile_coord), metas.get(tile_coord)
+            state = self.check_tile(tile_coord, zoom, source, meta, now)
+            if state == "fresh":
+                yield tile_coord, source
+            else:
+                headers = self.get_tile_request_headers(meta) if state == "stale" else None
+                jobs.append((tile_coord, self.get_tile_url(tile_coord, zoom), headers))
+
+        for tile_coord, result in self.fetcher.request_many(jobs):
+            yield tile_coord, self.store_tile_response(
+                tile_coord, zoom, sources.get(tile_coord), metas.get(tile_coord), result
+            )
+
+    async def retrieve_tile_image_async(self, tile_coord, zoom, fetcher):
+        """
+        Asynchronous version of retrieve_tile_image(), requesting the tile
+        (if necessary) through the given AsyncTileFetcher. The tile store is
+        used from the loop's default executor.
+        """
+        x, y = tile_coord
+
+        def lookup():
+            return self.tile_store.get_tile_source(zoom, x, y), self.tile_store.get_tile_meta(zoom, x, y)
+
+        source, meta = await _run_blocking(lookup)
+        state = self.check_tile(tile_coord, zoom, source, meta)
+        if state == "fresh":
+            return source
+
+        headers = self.get_tile_request_headers(meta) if state == "stale" else None
+        try:
+            result = await fetcher.request(self.get_tile_url(tile_coord, zoom), headers)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            result = e
+        return await _run_blocking(self.store_tile_response, tile_coord, zoom, source, meta, result)
+
+    async def retrieve_tile_images_async(self, tile_coords, zoom, fetcher):
+        """
+        Asynchronous version of retrieve_tile_images(): an async generator
+        yielding (tile_coord, source) for each tile as soon as it is
+        available, with the requests running concurrently on the event
+        loop through the given AsyncTileFetcher. Requests still pending
+        when the generator is closed or cancelled are cancelled. The tile
+        store is used from the loop's default executor.
+        """
+        tile_coords = list(tile_coords)
+
+        def lookup():
+            return (
+                self.tile_store.get_tile_sources(zoom, tile_coords),
+                self.tile_store.get_tile_metas(zoom, tile_coords),
+            )
+
+        sources, metas = await _run_blocking(lookup)
+        now = time.time()
+
+        async def request(tile_coord, url, headers):
             try:
-                urlretrieve(url, filename=filename)
+                return tile_coord, await fetcher.request(url, headers)
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
-                raise Exception(f"Unable to retrieve URL: {url}\n{e}")
-        return filename
+                return tile_coord, e
+
+        tasks = []
+        try:
+            for tile_coord in tile_coords:
+                source, meta = sources.get(tile_coord), metas.get(tile_coord)
+                state = self.check_tile(tile_coord, zoom, source, meta, now)
+                if state == "fresh":
+                    yield tile_coord, source
+                else:
+                    headers = self.get_tile_request_headers(meta) if state == "stale" else None
+                    url = self.get_tile_url(tile_coord, zoom)
+                    tasks.append(asyncio.ensure_future(request(tile_coord, url, headers)))
+
+            for next_done in asyncio.as_completed(tasks):
+                tile_coord, result = await next_done
+                yield tile_coord, await _run_blocking(
+                    self.store_tile_response,
+                    tile_coord,
+                    zoom,
+                    sources.get(tile_coord),
+                    metas.get(tile_coord),
+                    result,
+                )
+        finally:
+            for task in tasks:
+                task.cancel()
 
     def tile_nw_lat_lon(self, tile_coord, zoom):
         """
@@ -337,13 +988,36 @@ class OSMManager:
         left corner of the tile.
         """
         x_tile, y_tile = tile_coord
-        n = 2.0**zoom
-        lon_deg = x_tile / n * 360.0 - 180.0
-        lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * y_tile / n)))
-        lat_deg = lat_rad * 180.0 / math.pi
-        return lat_deg, lon_deg
+        return tile_to_lat_lon(x_tile, y_tile, zoom)
+
+    def get_image_version(self, bounds, zoom):
+        """
+        Given bounding lat_lons (in degrees) and an OSM zoom level, returns
+        a digest of the versions (ETags, or else download times) of the
+        stored tiles which create_osm_image() would use, so an image made
+        from them can be cached under it and is rebuilt whenever one of
+        them is downloaded again.
+        Returns None if any of the tiles is missing, or stale and due for
+        revalidation: an image made now would not be from fresh tiles.
+        """
+        layout = OSMImageLayout(self, bounds, zoom)
+        stored = self.tile_store.get_stored_tiles(zoom, layout.tile_coords)
+        metas = self.tile_store.get_tile_metas(zoom, layout.tile_coords)
+        now = time.time()
+
+        versions = []
+        for tile_coord in layout.tile_coords:
+            meta = metas.get(tile_coord)
+            if not self._is_fresh(tile_coord, zoom, tile_coord in stored, meta, now):
+                return None
+            meta = meta or {}
+            versions.append([*tile_coord, meta.get("etag") or meta.get("fetched")])
 
-    def create_osm_image(self, bounds, zoom):
+        md5 = hashlib.md5()
+        md5.update(json.dumps([self.cache_prefix, zoom, versions]).encode("utf-8"))
+        return md5.hexdigest()
+
+    def create_osm_image(self, bounds, zoom, size=None):
         """
         Given bounding lat_lons (in degrees), and an OSM zoom level,
         creates an image constructed from OSM tiles.
@@ -351,45 +1025,356 @@ class OSMManager:
         by the image manager's "get_image()" method),
         and bounds is the (min_lat, max_lat, min_lon, max_lon) bounding box
         which the tiles cover.
+
+        If size (width, height) is given, the image is instead made as large
+        as fits within size while keeping the proportions of the tiles, and
+        each tile is scaled straight into its place. Memory use is then
+        bounded by size rather than by the zoom level, and the image
+        manager must implement scale_image().
+        """
+        layout = self.start_osm_image(bounds, zoom, size)
+        uncached = self.paste_cached_tiles(layout)
+        if self.synthesize:
+            uncached = self.paste_synthesized_tiles(layout, uncached)
+        for tile_coord, source in self.retrieve_tile_images(uncached, zoom):
+            self.paste_tile(layout, tile_coord, source)
+        return self.finish_osm_image(layout)
+
+    async def create_osm_image_async(
+        self, bounds, zoom, size=None, concurrency=8, timeout=None, fetcher=None
+    ):
+        """
+        Asynchronous version of create_osm_image(), for use on an asyncio
+        event loop. Tiles are requested concurrently on the loop, with at
+        most concurrency requests in flight, and pasted as they arrive.
+        Arguments are as for create_osm_image(), plus:
+            concurrency - maximum number of tile requests in flight, when
+                 no fetcher is given. Default 8.
+            timeout - maximum number of seconds for the whole image, or
+                 None for no limit. asyncio.TimeoutError is raised if it
+                 takes longer.
+            fetcher - AsyncTileFetcher to use, so that several images can
+                 share one connection pool. By default a new one is made
+                 and closed when done.
+        Tile store I/O, decoding, pasting and cache collection run in the
+        loop's default executor, so the loop is never blocked by them.
+        If the image cannot be completed (error, timeout or cancellation)
+        the partial image is destroyed, the progress report closed and
+        pending requests are cancelled.
+        Each OSMManager builds one image at a time, so concurrent images
+        need their own OSMManager and ImageManager.
+        """
+        own_fetcher = fetcher is None
+        if own_fetcher:
+            fetcher = AsyncTileFetcher(max_connections=concurrency)
+        layout = None
+
+        async def build():
+            nonlocal layout
+            layout = self.start_osm_image(bounds, zoom, size)
+            uncached = await _run_blocking(self.paste_cached_tiles, layout)
+            if self.synthesize:
+                uncached = await _run_blocking(self.paste_synthesized_tiles, layout, uncached)
+            async for tile_coord, source in self.retrieve_tile_images_async(
+                uncached, zoom, fetcher
+            ):
+                await _run_blocking(self.paste_tile, layout, tile_coord, source)
+            return await _run_blocking(self.finish_osm_image, layout)
+
+        try:
+            return await asyncio.wait_for(build(), timeout)
+        except BaseException:
+            if layout is not None and layout.pbar:
+                layout.pbar.close()
+            self.manager.destroy_image()
+            raise
+        finally:
+            if own_fetcher:
+                await fetcher.close()
+
+    def start_osm_image(self, bounds, zoom, size=None):
+        """
+        First step of create_osm_image(): works out which tiles cover the
+        bounds and where each goes, prepares the image manager's image and
+        starts the progress report.
+        Returns an OSMImageLayout to be passed to the following steps.
         """
-        (min_lat, max_lat, min_lon, max_lon) = bounds
         if not self.manager:
             raise Exception("No ImageManager was specified, cannot create image.")
 
-        topleft = min_x, min_y = self.get_tile_coord(min_lon, max_lat, zoom)
-        max_x, max_y = self.get_tile_coord(max_lon, min_lat, zoom)
-        new_max_lat, new_min_lon = self.tile_nw_lat_lon(topleft, zoom)
-        new_min_lat, new_max_lon = self.tile_nw_lat_lon((max_x + 1, max_y + 1), zoom)
-        pix_width = (max_x - min_x + 1) * self.tile_size
-        pix_height = (max_y - min_y + 1) * self.tile_size
-        self.manager.prepare_image(pix_width, pix_height)
-        total = (1 + max_x - min_x) * (1 + max_y - min_y)
+        layout = OSMImageLayout(self, bounds, zoom, size)
+        self.manager.prepare_image(*layout.size)
 
+        total = len(layout.tile_coords)
         if tqdm:
-            pbar = tqdm(desc="Fetching tiles", total=total, unit="tile")
+            layout.pbar = tqdm(desc="Fetching tiles", total=total, unit="tile")
         else:
             print(f"Fetching {total} tiles...")
+        return layout
 
-        for x in range(min_x, max_x + 1):
-            for y in range(min_y, max_y + 1):
-                f_name = self.retrieve_tile_image((x, y), zoom)
-                x_off = self.tile_size * (x - min_x)
-                y_off = self.tile_size * (y - min_y)
-                self.manager.paste_image_file(f_name, (x_off, y_off))
-                if tqdm:
-                    pbar.update()
-        if tqdm:
-            pbar.close()
+    def paste_cached_tiles(self, layout):
+        """
+        Pastes the tiles of layout which are still decoded in memory, as
+        long as the stored tile they were decoded from is fresh (see
+        check_tile()); stale tiles are left to be revalidated.
+        Returns the coords of the remaining tiles, which have to be
+        retrieved from the tile store (or downloaded).
+        """
+        zoom = layout.zoom
+        stored = self.tile_store.get_stored_tiles(zoom, layout.tile_coords)
+        metas = self.tile_store.get_tile_metas(zoom, layout.tile_coords)
+        now = time.time()
+
+        uncached = []
+        for x, y in layout.tile_coords:
+            xy, tile_size = layout.placement(x, y)
+            tile_key = (self.cache_prefix, zoom, x, y)
+            if tile_size and 0 in tile_size:
+                # Scaled down to nothing, no need to fetch it
+                pass
+            elif not self._is_fresh((x, y), zoom, (x, y) in stored, metas.get((x, y)), now):
+                uncached.append((x, y))
+                continue
+            elif not self.manager.paste_cached_tile(tile_key, xy, tile_size):
+                uncached.append((x, y))
+                continue
+            if layout.pbar:
+                layout.pbar.update()
+        return uncached
+
+    def _is_fresh(self, tile_coord, zoom, stored, meta, now):
+        """
+        Returns whether the stored tile at tile_coord and zoom can be used
+        as it is, given whether it is stored and its metadata.
+        """
+        # check_tile() only needs to know whether there is a source
+        try:
+            return self.check_tile(tile_coord, zoom, True if stored else None, meta, now) == "fresh"
+        except Exception:
+            return False
+
+    def paste_synthesized_tiles(self, layout, tile_coords):
+        """
+        For each tile of tile_coords missing from the tile store, pastes a
+        tile synthesized from stored tiles of other zoom levels (see the
+        synthesize argument of OSMManager). Tiles in the tile store, even
+        stale ones, are left to be retrieved as usual.
+        Returns the coords of the tiles which still have to be retrieved.
+        """
+        zoom = layout.zoom
+        stored = self.tile_store.get_stored_tiles(zoom, tile_coords)
+        missing = [c for c in tile_coords if c not in stored]
+        remaining = [c for c in tile_coords if c in stored]
+        if not missing:
+            return remaining
+
+        # Scale down the four tiles one zoom level up, if all are stored
+        children = [
+            (2 * x + i, 2 * y + j) for x, y in missing for i in (0, 1) for j in (0, 1)
+        ]
+        child_sources = self.tile_store.get_tile_sources(zoom + 1, children)
+        unsynthesized = []
+        for x, y in missing:
+            quad = [(2 * x + i, 2 * y + j) for i in (0, 1) for j in (0, 1)]
+            if all(c in child_sources for c in quad) and self._paste_children(
+                layout, (x, y), [(c, child_sources[c]) for c in quad]
+            ):
+                layout.source_tiles.setdefault(zoom + 1, []).extend(quad)
+                layout.synthesized += 1
+                if layout.pbar:
+                    layout.pbar.update()
+            else:
+                unsynthesized.append((x, y))
+
+        # Scale up part of the nearest stored tile further down
+        for levels in range(1, min(self.synthesize_levels, zoom) + 1):
+            if not unsynthesized:
+                break
+            missing, unsynthesized = unsynthesized, []
+            ancestors = {(x >> levels, y >> levels) for x, y in missing}
+            sources = self.tile_store.get_tile_sources(zoom - levels, ancestors)
+            for x, y in missing:
+                ancestor = (x >> levels, y >> levels)
+                if ancestor in sources and self._paste_ancestor_part(
+                    layout, (x, y), levels, ancestor, sources[ancestor]
+                ):
+                    layout.source_tiles.setdefault(zoom - levels, []).append(ancestor)
+                    layout.synthesized += 1
+                    if layout.pbar:
+                        layout.pbar.update()
+                else:
+                    unsynthesized.append((x, y))
+
+        return remaining + unsynthesized
+
+    def _paste_tile_part(self, zoom, tile_coord, source, xy, size, box=None):
+        """
+        Pastes the stored tile at tile_coord and zoom, cropped to box and
+        scaled to size, preferring its decoded copy if cached.
+        Returns False if the tile could not be loaded.
+        """
+        tile_key = (self.cache_prefix, zoom, *tile_coord)
+        if self.manager.paste_cached_tile(tile_key, xy, size, box):
+            return True
+        try:
+            self.manager.paste_image_file(source, xy, tile_key=tile_key, size=size, box=box)
+        except Exception as e:
+            print(f"Could not synthesize tile from {zoom}/{tile_coord}: {e}")
+            return False
+        return True
+
+    def _paste_children(self, layout, tile_coord, children):
+        """
+        Pastes the four (child_coord, source) tiles one zoom level up from
+        tile_coord, each scaled into its quarter of the tile's place.
+        """
+        (left, top), size = layout.placement(*tile_coord)
+        width, height = size or (self.tile_size, self.tile_size)
+        for (cx, cy), source in children:
+            i, j = cx & 1, cy & 1
+            x0, x1 = i * width // 2, (i + 1) * width // 2
+            y0, y1 = j * height // 2, (j + 1) * height // 2
+            if not self._paste_tile_part(
+                layout.zoom + 1, (cx, cy), source, (left + x0, top + y0), (x1 - x0, y1 - y0)
+            ):
+                return False
+        return True
+
+    def _paste_ancestor_part(self, layout, tile_coord, levels, ancestor, source):
+        """
+        Pastes the part of the tile levels zoom levels down (ancestor) which
+        covers tile_coord, scaled up into the tile's place.
+        """
+        xy, size = layout.placement(*tile_coord)
+        n = 1 << levels
+        i, j = tile_coord[0] & (n - 1), tile_coord[1] & (n - 1)
+        left, right = i * self.tile_size // n, (i + 1) * self.tile_size // n
+        top, bottom = j * self.tile_size // n, (j + 1) * self.tile_size // n
+        box = (left, top, right - left, bottom - top)
+        return self._paste_tile_part(
+            layout.zoom - levels,
+            ancestor,
+            source,
+            xy,
+            size or (self.tile_size, self.tile_size),
+            box,
+        )
+
+    def paste_tile(self, layout, tile_coord, source):
+        """
+        Loads a retrieved tile from its source and pastes it into its place
+        in the image. A tile revalidated as unchanged is pasted from its
+        decoded copy, if there is one.
+        """
+        x, y = tile_coord
+        xy, tile_size = layout.placement(x, y)
+        tile_key = (self.cache_prefix, layout.zoom, x, y)
+        if not self.manager.paste_cached_tile(tile_key, xy, tile_size):
+            self.manager.paste_image_file(source, xy, tile_key=tile_key, size=tile_size)
+        if layout.pbar:
+            layout.pbar.update()
+
+    def finish_osm_image(self, layout):
+        """
+        Last step of create_osm_image(): ends the progress report, records
+        the use of the tiles and returns (img, bounds).
+        """
+        self.synthesized_tiles = layout.synthesized
+        if layout.pbar:
+            layout.pbar.close()
         else:
             print("... done.")
-        return (
-            self.manager.get_image(),
-            (new_min_lat, new_max_lat, new_min_lon, new_max_lon),
+
+        used_tiles = dict(layout.source_tiles)
+        used_tiles.setdefault(layout.zoom, []).extend(layout.tile_coords)
+        for zoom, tile_coords in used_tiles.items():
+            self.tile_store.touch_tiles(zoom, tile_coords)
+            if self.cache_gc:
+                # Never evict the tiles of an image this manager has made
+                self.cache_gc.pin(zoom, tile_coords)
+        if self.cache_gc:
+            self.cache_gc.maybe_collect()
+        return self.manager.get_image(), layout.bounds
+
+
+class OSMImageLayout:
+    """
+    Describes how an OSM image is put together from tiles: which tiles
+    cover the requested bounds, the bounds they actually cover, and where
+    each tile goes in the (possibly scaled) image.
+    Tiles of other zoom levels used to synthesize missing tiles are
+    recorded in source_tiles, a {zoom: [tile_coord, ...]} dict, and the
+    number of tiles synthesized in synthesized.
+    """
+
+    def __init__(self, osm, bounds, zoom, size=None):
+        """
+        Given an OSMManager, bounding lat_lons (in degrees), an OSM zoom
+        level and optionally a maximum image size, lays out the image as
+        described in OSMManager.create_osm_image().
+        """
+        (min_lat, max_lat, min_lon, max_lon) = bounds
+        self.zoom = zoom
+        self.tile_size = osm.tile_size
+        self.scaled = bool(size)
+        self.pbar = None
+        self.source_tiles = {}
+        self.synthesized = 0
+
+        topleft = self.min_x, self.min_y = osm.get_tile_coord(min_lon, max_lat, zoom)
+        self.max_x, self.max_y = osm.get_tile_coord(max_lon, min_lat, zoom)
+        new_max_lat, new_min_lon = osm.tile_nw_lat_lon(topleft, zoom)
+        new_min_lat, new_max_lon = osm.tile_nw_lat_lon((self.max_x + 1, self.max_y + 1), zoom)
+        self.bounds = (new_min_lat, new_max_lat, new_min_lon, new_max_lon)
+
+        self.pix_size = (
+            (self.max_x - self.min_x + 1) * self.tile_size,
+            (self.max_y - self.min_y + 1) * self.tile_size,
         )
+        self.size = fit_size(self.pix_size, size) if size else self.pix_size
+        self.tile_coords = [
+            (x, y)
+            for x in range(self.min_x, self.max_x + 1)
+            for y in range(self.min_y, self.max_y + 1)
+        ]
+
+    def placement(self, x, y):
+        """
+        Returns ((x_off, y_off), size) for the tile with the given coords:
+        the offset of its top left corner in the image, and the size to
+        scale it to, or None if the image is not scaled.
+        """
+        x_off = self.tile_size * (x - self.min_x)
+        y_off = self.tile_size * (y - self.min_y)
+        if not self.scaled:
+            return (x_off, y_off), None
+        # Round both edges of the tile so neighbours meet exactly
+        pix_width, pix_height = self.pix_size
+        out_width, out_height = self.size
+        left = x_off * out_width // pix_width
+        top = y_off * out_height // pix_height
+        right = (x_off + self.tile_size) * out_width // pix_width
+        bottom = (y_off + self.tile_size) * out_height // pix_height
+        return (left, top), (right - left, bottom - top)
+
+
+def fit_size(image_size, max_size):
+    """
+    Given the (width, height) of an image and a maximum (width, height),
+    returns the largest size within max_size with the image's proportions.
+    """
+    w_h_ratio = float(image_size[0]) / image_size[1]
+    new_width = int(max_size[1] * w_h_ratio)
+    new_height = int(max_size[0] / w_h_ratio)
+    if new_width > max_size[0]:
+        return max_size[0], new_height
+    elif new_height > max_size[1]:
+        return new_width, max_size[1]
+    return tuple(max_size)
 
 
 # import httplib
 # httplib.HTTPConnection.debuglevel = 1
 opener = urllib.request.build_opener()
-opener.addheaders = [("User-agent", "OSMViz/1.1.0 +https://hugovk.github.io/osmviz")]
+opener.addheaders = [("User-agent", USER_AGENT)]
 urllib.request.install_opener(opener)
@@ -0,0 +1,194 @@
+"""
+Web Mercator Projection Tool:
+  - Converts lat/lon coordinates (in degrees) to OSM tile coordinates and
+    to pixel coordinates on a map image, and back.
+  - Every function accepts either plain numbers or NumPy arrays; arrays
+    are converted in one vectorized call.
+
+Basic idea:
+  1. Use lat_lon_to_tile() / tile_to_lat_lon() for tile coordinates at a
+     given zoom level (https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames).
+  2. Construct a Viewport for a map image (its lat/lon bounds and its
+     size in pixels) and call project() to get the pixel coordinates of
+     points on it. The Viewport precomputes the constants of its
+     projection, so projecting a point costs a handful of operations.
+
+Unlike linear interpolation of latitude between the map bounds, which
+drifts away from the tiles as the map gets taller, these functions use the
+same Web Mercator projection as the OSM tiles themselves.
+"""
+
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Latitude at which Web Mercator's square world map ends, in degrees
+MAX_LATITUDE = 85.0511287798
+
+_DEG_TO_RAD = math.pi / 180.0
+_RAD_TO_DEG = 180.0 / math.pi
+
+
+def _is_array(*values):
+    # Only NumPy arrays take the vectorized path: plain numbers keep their
+    # scalar results, and sequences must be converted by the caller
+    return np is not None and any(isinstance(v, np.ndarray) for v in values)
+
+
+def _broadcast(*values):
+    # Float arrays of one shape, so an array of latitudes may be paired
+    # with a single longitude (or vice versa)
+    return np.broadcast_arrays(*(np.asarray(v, dtype=float) for v in values))
+
+
+def mercator_x(lon_deg):
+    """
+    Returns the Web Mercator x coordinate of a longitude, as a fraction of
+    the world's width: 0 at -180 degrees, 1 at +180 degrees.
+    """
+    if _is_array(lon_deg):
+        return (np.asarray(lon_deg, dtype=float) + 180.0) / 360.0
+    return (lon_deg + 180.0) / 360.0
+
+
+def mercator_y(lat_deg):
+    """
+    Returns the Web Mercator y coordinate of a latitude, as a fraction of
+    the world's height: 0 at the top (north), 1 at the bottom (south).
+    Latitudes are clamped to +/- MAX_LATITUDE.
+    """
+    if _is_array(lat_deg):
+        lat_rad = np.radians(np.clip(np.asarray(lat_deg, dtype=float), -MAX_LATITUDE, MAX_LATITUDE))
+        return (1.0 - np.log(np.tan(lat_rad) + 1.0 / np.cos(lat_rad)) / math.pi) / 2.0
+    lat_rad = min(max(lat_deg, -MAX_LATITUDE), MAX_LATITUDE) * _DEG_TO_RAD
+    return (1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) / math.pi) / 2.0
+
+
+def mercator_lat(y):
+    """
+    Inverse of mercator_y(): returns the latitude, in degrees, of a Web
+    Mercator y coordinate given as a fraction of the world's height.
+    """
+    if _is_array(y):
+        return np.degrees(np.arctan(np.sinh(math.pi * (1.0 - 2.0 * np.asarray(y, dtype=float)))))
+    return math.atan(math.sinh(math.pi * (1.0 - 2.0 * y))) * _RAD_TO_DEG
+
+
+def lat_lon_to_tile(lat_deg, lon_deg, zoom):
+    """
+    Given lat, lon coords in DEGREES and a zoom level, returns the (x, y)
+    number of the tile containing them: ints for scalar input, int arrays
+    for array input.
+    """
+    n = 2.0**zoom
+    if _is_array(lat_deg, lon_deg):
+        lat_deg, lon_deg = _broadcast(lat_deg, lon_deg)
+        x = np.floor(mercator_x(lon_deg) * n).astype(np.int64)
+        y = np.floor(mercator_y(lat_deg) * n).astype(np.int64)
+        return x, y
+    return int(mercator_x(lon_deg) * n), int(mercator_y(lat_deg) * n)
+
+
+def tile_to_lat_lon(x_tile, y_tile, zoom):
+    """
+    Given x, y tile numbers (which may be fractional) and a zoom level,
+    returns the (lat, lon) in degrees of their upper left corner.
+    """
+    n = 2.0**zoom
+    if _is_array(x_tile, y_tile):
+        x_tile, y_tile = _broadcast(x_tile, y_tile)
+        return mercator_lat(y_tile / n), x_tile / n * 360.0 - 180.0
+    return mercator_lat(y_tile / n), x_tile / n * 360.0 - 180.0
+
+
+def tile_grid(bounds, zoom):
+    """
+    Given (min_lat, max_lat, min_lon, max_lon) bounds in degrees and a zoom
+    level, returns (xs, ys): two int arrays holding the x and y numbers of
+    every tile covering the bounds, ordered column by column.
+    """
+    min_lat, max_lat, min_lon, max_lon = bounds
+    last = (1 << zoom) - 1
+    min_x, min_y = lat_lon_to_tile(max_lat, min_lon, zoom)
+    max_x, max_y = lat_lon_to_tile(min_lat, max_lon, zoom)
+    min_x, min_y = max(min_x, 0), max(min_y, 0)
+    max_x, max_y = min(max_x, last), min(max_y, last)
+    xs, ys = np.meshgrid(
+        np.arange(min_x, max_x + 1), np.arange(min_y, max_y + 1), indexing="ij"
+    )
+    return xs.ravel(), ys.ravel()
+
+
+def choose_zoom(bounds, size, tile_size=256, max_zoom=19):
+    """
+    Given (min_lat, max_lat, min_lon, max_lon) bounds in degrees and the
+    (width, height) in pixels of an image they are to fit in, returns the
+    lowest zoom level (up to max_zoom) at which the tiles covering the
+    bounds have at least as many pixels as the image can show. Tiles of a
+    higher zoom level would only be scaled down again.
+    """
+    min_lat, max_lat, min_lon, max_lon = bounds
+    width, height = size
+    # Fractions of the world's width and height spanned by the bounds
+    span_x = mercator_x(max_lon) - mercator_x(min_lon)
+    span_y = mercator_y(min_lat) - mercator_y(max_lat)
+    if span_x <= 0 or span_y <= 0:
+        return max_zoom
+    # The image keeps the map's proportions, so the axis which fills the
+    # image first sets the scale
+    world_size = min(width / span_x, height / span_y)
+    zoom = math.ceil(math.log2(max(world_size / tile_size, 1.0)))
+    return min(zoom, max_zoom)
+
+
+class Viewport:
+    """
+    A map image covering known lat/lon bounds with a known size in pixels,
+    onto which lat/lon coordinates can be projected.
+    """
+
+    def __init__(self, bounds, screen_size):
+        """
+        Creates a Viewport.
+        Arguments:
+            bounds - (min_lat, max_lat, min_lon, max_lon) covered by the
+                 image, in degrees, as returned by create_osm_image()
+            screen_size - (width, height) of the image in pixels
+        """
+        self.bounds = tuple(bounds)
+        self.screen_size = tuple(screen_size)
+        min_lat, max_lat, min_lon, max_lon = bounds
+        width, height = screen_size
+
+        self._x0 = mercator_x(min_lon)
+        self._y0 = mercator_y(max_lat)
+        self._x_scale = width / (mercator_x(max_lon) - self._x0)
+        self._y_scale = height / (mercator_y(min_lat) - self._y0)
+
+    def project(self, lat, lon):
+        """
+        Given lat, lon coords in degrees, returns the corresponding (x, y)
+        pixel coordinates: ints for scalar input, int arrays for arrays.
+        An array may be paired with a scalar, which is broadcast to it.
+        """
+        if _is_array(lat, lon):
+            lat, lon = _broadcast(lat, lon)
+            x = (mercator_x(lon) - self._x0) * self._x_scale
+            y = (mercator_y(lat) - self._y0) * self._y_scale
+            return x.astype(np.int64), y.astype(np.int64)
+        x = (mercator_x(lon) - self._x0) * self._x_scale
+        y = (mercator_y(lat) - self._y0) * self._y_scale
+        return int(x), int(y)
+
+    def unproject(self, x, y):
+        """
+        Given (x, y) pixel coordinates, returns the corresponding (lat, lon)
+        in degrees.
+        """
+        if _is_array(x, y):
+            x, y = _broadcast(x, y)
+        lon = (x / self._x_scale + self._x0) * 360.0 - 180.0
+        return mercator_lat(y / self._y_scale + self._y0), lon
@@ -0,0 +1,303 @@
+"""
+Tile Seeding Tool:
+  - Warms an OSMManager's tile store for a region over a range of zoom
+    levels, so later simulations over that region never wait on the
+    tile server.
+  - Downloads with a bounded pool of workers and an optional rate limit.
+  - Can be interrupted and run again: fresh tiles already in the tile
+    store are skipped, so a second run resumes where the first one stopped.
+  - Tiles are requested and stored like OSMManager does, so seeded tiles
+    get freshness metadata (stale ones are revalidated with conditional
+    requests), failed tiles are negatively cached rather than requested
+    again by the next run, and a cache quota sees the seeded bytes.
+
+Basic idea:
+  1. Construct an OSMManager for the tile server and tile store to seed.
+  2. Construct a TileSeeder with it and call seed() with a bounding box
+     and a zoom range; a SeedReport is returned when done.
+  Or, from the command line:
+    python -m examples.osmviz_chronos.seed 30 46 -119 -68.5 --zooms 4 8
+"""
+
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .fetcher import TileFetcher
+from .projection import tile_grid
+
+
+class RateLimiter:
+    """
+    Spaces out calls to acquire() so that, across all threads, at most
+    rate calls go through per second.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until the caller may make its next request."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_time, now)
+            self._next_time = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class SeedReport:
+    """
+    Outcome of a TileSeeder.seed() run.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.skipped = 0
+        self.not_retried = 0
+        self.fetched = 0
+        self.revalidated = 0
+        self.failed = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        self.interrupted = False
+        self.errors = []
+
+    @property
+    def tiles_per_sec(self):
+        """Tiles downloaded per second of wall clock time."""
+        return self.fetched / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bytes_per_sec(self):
+        """Bytes downloaded per second of wall clock time."""
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        status = "interrupted" if self.interrupted else "done"
+        return (
+            f"Seeding {status}: {self.total} tiles, {self.skipped} already cached, "
+            f"{self.not_retried} failed recently (not retried), {self.fetched} fetched, "
+            f"{self.revalidated} revalidated, {self.failed} failed; "
+            f"{self.bytes} bytes in {self.elapsed:.1f}s "
+            f"({self.tiles_per_sec:.1f} tiles/s, {self.bytes_per_sec / 1024:.1f} KiB/s)"
+        )
+
+
+class TileSeeder:
+    """
+    A TileSeeder downloads every tile of a region's tile pyramid into an
+    OSMManager's tile store.
+    """
+
+    def __init__(self, osm, workers=None, rate=None, batch_size=200, verbose=True):
+        """
+        Creates a TileSeeder.
+        Arguments:
+            osm - OSMManager whose tile server and tile store are used
+            workers - maximum number of concurrent downloads. Default is the
+                 OSMManager fetcher's worker count. Each seed() downloads
+                 with its own TileFetcher, closed when seeding finishes.
+            rate - maximum number of tile requests per second, or None for
+                 no limit. Please respect the tile server's usage policy.
+            batch_size - number of responses written to the tile store per
+                 batch (one transaction for database stores)
+            verbose - whether to print progress while seeding
+        """
+        self.osm = osm
+        self.workers = workers or osm.fetcher.workers
+        self.limiter = RateLimiter(rate) if rate else None
+        self.batch_size = batch_size
+        self.verbose = verbose
+
+    def _download(self, fetcher, url, headers):
+        if self.limiter:
+            self.limiter.acquire()
+        return fetcher.request(url, headers)
+
+    def _tiles_to_fetch(self, bounds, min_zoom, max_zoom, report):
+        """
+        Yields (zoom, tile_coord, stored, meta) for each tile of the pyramid
+        which is missing from the tile store or stale, where stored says
+        whether it is in the store and meta is its freshness metadata.
+        Fresh tiles are counted as skipped, and tiles whose last download
+        failed less than negative_ttl ago as not retried.
+        """
+        osm = self.osm
+        store = osm.tile_store
+        now = time.time()
+        for zoom in range(min_zoom, max_zoom + 1):
+            xs, ys = tile_grid(bounds, zoom)
+            if not len(xs):
+                continue
+            tile_coords = list(zip(xs.tolist(), ys.tolist()))
+            # The grid is ordered column by column: look tiles up one column
+            # at a time, so bulk lookups stay small
+            height = int(ys.max() - ys.min()) + 1
+            for i in range(0, len(tile_coords), height):
+                column = tile_coords[i : i + height]
+                stored = store.get_stored_tiles(zoom, column)
+                metas = store.get_tile_metas(zoom, column)
+                report.total += len(column)
+                for tile_coord in column:
+                    meta = metas.get(tile_coord)
+                    # check_tile() only needs to know whether there is a source
+                    source = True if tile_coord in stored else None
+                    try:
+                        state = osm.check_tile(tile_coord, zoom, source, meta, now)
+                    except Exception:
+                        report.not_retried += 1
+                        continue
+                    if state == "fresh":
+                        report.skipped += 1
+                    else:
+                        yield zoom, tile_coord, source, meta
+
+    def seed(self, bounds, min_zoom, max_zoom):
+        """
+        Downloads every tile covering bounds, a (min_lat, max_lat, min_lon,
+        max_lon) box in degrees, at zoom levels min_zoom to max_zoom
+        inclusive, skipping fresh tiles already in the tile store and
+        revalidating stale ones (see OSMManager.check_tile()).
+        Returns a SeedReport. A KeyboardInterrupt stops seeding after
+        saving the tiles downloaded so far; the report is then marked as
+        interrupted.
+        """
+        report = SeedReport()
+        store = self.osm.tile_store
+        pending = {}
+        batch = []
+        start = time.monotonic()
+        last_print = start
+
+        def flush():
+            # Stored like OSMManager stores what it downloads: with metadata,
+            # failures negatively cached, and the cache quota told
+            with store.batch():
+                for zoom, tile_coord, source, meta, result in batch:
+                    self._store(zoom, tile_coord, source, meta, result, report)
+            batch.clear()
+
+        def collect(done):
+            for future in done:
+                zoom, tile_coord, source, meta = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = e
+                batch.append((zoom, tile_coord, source, meta, result))
+            if len(batch) >= self.batch_size:
+                flush()
+
+        fetcher = TileFetcher(
+            workers=self.workers, timeout=self.osm.fetcher.timeout, headers=self.osm.fetcher.headers
+        )
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            for zoom, tile_coord, source, meta in self._tiles_to_fetch(
+                bounds, min_zoom, max_zoom, report
+            ):
+                # Keep a bounded number of downloads in flight
+                while len(pending) >= 2 * self.workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                url = self.osm.get_tile_url(tile_coord, zoom)
+                headers = self.osm.get_tile_request_headers(meta) if source else None
+                future = pool.submit(self._download, fetcher, url, headers)
+                pending[future] = (zoom, tile_coord, source, meta)
+
+                now = time.monotonic()
+                if self.verbose and now - last_print >= 5.0:
+                    last_print = now
+                    report.elapsed = now - start
+                    print(report, flush=True)
+
+            collect(wait(pending).done)
+        except KeyboardInterrupt:
+            report.interrupted = True
+            for future in pending:
+                future.cancel()
+            collect([f for f in pending if f.done() and not f.cancelled()])
+        finally:
+            pool.shutdown(wait=not report.interrupted)
+            fetcher.close()
+            if batch:
+                flush()
+            report.elapsed = time.monotonic() - start
+
+        return report
+
+    def _store(self, zoom, tile_coord, source, meta, result, report):
+        """
+        Stores the result of requesting a tile with
+        OSMManager.store_tile_response(), and counts it in report.
+        """
+        x, y = tile_coord
+        try:
+            self.osm.store_tile_response(tile_coord, zoom, source, meta, result)
+        except Exception:
+            pass  # A missing tile which failed: negatively cached, counted below
+        if isinstance(result, Exception):
+            report.failed += 1
+            report.errors.append((zoom, x, y, str(result)))
+        elif result[0] == 200:
+            report.fetched += 1
+            report.bytes += len(result[2])
+        elif result[0] == 304:
+            report.revalidated += 1
+        else:
+            report.failed += 1
+            report.errors.append((zoom, x, y, f"HTTP {result[0]}"))
+
+
+def main():
+    import argparse
+
+    from .manager import ImageManager, OSMManager
+
+    parser = argparse.ArgumentParser(
+        description="Download all OSM tiles covering a region over a range of zoom levels."
+    )
+    parser.add_argument("min_lat", type=float)
+    parser.add_argument("max_lat", type=float)
+    parser.add_argument("min_lon", type=float)
+    parser.add_argument("max_lon", type=float)
+    parser.add_argument(
+        "--zooms", type=int, nargs=2, metavar=("MIN", "MAX"), required=True,
+        help="inclusive range of zoom levels to seed",
+    )
+    parser.add_argument("--cache", default="maptiles/", help="tile cache directory")
+    parser.add_argument("--url", help="tile URL template, e.g. https://server/{z}/{x}/{y}.png")
+    parser.add_argument(
+        "--tile-store", default="directory", choices=("directory", "mbtiles"),
+        help="how tiles are kept in the cache directory",
+    )
+    parser.add_argument("--workers", type=int, default=4, help="concurrent downloads")
+    parser.add_argument("--rate", type=float, help="maximum tile requests per second")
+    args = parser.parse_args()
+
+    # Seeding never builds an image, so the abstract ImageManager will do
+    osm = OSMManager(
+        cache=args.cache,
+        url=args.url,
+        tile_store=args.tile_store,
+        workers=args.workers,
+        image_manager=ImageManager(),
+    )
+    seeder = TileSeeder(osm, rate=args.rate)
+    try:
+        report = seeder.seed(
+            (args.min_lat, args.max_lat, args.min_lon, args.max_lon), *args.zooms
+        )
+    finally:
+        osm.close()
+        osm.tile_store.close()
+    print(report)
+    for zoom, x, y, error in report.errors[:10]:
+        print(f"  failed {zoom}/{x}/{y}: {error}")
+
+
+if __name__ == "__main__":
+    main()
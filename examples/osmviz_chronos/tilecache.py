@@ -0,0 +1,294 @@
+"""
+Decoded Tile Cache:
+  - Keeps recently used tiles in memory in their decoded form, so repeated
+    calls to OSMManager.create_osm_image() skip reading and decoding PNGs.
+  - Bounded by a byte budget, evicting least recently used tiles first.
+  - One cache (shared_tile_cache) is shared by every ImageManager in the
+    process; entries are namespaced per image format so a Pygame Surface
+    is never handed to a PIL ImageManager or vice versa.
+  - The in-memory cache dies with its process. RawTileCache keeps decoded
+    tiles on disk as raw pixels as well, so a new process (such as each
+    Chronos session started from the control panel) reads them back
+    instead of decoding the PNGs again.
+"""
+
+import hashlib
+import os
+import os.path as path
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from .fetcher import write_file_atomic
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Header of a RawTileCache file: magic, width, height and pixel mode
+_RAW_HEADER = struct.Struct("<4sII4s")
+_RAW_MAGIC = b"OSMT"
+
+
+class DecodedTileCache:
+    """
+    A thread-safe LRU mapping from tile keys to decoded images, bounded
+    by the approximate number of bytes those images occupy.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Creates a DecodedTileCache.
+        Arguments:
+            max_bytes - byte budget for all cached images. A budget of 0
+                 disables caching. Default 256 MiB.
+        """
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the image stored under key, marking it as most recently
+        used, or None if there is no such image.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, image, nbytes):
+        """
+        Stores image under key, accounting nbytes against the budget, then
+        evicts least recently used images until the cache fits its budget.
+        Images larger than the whole budget are not stored.
+        """
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (image, nbytes)
+            self.current_bytes += nbytes
+            self._evict()
+
+    def remove(self, key):
+        """Drops the image stored under key, if any."""
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+
+    def set_max_bytes(self, max_bytes):
+        """Changes the byte budget, evicting images if necessary."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        """Drops every cached image. Counters are left untouched."""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """
+        Returns a dict describing the cache: number of entries, bytes used,
+        byte budget, hits, misses, evictions and hit ratio.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._entries:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self.current_bytes -= nbytes
+            self.evictions += 1
+
+
+class RawTileCache:
+    """
+    A directory of decoded tiles, one file of raw pixels per tile, shared
+    by every process using the same directory. Reading a tile back is a
+    plain file read, much cheaper than decoding its PNG.
+    Bounded by a byte budget, evicting least recently used tiles first,
+    and by an age, after which a tile is decoded again from the tile
+    store (which may have a newer version of it by then).
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, max_age=7 * 24 * 3600):
+        """
+        Creates a RawTileCache storing its files in directory, which is
+        created if it does not exist.
+        Arguments:
+            max_bytes - byte budget for all cached tiles. Default 256 MiB.
+            max_age - number of seconds a tile is kept after it was stored.
+                 Default 7 days.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._bytes = None  # Unknown until the directory is first scanned
+        self._lock = threading.Lock()
+
+    def _filename(self, key):
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return path.join(self.directory, f"{digest}.raw")
+
+    def get(self, key):
+        """
+        Returns (size, mode, pixels) for the tile stored under key, where
+        size is its (width, height), mode its pixel format ("RGB", "RGBA",
+        ...) and pixels a bytes object of packed rows, or None if there is
+        no such tile or it has expired.
+        """
+        filename = self._filename(key)
+        try:
+            with open(filename, "rb") as f:
+                stored = os.fstat(f.fileno()).st_mtime
+                magic, width, height, mode = _RAW_HEADER.unpack(f.read(_RAW_HEADER.size))
+                pixels = f.read()
+            if magic != _RAW_MAGIC or time.time() - stored > self.max_age:
+                raise ValueError
+            mode = mode.decode("ascii").strip()
+            if len(pixels) != width * height * len(mode):
+                raise ValueError
+            # Mark the tile as recently used, leaving its age alone
+            os.utime(filename, (time.time(), stored))
+        except (OSError, ValueError, struct.error):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return (width, height), mode, pixels
+
+    def put(self, key, size, mode, pixels):
+        """
+        Stores the decoded tile under key (see get()), then evicts least
+        recently used tiles if the cache is over its budget.
+        """
+        width, height = size
+        if len(mode) > 4 or len(pixels) != width * height * len(mode):
+            raise Exception("Tile pixels do not match their size and mode.")
+        header = _RAW_HEADER.pack(_RAW_MAGIC, width, height, mode.encode("ascii").ljust(4))
+        write_file_atomic(self._filename(key), header + bytes(pixels))
+        with self._lock:
+            if self._bytes is not None:
+                self._bytes += _RAW_HEADER.size + len(pixels)
+            if self._bytes is None or self._bytes > self.max_bytes:
+                self._evict()
+
+    def remove(self, key):
+        """Deletes the tile stored under key, if any."""
+        self.discard(self._filename(key))
+
+    def discard(self, filename):
+        """
+        Deletes a file of the cache, as yielded by iter_usage(), if it is
+        still there.
+        """
+        try:
+            nbytes = os.stat(filename).st_size
+            os.remove(filename)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if self._bytes is not None:
+                self._bytes = max(self._bytes - nbytes, 0)
+
+    def iter_usage(self):
+        """
+        Yields (filename, nbytes, last_used) for every cached tile, where
+        last_used is the time it was last stored or read.
+        """
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".raw"):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            yield entry.path, st.st_size, st.st_atime
+
+    def stats(self):
+        """
+        Returns a dict describing the cache: bytes used (None until known),
+        byte budget, hits and misses.
+        """
+        with self._lock:
+            return {
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _evict(self):
+        """
+        Scans the directory, deleting expired tiles and then least recently
+        used ones until the cache is within 90% of its budget.
+        """
+        now = time.time()
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".raw"):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            if now - st.st_mtime > self.max_age:
+                self._unlink(entry.path)
+                continue
+            entries.append((st.st_atime, st.st_size, entry.path))
+            total += st.st_size
+
+        if total > self.max_bytes:
+            entries.sort()
+            for _, nbytes, filename in entries:
+                if total <= 0.9 * self.max_bytes:
+                    break
+                self._unlink(filename)
+                total -= nbytes
+        self._bytes = total
+
+    @staticmethod
+    def _unlink(filename):
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+
+# Process-wide cache used by every ImageManager unless told otherwise.
+shared_tile_cache = DecodedTileCache()
@@ -0,0 +1,709 @@
+"""
+Tile Store Tool:
+  - Provides a simple interface for storing and looking up map tiles
+    downloaded by an OSMManager
+  - Can keep tiles as individual files in a directory (the original
+    layout) or inside a single MBTiles (SQLite) database
+
+Basic idea:
+  1. Choose a TileStore class and construct an instance.
+     - DirectoryTileStore keeps one PNG file per tile, named like
+       osmviz-09b76-6_10_22.png.
+     - MBTilesStore keeps every tile of one tile server in one indexed
+       SQLite file, avoiding a stat and an open per tile lookup.
+  2. Pass it to an OSMManager through its tile_store argument, or pass
+     tile_store="mbtiles" to use <cache>/<cache_prefix>tiles.mbtiles.
+  3. Existing tile directories can be converted in one go with
+     import_tile_directory(), or from the command line:
+       python -m examples.osmviz_chronos.tilestore maptiles/
+     which creates one MBTiles file per tile server next to the tiles.
+
+Tile sources returned by a store are either filenames or file-like
+objects; both can be handed straight to an ImageManager.
+
+Every store also keeps freshness metadata for its tiles (see
+TileMetadata), which the OSMManager uses to decide when a tile needs to be
+revalidated with the tile server.
+"""
+
+import io
+import os
+import os.path as path
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from .fetcher import write_file_atomic
+
+# Cached tile filenames look like "osmviz-09b76-6_10_22.png"
+TILE_FILENAME_RE = re.compile(
+    r"^(?P<prefix>osmviz-[0-9a-f]{5}-)(?P<z>\d+)_(?P<x>\d+)_(?P<y>\d+)\.png$"
+)
+
+
+def mbtiles_filename(directory, prefix):
+    """
+    Returns the default MBTiles filename for tiles from the server whose
+    cached tile filenames start with prefix.
+    """
+    return path.join(directory, f"{prefix}tiles.mbtiles")
+
+
+def find_tile_prefixes(directory):
+    """
+    Returns the set of tile filename prefixes (one per tile server) found
+    in a tile cache directory.
+    """
+    prefixes = set()
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            match = TILE_FILENAME_RE.match(entry.name)
+            if match:
+                prefixes.add(match.group("prefix"))
+    return prefixes
+
+
+class TileMetadata:
+    """
+    Freshness metadata for tiles, kept in an SQLite table. For each tile:
+        fetched - time the tile was last fetched or revalidated
+        expires - time until which the tile may be used without asking
+             the tile server again
+        etag, last_modified - HTTP validators for conditional requests
+        status - 200 for a stored tile, otherwise the HTTP status (or 0
+             for a network error) of a failed download which is being
+             negatively cached until it expires
+    and, separately, when each tile was last used (see touch_many()).
+    Times are in seconds since the epoch.
+    """
+
+    FIELDS = ("fetched", "expires", "etag", "last_modified", "status")
+
+    def __init__(self, conn, lock):
+        """
+        Creates the metadata table, if necessary, in an open SQLite
+        connection; lock serializes access to the connection.
+        """
+        self.conn = conn
+        self._lock = lock
+        with self._lock:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS osmviz_tile_meta (
+                    zoom INTEGER NOT NULL,
+                    x INTEGER NOT NULL,
+                    y INTEGER NOT NULL,
+                    fetched REAL,
+                    expires REAL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    status INTEGER,
+                    accessed REAL,
+                    PRIMARY KEY (zoom, x, y)
+                )
+                """
+            )
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(osmviz_tile_meta)")]
+            if "accessed" not in columns:
+                self.conn.execute("ALTER TABLE osmviz_tile_meta ADD COLUMN accessed REAL")
+
+    def get(self, zoom, x, y):
+        """Returns the metadata dict of the given tile, or None."""
+        with self._lock:
+            row = self.conn.execute(
+                f"SELECT {', '.join(self.FIELDS)} FROM osmviz_tile_meta"
+                " WHERE zoom = ? AND x = ? AND y = ?",
+                (zoom, x, y),
+            ).fetchone()
+        return dict(zip(self.FIELDS, row)) if row else None
+
+    def get_many(self, zoom, tile_coords):
+        """
+        Returns a dict mapping each of tile_coords which has metadata to
+        its metadata dict, using a single range query.
+        """
+        wanted = set(tile_coords)
+        if not wanted:
+            return {}
+        xs = [x for x, _ in wanted]
+        ys = [y for _, y in wanted]
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT x, y, {', '.join(self.FIELDS)} FROM osmviz_tile_meta"
+                " WHERE zoom = ? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?",
+                (zoom, min(xs), max(xs), min(ys), max(ys)),
+            ).fetchall()
+        return {
+            (row[0], row[1]): dict(zip(self.FIELDS, row[2:]))
+            for row in rows
+            if (row[0], row[1]) in wanted
+        }
+
+    def put(self, zoom, x, y, meta):
+        """Stores the metadata dict of the given tile."""
+        with self._lock:
+            self.conn.execute(
+                "INSERT INTO osmviz_tile_meta"
+                f" (zoom, x, y, {', '.join(self.FIELDS)})"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (zoom, x, y) DO UPDATE SET "
+                + ", ".join(f"{field} = excluded.{field}" for field in self.FIELDS),
+                (zoom, x, y, *(meta.get(field) for field in self.FIELDS)),
+            )
+
+    def touch_many(self, zoom, tile_coords, now):
+        """Records that the given tiles were used at time now."""
+        with self._lock:
+            self.conn.executemany(
+                "INSERT INTO osmviz_tile_meta (zoom, x, y, accessed) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (zoom, x, y) DO UPDATE SET accessed = excluded.accessed",
+                [(zoom, x, y, now) for x, y in tile_coords],
+            )
+
+    def get_last_used(self):
+        """
+        Returns a dict mapping (zoom, x, y) to the time each tile was last
+        used or, if that was never recorded, fetched.
+        """
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT zoom, x, y, COALESCE(accessed, fetched) FROM osmviz_tile_meta"
+            ).fetchall()
+        return {(zoom, x, y): used for zoom, x, y, used in rows if used is not None}
+
+    def delete(self, zoom, x, y):
+        """Removes the metadata of the given tile, if any."""
+        with self._lock:
+            self.conn.execute(
+                "DELETE FROM osmviz_tile_meta WHERE zoom = ? AND x = ? AND y = ?",
+                (zoom, x, y),
+            )
+
+
+class TileStore:
+    """
+    Simple abstract interface for storing and retrieving tiles, to be used
+    by an OSMManager object.
+    Tiles are addressed by zoom level and slippy map (x, y) tile coords.
+    Subclasses set self.metadata to a TileMetadata, or leave it None if
+    they do not keep freshness metadata.
+    """
+
+    metadata = None
+
+    # TO BE OVERRIDDEN #
+
+    def get_tile_source(self, zoom, x, y):
+        """
+        To be overridden.
+        Returns something an ImageManager can load the given tile from
+        (a filename or a file-like object), or None if it is not stored.
+        """
+        raise NotImplementedError
+
+    def get_tile_data(self, zoom, x, y):
+        """
+        To be overridden.
+        Returns the encoded bytes of the given tile, or None if it is not
+        stored.
+        """
+        raise NotImplementedError
+
+    def put_tile(self, zoom, x, y, data):
+        """
+        To be overridden.
+        Stores the encoded bytes of the given tile and returns its tile
+        source, as get_tile_source() would.
+        """
+        raise NotImplementedError
+
+    def delete_tile(self, zoom, x, y):
+        """
+        To be overridden.
+        Removes the given tile from the store, if present.
+        """
+        raise NotImplementedError
+
+    def iter_tiles(self):
+        """
+        To be overridden.
+        Yields (zoom, x, y) for every stored tile.
+        """
+        raise NotImplementedError
+
+    def iter_tile_usage(self):
+        """
+        To be overridden.
+        Yields (zoom, x, y, nbytes, last_used) for every stored tile, where
+        last_used is the time the tile was last used, or the best available
+        estimate of it (e.g. when it was fetched).
+        """
+        raise NotImplementedError
+
+    # END OF TO BE OVERRIDDEN #
+
+    def is_tile_file(self, filename):
+        """
+        Returns True if filename is one of the files holding the tiles
+        whose bytes iter_tile_usage() reports, so that a cache quota does
+        not count them twice.
+        """
+        return False
+
+    def has_tile(self, zoom, x, y):
+        """Returns True if the given tile is stored."""
+        return self.get_tile_source(zoom, x, y) is not None
+
+    def get_tile_meta(self, zoom, x, y):
+        """Returns the freshness metadata dict of the given tile, or None."""
+        if self.metadata is None:
+            return None
+        return self.metadata.get(zoom, x, y)
+
+    def get_tile_metas(self, zoom, tile_coords):
+        """
+        Returns a dict mapping each of tile_coords which has freshness
+        metadata to its metadata dict.
+        """
+        if self.metadata is None:
+            return {}
+        return self.metadata.get_many(zoom, tile_coords)
+
+    def put_tile_meta(self, zoom, x, y, meta):
+        """Stores the freshness metadata dict of the given tile."""
+        if self.metadata is not None:
+            self.metadata.put(zoom, x, y, meta)
+
+    def touch_tiles(self, zoom, tile_coords, now=None):
+        """
+        Records that the given tiles were just used, for least recently
+        used cache eviction.
+        """
+        if self.metadata is not None:
+            self.metadata.touch_many(zoom, tile_coords, time.time() if now is None else now)
+
+    def delete_tiles(self, tiles):
+        """
+        Given an iterable of (zoom, x, y) tuples, removes all of those
+        tiles inside a single batch.
+        """
+        with self.batch():
+            for zoom, x, y in tiles:
+                self.delete_tile(zoom, x, y)
+
+    def get_tile_sources(self, zoom, tile_coords):
+        """
+        Given a zoom level and a collection of (x, y) tile coords, returns
+        a dict mapping each stored tile coord to its tile source. Tiles
+        which are not stored are left out.
+        Stores which can look up many tiles at once should override this.
+        """
+        sources = {}
+        for x, y in tile_coords:
+            source = self.get_tile_source(zoom, x, y)
+            if source is not None:
+                sources[(x, y)] = source
+        return sources
+
+    def get_stored_tiles(self, zoom, tile_coords):
+        """
+        Given a zoom level and a collection of (x, y) tile coords, returns
+        the set of those which are stored, without reading any tile data.
+        Stores which can look up many tiles at once should override this.
+        """
+        return set(self.get_tile_sources(zoom, tile_coords))
+
+    def put_tiles(self, tiles):
+        """
+        Given an iterable of (zoom, x, y, data) tuples, stores them all
+        inside a single batch.
+        """
+        with self.batch():
+            for zoom, x, y, data in tiles:
+                self.put_tile(zoom, x, y, data)
+
+    @contextmanager
+    def batch(self):
+        """
+        Context manager grouping several put_tile() calls, so stores
+        backed by a database can write them in a single transaction.
+        """
+        yield self
+
+    def close(self):
+        """Releases any resources held by the store."""
+
+
+class DirectoryTileStore(TileStore):
+    """
+    A TileStore which keeps every tile as a separate file in a directory.
+    """
+
+    def __init__(self, directory, prefix):
+        """
+        Constructs a DirectoryTileStore.
+        Arguments:
+            directory - path to the directory holding the tile files
+            prefix - string with which every tile filename begins, used to
+                 keep tiles from different servers apart
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self._meta_conn = None
+        self._meta_lock = threading.Lock()
+
+    @property
+    def metadata(self):
+        """
+        Freshness metadata for the tiles, kept in a small SQLite file next
+        to them and opened on first use.
+        """
+        with self._meta_lock:
+            if self._meta_conn is None:
+                filename = path.join(self.directory, f"{self.prefix}meta.sqlite")
+                self._meta_conn = sqlite3.connect(
+                    filename, check_same_thread=False, isolation_level=None
+                )
+                self._meta_conn.execute("PRAGMA journal_mode=WAL")
+                self._metadata = TileMetadata(self._meta_conn, threading.RLock())
+        return self._metadata
+
+    def get_tile_filename(self, zoom, x, y):
+        """Returns the filename under which the given tile is stored."""
+        return path.join(self.directory, f"{self.prefix}{zoom}_{x}_{y}.png")
+
+    def get_tile_source(self, zoom, x, y):
+        filename = self.get_tile_filename(zoom, x, y)
+        if path.isfile(filename):
+            return filename
+        return None
+
+    def get_tile_data(self, zoom, x, y):
+        try:
+            with open(self.get_tile_filename(zoom, x, y), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put_tile(self, zoom, x, y, data):
+        filename = self.get_tile_filename(zoom, x, y)
+        write_file_atomic(filename, data)
+        return filename
+
+    def delete_tile(self, zoom, x, y):
+        try:
+            os.remove(self.get_tile_filename(zoom, x, y))
+        except FileNotFoundError:
+            pass
+        self.metadata.delete(zoom, x, y)
+
+    def is_tile_file(self, filename):
+        if path.abspath(path.dirname(filename)) != path.abspath(self.directory):
+            return False
+        match = TILE_FILENAME_RE.match(path.basename(filename))
+        return bool(match) and match.group("prefix") == self.prefix
+
+    def iter_tiles(self):
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                match = TILE_FILENAME_RE.match(entry.name)
+                if match and match.group("prefix") == self.prefix:
+                    yield int(match.group("z")), int(match.group("x")), int(match.group("y"))
+
+    def iter_tile_usage(self):
+        last_used = self.metadata.get_last_used()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                match = TILE_FILENAME_RE.match(entry.name)
+                if not match or match.group("prefix") != self.prefix:
+                    continue
+                tile = int(match.group("z")), int(match.group("x")), int(match.group("y"))
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield (*tile, st.st_size, last_used.get(tile, st.st_mtime))
+
+    def close(self):
+        with self._meta_lock:
+            if self._meta_conn is not None:
+                self._meta_conn.close()
+                self._meta_conn = None
+
+
+class MBTilesStore(TileStore):
+    """
+    A TileStore which keeps tiles in an MBTiles file: an SQLite database
+    with a "tiles" table indexed by (zoom_level, tile_column, tile_row).
+    As required by the MBTiles spec, rows are numbered from the bottom
+    (TMS scheme), so tile_row is the flipped slippy map y coordinate.
+    """
+
+    def __init__(self, filename, name=None):
+        """
+        Constructs an MBTilesStore, creating the database if necessary.
+        Arguments:
+            filename - path of the .mbtiles file
+            name - optional tileset name, recorded in the metadata table
+        """
+        self.filename = filename
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+        self.conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS tiles (
+                zoom_level INTEGER NOT NULL,
+                tile_column INTEGER NOT NULL,
+                tile_row INTEGER NOT NULL,
+                tile_data BLOB NOT NULL
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS tile_index
+                ON tiles (zoom_level, tile_column, tile_row);
+            """
+        )
+        # Extra tables are allowed by the MBTiles spec
+        self.metadata = TileMetadata(self.conn, self._lock)
+        with self.batch():
+            self.conn.execute(
+                "INSERT OR IGNORE INTO metadata (name, value) VALUES ('format', 'png')"
+            )
+            if name:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO metadata (name, value) VALUES ('name', ?)",
+                    (name,),
+                )
+
+    @staticmethod
+    def _flip_y(zoom, y):
+        """Converts between slippy map y and TMS tile_row (its own inverse)."""
+        return (1 << zoom) - 1 - y
+
+    def get_tile_data(self, zoom, x, y):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT tile_data FROM tiles"
+                " WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                (zoom, x, self._flip_y(zoom, y)),
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_tile_source(self, zoom, x, y):
+        data = self.get_tile_data(zoom, x, y)
+        if data is None:
+            return None
+        return io.BytesIO(data)
+
+    def get_tile_sources(self, zoom, tile_coords):
+        """
+        Looks up every tile of the bounding box enclosing tile_coords with
+        a single indexed range query.
+        """
+        wanted = set(tile_coords)
+        if not wanted:
+            return {}
+        xs = [x for x, _ in wanted]
+        ys = [y for _, y in wanted]
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT tile_column, tile_row, tile_data FROM tiles"
+                " WHERE zoom_level = ? AND tile_column BETWEEN ? AND ?"
+                " AND tile_row BETWEEN ? AND ?",
+                (
+                    zoom,
+                    min(xs),
+                    max(xs),
+                    self._flip_y(zoom, max(ys)),
+                    self._flip_y(zoom, min(ys)),
+                ),
+            ).fetchall()
+
+        sources = {}
+        for x, row, data in rows:
+            coord = (x, self._flip_y(zoom, row))
+            if coord in wanted:
+                sources[coord] = io.BytesIO(data)
+        return sources
+
+    def get_stored_tiles(self, zoom, tile_coords):
+        """
+        Like get_tile_sources(), a single range query, but answered from
+        the tile index alone, without reading the tile blobs.
+        """
+        wanted = set(tile_coords)
+        if not wanted:
+            return set()
+        xs = [x for x, _ in wanted]
+        ys = [y for _, y in wanted]
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT tile_column, tile_row FROM tiles"
+                " WHERE zoom_level = ? AND tile_column BETWEEN ? AND ?"
+                " AND tile_row BETWEEN ? AND ?",
+                (
+                    zoom,
+                    min(xs),
+                    max(xs),
+                    self._flip_y(zoom, max(ys)),
+                    self._flip_y(zoom, min(ys)),
+                ),
+            ).fetchall()
+        return {(x, self._flip_y(zoom, row)) for x, row in rows} & wanted
+
+    def put_tile(self, zoom, x, y, data):
+        with self.batch():
+            self.conn.execute(
+                "INSERT OR REPLACE INTO tiles"
+                " (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+                (zoom, x, self._flip_y(zoom, y), sqlite3.Binary(data)),
+            )
+        return io.BytesIO(data)
+
+    def put_tiles(self, tiles):
+        rows = (
+            (zoom, x, self._flip_y(zoom, y), sqlite3.Binary(data))
+            for zoom, x, y, data in tiles
+        )
+        with self.batch():
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO tiles"
+                " (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+
+    def delete_tile(self, zoom, x, y):
+        with self.batch():
+            self.conn.execute(
+                "DELETE FROM tiles"
+                " WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                (zoom, x, self._flip_y(zoom, y)),
+            )
+            self.metadata.delete(zoom, x, y)
+
+    def is_tile_file(self, filename):
+        # The database, and its write-ahead log while it is open
+        base = path.abspath(self.filename)
+        return path.abspath(filename) in (base, f"{base}-wal", f"{base}-shm", f"{base}-journal")
+
+    def iter_tiles(self):
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT zoom_level, tile_column, tile_row FROM tiles"
+            ).fetchall()
+        for zoom, x, row in rows:
+            yield zoom, x, self._flip_y(zoom, row)
+
+    def iter_tile_usage(self):
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT t.zoom_level, t.tile_column, t.tile_row, length(t.tile_data),"
+                " COALESCE(m.accessed, m.fetched, 0)"
+                " FROM tiles t LEFT JOIN osmviz_tile_meta m"
+                " ON m.zoom = t.zoom_level AND m.x = t.tile_column"
+                " AND m.y = (1 << t.zoom_level) - 1 - t.tile_row"
+            ).fetchall()
+        for zoom, x, row, nbytes, last_used in rows:
+            yield zoom, x, self._flip_y(zoom, row), nbytes, last_used
+
+    @contextmanager
+    def batch(self):
+        """
+        Runs the enclosed writes in one transaction, committed when the
+        outermost batch exits and rolled back if it raises.
+        """
+        with self._lock:
+            if self._batch_depth == 0:
+                self.conn.execute("BEGIN")
+            self._batch_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self.conn.execute("ROLLBACK")
+                raise
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.conn.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+def import_tile_directory(directory, store, prefix, batch_size=1000, remove=False):
+    """
+    Copies every cached tile file from one tile server in directory into
+    store, committing in batches of batch_size tiles.
+    Arguments:
+        directory - tile cache directory, e.g. "maptiles/"
+        store - destination TileStore
+        prefix - filename prefix of the tiles to import, which identifies
+             the tile server they came from, e.g. "osmviz-09b76-"
+        batch_size - number of tiles written per transaction
+        remove - if True, each tile file is deleted once its batch has
+             been committed
+    Returns the number of tiles imported.
+    """
+    count = 0
+    batch = []
+    imported_files = []
+
+    def flush():
+        store.put_tiles(batch)
+        if remove:
+            for filename in imported_files:
+                os.remove(filename)
+        batch.clear()
+        imported_files.clear()
+
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            match = TILE_FILENAME_RE.match(entry.name)
+            if not match or match.group("prefix") != prefix:
+                continue
+            with open(entry.path, "rb") as f:
+                data = f.read()
+            zoom, x, y = int(match.group("z")), int(match.group("x")), int(match.group("y"))
+            batch.append((zoom, x, y, data))
+            imported_files.append(entry.path)
+            count += 1
+            if len(batch) >= batch_size:
+                flush()
+    if batch:
+        flush()
+    return count
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Import a directory of cached OSM tiles into MBTiles files, "
+        "one per tile server."
+    )
+    parser.add_argument("directory", help="tile cache directory, e.g. maptiles/")
+    parser.add_argument("--prefix", help="only import tiles with this filename prefix")
+    parser.add_argument(
+        "--remove", action="store_true", help="delete tile files once imported"
+    )
+    args = parser.parse_args()
+
+    prefixes = [args.prefix] if args.prefix else sorted(find_tile_prefixes(args.directory))
+    for prefix in prefixes:
+        filename = mbtiles_filename(args.directory, prefix)
+        store = MBTilesStore(filename, name=prefix)
+        try:
+            count = import_tile_directory(args.directory, store, prefix, remove=args.remove)
+        finally:
+            store.close()
+        print(f"Imported {count} tiles into {filename}")
+
+
+if __name__ == "__main__":
+    main()
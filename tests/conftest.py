@@ -0,0 +1,135 @@
+"""
+Shared fixtures: a stand-in tile server on localhost, so OSMManager and
+TileSeeder can be tested without touching a real tile server.
+"""
+
+import io
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import pygame  # noqa: E402
+
+from examples.osmviz_chronos.tilecache import shared_tile_cache  # noqa: E402
+
+
+def make_tile_png(color, size=256):
+    """Returns a PNG of a size x size tile filled with color."""
+    surface = pygame.Surface((size, size))
+    surface.fill(color)
+    buf = io.BytesIO()
+    pygame.image.save(surface, buf, "tile.png")
+    return buf.getvalue()
+
+
+class TileServer:
+    """
+    Serves /{z}/{x}/{y}.png tiles, one plain colour each, with an ETag
+    per tile version, answering If-None-Match with 304.
+    Attributes tests may change:
+        max_age - Cache-Control max-age sent with tiles, or None
+        missing - set of (zoom, x, y) answered with 404
+        versions - {(zoom, x, y): version}, 1 for tiles not in it
+    Every request is recorded in requests as (time, path, headers).
+    """
+
+    TILE_RE = re.compile(r"^/(\d+)/(\d+)/(\d+)\.png$")
+
+    def __init__(self):
+        self.max_age = None
+        self.missing = set()
+        self.versions = {}
+        self.requests = []
+        self._lock = threading.Lock()
+        self._pngs = {}
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/{{z}}/{{x}}/{{y}}.png"
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def etag(self, tile):
+        return '"{}-{}-{}-v{}"'.format(*tile, self.versions.get(tile, 1))
+
+    def tile_png(self, tile):
+        key = (tile, self.versions.get(tile, 1))
+        with self._lock:
+            if key not in self._pngs:
+                zoom, x, y = tile
+                color = ((x * 40 + key[1] * 90) % 256, (y * 40) % 256, (zoom * 30) % 256)
+                self._pngs[key] = make_tile_png(color)
+            return self._pngs[key]
+
+    def _handle(self, request):
+        with self._lock:
+            self.requests.append((time.monotonic(), request.path, dict(request.headers)))
+        match = self.TILE_RE.match(request.path)
+        tile = tuple(int(n) for n in match.groups()) if match else None
+        if tile is None or tile in self.missing:
+            self._respond(request, 404, {}, b"not found")
+            return
+        headers = {"ETag": self.etag(tile)}
+        if self.max_age is not None:
+            headers["Cache-Control"] = f"max-age={self.max_age}"
+        if request.headers.get("If-None-Match") == headers["ETag"]:
+            self._respond(request, 304, headers, b"")
+            return
+        headers["Content-Type"] = "image/png"
+        self._respond(request, 200, headers, self.tile_png(tile))
+
+    @staticmethod
+    def _respond(request, status, headers, body):
+        request.send_response(status)
+        for name, value in headers.items():
+            request.send_header(name, value)
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def tile_requests(self):
+        """Returns the (zoom, x, y, headers) of every tile request so far."""
+        with self._lock:
+            requests = list(self.requests)
+        return [
+            (*(int(n) for n in self.TILE_RE.match(path).groups()), headers)
+            for _, path, headers in requests
+            if self.TILE_RE.match(path)
+        ]
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def tile_server():
+    server = TileServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture(autouse=True)
+def clear_shared_tile_cache():
+    # Decoded tiles must not leak from one test's tile server to the next
+    shared_tile_cache.clear()
+    yield
+    shared_tile_cache.clear()
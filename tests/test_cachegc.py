@@ -0,0 +1,93 @@
+import os
+import time
+
+from examples.osmviz_chronos.bgcache import BackgroundCache
+from examples.osmviz_chronos.cachegc import TileCacheGC
+from examples.osmviz_chronos.tilecache import RawTileCache
+from examples.osmviz_chronos.tilestore import DirectoryTileStore
+
+DAY = 24 * 3600
+
+
+def directory_bytes(directory):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(directory)
+        for name in files
+    )
+
+
+def make_cache(tmp_path, tiles=4, tile_bytes=10000):
+    """A directory cache with tiles, decoded tiles and a background, all last used a day ago."""
+    store = DirectoryTileStore(str(tmp_path), "osmviz-00000-")
+    raw = RawTileCache(str(tmp_path / "decoded"))
+    backgrounds = BackgroundCache(str(tmp_path / "backgrounds"))
+    old = time.time() - DAY
+    for x in range(tiles):
+        store.put_tile(5, x, 0, bytes(tile_bytes))
+        raw.put(("ns", "osmviz-00000-", 5, x, 0), (50, 50), "RGB", bytes(50 * 50 * 3))
+    store.touch_tiles(5, [(x, 0) for x in range(tiles)], now=old)
+    backgrounds.save("bg", (10, 10), (0, 1, 0, 1), bytes(300))
+    for directory in (raw.directory, backgrounds.directory):
+        for entry in os.scandir(directory):
+            os.utime(entry.path, (old, old))
+    return store, raw, backgrounds
+
+
+def test_raw_tile_cache_remove_updates_bytes(tmp_path):
+    raw = RawTileCache(str(tmp_path))
+    for x in range(3):
+        raw.put(("ns", x), (10, 10), "RGB", bytes(300))
+    before = raw.stats()["bytes"]
+    assert before == directory_bytes(tmp_path)
+
+    raw.remove(("ns", 0))
+    raw.remove(("ns", 0))  # already gone
+    assert raw.stats()["bytes"] == before - (before // 3) == directory_bytes(tmp_path)
+
+
+def test_quota_counts_every_file(tmp_path):
+    store, raw, backgrounds = make_cache(tmp_path)
+    (tmp_path / "unrelated.bin").write_bytes(bytes(1234))
+    gc = TileCacheGC(
+        store, 10**9, background_cache=backgrounds, raw_tile_cache=raw, directory=str(tmp_path)
+    )
+    usage = gc.usage()
+    assert usage["tiles"] == 4 and usage["decoded"] == 4 and usage["backgrounds"] == 1
+    # The metadata database and the unrelated file are counted as well
+    assert usage["other_bytes"] >= 1234
+    assert usage["bytes"] == directory_bytes(tmp_path)
+    assert gc.collect()["bytes_before"] == directory_bytes(tmp_path)
+    store.close()
+
+
+def test_collect_evicts_old_entries_of_every_kind(tmp_path):
+    store, raw, backgrounds = make_cache(tmp_path)
+    gc = TileCacheGC(
+        store, 1, background_cache=backgrounds, raw_tile_cache=raw, directory=str(tmp_path)
+    )
+    gc.pin(5, [(0, 0)])
+    stats = gc.collect()
+    assert (stats["evicted_tiles"], stats["evicted_decoded"], stats["evicted_backgrounds"]) == (3, 4, 1)
+    assert set(store.iter_tiles()) == {(5, 0, 0)}
+    usage = gc.usage()
+    assert (usage["tiles"], usage["decoded"], usage["backgrounds"]) == (1, 0, 0)
+    assert raw.stats()["bytes"] == 0
+    store.close()
+
+
+def test_collect_keeps_recently_used_entries(tmp_path):
+    # Used by another process a minute ago: not pinned here, but kept
+    store, raw, backgrounds = make_cache(tmp_path)
+    store.touch_tiles(5, [(0, 0), (1, 0)], now=time.time() - 60)
+    gc = TileCacheGC(
+        store, 1, background_cache=backgrounds, raw_tile_cache=raw, directory=str(tmp_path)
+    )
+    stats = gc.collect()
+    assert stats["evicted_tiles"] == 2
+    assert set(store.iter_tiles()) == {(5, 0, 0), (5, 1, 0)}
+
+    gc.keep_recent = 0
+    gc.collect()
+    assert set(store.iter_tiles()) == set()
+    store.close()
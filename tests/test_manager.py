@@ -0,0 +1,130 @@
+import time
+
+import pygame
+import pytest
+
+from examples.osmviz_chronos.manager import OSMManager, PygameImageManager
+from examples.osmviz_chronos.tilecache import shared_tile_cache
+
+# Four tiles at zoom 2: x and y 1 to 2
+BOUNDS = (-10, 10, -10, 10)
+ZOOM = 2
+TILES = {(ZOOM, x, y) for x in (1, 2) for y in (1, 2)}
+
+
+def make_osm(tmp_path, tile_server, **kwargs):
+    return OSMManager(
+        cache=str(tmp_path),
+        url=tile_server.url,
+        image_manager=PygameImageManager(),
+        **kwargs,
+    )
+
+
+def create_image(osm):
+    img, bounds = osm.create_osm_image(BOUNDS, ZOOM)
+    pixels = pygame.image.tostring(img, "RGB")
+    osm.manager.destroy_image()
+    return pixels
+
+
+def test_expired_tile_in_decoded_cache_is_revalidated(tmp_path, tile_server):
+    tile_server.max_age = 1
+    osm = make_osm(tmp_path, tile_server)
+    first = create_image(osm)
+    assert len(tile_server.tile_requests()) == len(TILES)
+    assert len(shared_tile_cache) == len(TILES)
+
+    # Still fresh: everything comes from the decoded cache
+    assert create_image(osm) == first
+    assert len(tile_server.tile_requests()) == len(TILES)
+
+    # Expired while still decoded in memory: each tile is revalidated
+    time.sleep(1.1)
+    assert create_image(osm) == first
+    requests = tile_server.tile_requests()[len(TILES):]
+    assert {(zoom, x, y) for zoom, x, y, _ in requests} == TILES
+    for zoom, x, y, headers in requests:
+        assert headers["If-None-Match"] == tile_server.etag((zoom, x, y))
+    osm.close()
+
+
+def test_changed_tile_replaces_decoded_copy(tmp_path, tile_server):
+    tile_server.max_age = 1
+    osm = make_osm(tmp_path, tile_server)
+    first = create_image(osm)
+
+    tile_server.versions[(ZOOM, 1, 1)] = 2
+    time.sleep(1.1)
+    assert create_image(osm) != first
+    osm.close()
+
+
+def test_unchanged_tile_is_revalidated_not_downloaded(tmp_path, tile_server):
+    tile_server.max_age = 1
+    osm = make_osm(tmp_path, tile_server)
+    source = osm.retrieve_tile_image((1, 1), ZOOM)
+    meta = osm.tile_store.get_tile_meta(ZOOM, 1, 1)
+    time.sleep(1.1)
+
+    assert osm.retrieve_tile_image((1, 1), ZOOM) == source
+    _, _, _, headers = tile_server.tile_requests()[-1]
+    assert headers["If-None-Match"] == tile_server.etag((ZOOM, 1, 1))
+    revalidated = osm.tile_store.get_tile_meta(ZOOM, 1, 1)
+    assert revalidated["etag"] == meta["etag"]
+    assert revalidated["expires"] > meta["expires"]
+
+    # Fresh again: no request at all
+    osm.retrieve_tile_image((1, 1), ZOOM)
+    assert len(tile_server.tile_requests()) == 2
+    osm.close()
+
+
+def test_offline_uses_stale_tiles_without_requests(tmp_path, tile_server):
+    tile_server.max_age = 1
+    osm = make_osm(tmp_path, tile_server)
+    first = create_image(osm)
+    osm.close()
+    time.sleep(1.1)
+
+    offline = make_osm(tmp_path, tile_server, offline=True)
+    assert create_image(offline) == first
+    assert len(tile_server.tile_requests()) == len(TILES)
+
+    # A tile which was never downloaded cannot be had offline
+    with pytest.raises(Exception, match="offline"):
+        offline.retrieve_tile_image((0, 0), ZOOM)
+    assert len(tile_server.tile_requests()) == len(TILES)
+
+
+def test_missing_tile_is_negatively_cached(tmp_path, tile_server):
+    tile_server.missing = {(ZOOM, 0, 0)}
+    osm = make_osm(tmp_path, tile_server, negative_ttl=1)
+    with pytest.raises(Exception, match="HTTP 404"):
+        osm.retrieve_tile_image((0, 0), ZOOM)
+    with pytest.raises(Exception, match="not retrying"):
+        osm.retrieve_tile_image((0, 0), ZOOM)
+    # Only the first attempt reached the server
+    assert len(tile_server.tile_requests()) == 1
+    assert osm.tile_store.get_tile_meta(ZOOM, 0, 0)["status"] == 404
+
+    # Retried once negative_ttl has passed
+    tile_server.missing = set()
+    time.sleep(1.1)
+    assert osm.retrieve_tile_image((0, 0), ZOOM) is not None
+    assert len(tile_server.tile_requests()) == 2
+    osm.close()
+
+
+def test_stale_tile_is_kept_when_revalidation_fails(tmp_path, tile_server):
+    tile_server.max_age = 1
+    osm = make_osm(tmp_path, tile_server, negative_ttl=3600)
+    source = osm.retrieve_tile_image((1, 1), ZOOM)
+    time.sleep(1.1)
+
+    tile_server.missing = {(ZOOM, 1, 1)}
+    assert osm.retrieve_tile_image((1, 1), ZOOM) == source
+    # Not asked again until negative_ttl has passed
+    assert osm.retrieve_tile_image((1, 1), ZOOM) == source
+    assert len(tile_server.tile_requests()) == 2
+    osm.close()
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from examples.osmviz_chronos.projection import Viewport, lat_lon_to_tile, tile_to_lat_lon
+
+BOUNDS = (30, 46, -119, -68.5)
+SIZE = (1280, 800)
+
+
+def test_project_arrays_match_scalars():
+    viewport = Viewport(BOUNDS, SIZE)
+    lats = np.array([31.0, 38.5, 45.0])
+    lons = np.array([-118.0, -90.0, -70.0])
+    xs, ys = viewport.project(lats, lons)
+    assert [viewport.project(lat, lon) for lat, lon in zip(lats, lons)] == list(
+        zip(xs.tolist(), ys.tolist())
+    )
+
+
+@pytest.mark.parametrize(
+    "lat, lon",
+    [(np.array([31.0, 38.5, 45.0]), -90.0), (38.5, np.array([-118.0, -90.0, -70.0]))],
+)
+def test_project_mixed_array_and_scalar(lat, lon):
+    viewport = Viewport(BOUNDS, SIZE)
+    xs, ys = viewport.project(lat, lon)
+    assert xs.shape == ys.shape == (3,)
+    for x, y, la, lo in zip(xs, ys, *np.broadcast_arrays(lat, lon)):
+        assert viewport.project(float(la), float(lo)) == (x, y)
+
+    lats, lons = viewport.unproject(xs, 400)
+    assert lats.shape == lons.shape == (3,)
+
+
+def test_tiles_mixed_array_and_scalar():
+    xs, ys = lat_lon_to_tile(np.array([31.0, 45.0]), -90.0, 6)
+    expected = [lat_lon_to_tile(lat, -90.0, 6) for lat in (31.0, 45.0)]
+    assert list(zip(xs.tolist(), ys.tolist())) == expected
+    lats, lons = tile_to_lat_lon(np.array([16, 17]), 24, 6)
+    assert lons.shape == lats.shape == (2,)
@@ -0,0 +1,109 @@
+import time
+
+import pytest
+
+from examples.osmviz_chronos.manager import ImageManager, OSMManager
+from examples.osmviz_chronos.seed import TileSeeder
+
+# The whole world at zooms 0 to 2: 1 + 4 + 16 tiles
+WORLD = (-85, 85, -180, 179.9)
+WORLD_TILES = 21
+
+
+def make_osm(tmp_path, tile_server, **kwargs):
+    # Seeding never builds an image, so the abstract ImageManager will do
+    return OSMManager(
+        cache=str(tmp_path), url=tile_server.url, image_manager=ImageManager(), **kwargs
+    )
+
+
+@pytest.fixture(params=["directory", "mbtiles"])
+def osm(request, tmp_path, tile_server):
+    osm = make_osm(tmp_path, tile_server, tile_store=request.param)
+    yield osm
+    osm.close()
+    osm.tile_store.close()
+
+
+def test_seeded_tiles_have_metadata(osm, tile_server):
+    tile_server.max_age = 3600
+    report = TileSeeder(osm, verbose=False).seed(WORLD, 0, 2)
+    assert (report.total, report.fetched, report.failed) == (WORLD_TILES, WORLD_TILES, 0)
+    assert report.bytes > 0
+
+    now = time.time()
+    meta = osm.tile_store.get_tile_meta(2, 1, 3)
+    assert meta["etag"] == tile_server.etag((2, 1, 3))
+    assert meta["status"] == 200
+    assert now + 3000 < meta["expires"] <= now + 3600
+
+    # All fresh: nothing is requested again
+    report = TileSeeder(osm, verbose=False).seed(WORLD, 0, 2)
+    assert (report.skipped, report.fetched) == (WORLD_TILES, 0)
+    assert len(tile_server.tile_requests()) == WORLD_TILES
+
+
+def test_stale_tiles_are_revalidated(osm, tile_server):
+    tile_server.max_age = 1
+    TileSeeder(osm, verbose=False).seed(WORLD, 0, 1)
+    time.sleep(1.1)
+
+    report = TileSeeder(osm, verbose=False).seed(WORLD, 0, 1)
+    assert (report.revalidated, report.fetched, report.bytes) == (5, 0, 0)
+    requests = tile_server.tile_requests()[5:]
+    assert len(requests) == 5
+    for zoom, x, y, headers in requests:
+        assert headers["If-None-Match"] == tile_server.etag((zoom, x, y))
+
+
+def test_failed_tiles_are_not_requested_again(osm, tile_server):
+    tile_server.missing = {(2, 0, 0), (2, 3, 3)}
+    report = TileSeeder(osm, verbose=False).seed(WORLD, 0, 2)
+    assert (report.fetched, report.failed) == (WORLD_TILES - 2, 2)
+    assert {error[:3] for error in report.errors} == tile_server.missing
+
+    # Resuming neither requests the stored tiles nor retries the failures
+    # until negative_ttl has passed
+    report = TileSeeder(osm, verbose=False).seed(WORLD, 0, 2)
+    assert (report.skipped, report.not_retried, report.fetched) == (WORLD_TILES - 2, 2, 0)
+    assert len(tile_server.tile_requests()) == WORLD_TILES
+
+
+def test_interrupted_seed_resumes(osm, tile_server, monkeypatch):
+    seeder = TileSeeder(osm, workers=2, verbose=False)
+    tiles_to_fetch = seeder._tiles_to_fetch
+
+    def interrupted(*args):
+        for n, tile in enumerate(tiles_to_fetch(*args)):
+            if n == 10:
+                raise KeyboardInterrupt
+            yield tile
+
+    monkeypatch.setattr(seeder, "_tiles_to_fetch", interrupted)
+    report = seeder.seed(WORLD, 0, 2)
+    assert report.interrupted
+    fetched = report.fetched
+    assert 0 < fetched <= 10
+
+    report = TileSeeder(osm, verbose=False).seed(WORLD, 0, 2)
+    assert not report.interrupted
+    assert (report.skipped, report.fetched) == (fetched, WORLD_TILES - fetched)
+
+
+def test_rate_limit(tmp_path, tile_server):
+    osm = make_osm(tmp_path, tile_server)
+    report = TileSeeder(osm, workers=4, rate=20, verbose=False).seed(WORLD, 0, 2)
+    assert report.fetched == WORLD_TILES
+
+    times = sorted(t for t, _, _ in tile_server.requests)
+    # 20 requests per second at most, however many workers there are
+    assert times[-1] - times[0] >= (WORLD_TILES - 1) / 20 * 0.9
+    osm.close()
+
+
+def test_cache_quota_sees_seeded_bytes(tmp_path, tile_server):
+    osm = make_osm(tmp_path, tile_server, cache_quota=10**9)
+    before = osm.cache_gc.collect()["bytes_after"]
+    report = TileSeeder(osm, verbose=False).seed(WORLD, 0, 2)
+    assert osm.cache_gc._tracked_bytes == before + report.bytes
+    osm.close()